@@ -1,217 +1,614 @@
 import datetime
+import json
 import logging
+import os
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from redis.exceptions import LockError, RedisError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from database_backend import get_database_connection, is_database_configured
 
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
-SITE_TOKEN_LIFETIME = None
-SITE_TOKEN = None
-SITE_CLIENT_TOKEN = None
-SITE_CLIENT_TOKEN_LIFETIME = None
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_LOCK_TIMEOUT = 30
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.3
+DEFAULT_TIMEOUTS = {
+    'default': (3.05, 10),
+    'token': (3.05, 10),
+    'catalog': (3.05, 15),
+    'product': (3.05, 10),
+    'file': (3.05, 10),
+    'cart': (3.05, 10),
+    'flow': (3.05, 10),
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 100
+DEFAULT_PAGE_WORKERS = 4
+
+_client = None
+_client_lock = threading.Lock()
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+
+class ElasticpathClient(object):
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeouts=None,
+                 retries=DEFAULT_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        self.timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        # Only idempotent reads are retried on read errors and bad statuses,
+        # connection errors are safe to retry for any method.
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        # Threads beyond the pool size wait for a pooled connection instead
+        # of opening one that is thrown away afterwards.
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
+    def close(self):
+        self.session.close()
 
-def get_token(url, client_id, client_secret=None):
-    global SITE_TOKEN, SITE_TOKEN_LIFETIME, SITE_CLIENT_TOKEN
-    global SITE_CLIENT_TOKEN_LIFETIME
+    def request(self, method, url, endpoint='default', **kwargs):
+        kwargs.setdefault(
+            'timeout',
+            self.timeouts.get(endpoint, self.timeouts['default'])
+        )
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
 
-    now = datetime.datetime.now()
-    if not client_secret and SITE_TOKEN_LIFETIME:
-        logger.debug(
-            f'Time is now: {now} and token valid until: '
-            f'{datetime.datetime.fromtimestamp(SITE_TOKEN_LIFETIME)}'
+    def request_token(self, url, data):
+        response = self.request('POST', url, endpoint='token', data=data)
+        return response.json()
+
+    def iter_pages(self, url, access_token, page_size=DEFAULT_PAGE_SIZE,
+                   endpoint='catalog', params=None):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        params = dict(params or {})
+        params.update({
+            'page[limit]': min(page_size, MAX_PAGE_SIZE),
+            'page[offset]': 0,
+        })
+        fetched = 0
+        next_url = url
+        while next_url:
+            response = self.request(
+                'GET', next_url, endpoint=endpoint,
+                headers=headers, params=params
+            )
+            page = response.json()
+            yield page
+            # A short page is not the last one when the server caps the
+            # page size, so stop on the total or a missing next link.
+            entries = len(page.get('data') or [])
+            fetched += entries
+            total = get_total(page)
+            if not entries or (total is not None and fetched >= total):
+                break
+            # links.next already carries the page parameters
+            next_url = (page.get('links') or {}).get('next')
+            params = None
+
+    def iter_entries(self, url, access_token, page_size=DEFAULT_PAGE_SIZE,
+                     endpoint='catalog'):
+        for page in self.iter_pages(url, access_token, page_size, endpoint):
+            yield from page.get('data') or []
+
+    def fetch_pages(self, url, access_token, page_size=DEFAULT_PAGE_SIZE,
+                    max_workers=DEFAULT_PAGE_WORKERS, endpoint='catalog',
+                    params=None):
+        first_page = next(
+            self.iter_pages(url, access_token, page_size, endpoint, params)
+        )
+        first_entries = len(first_page.get('data') or [])
+        total = get_total(first_page)
+        if not first_entries or total is None:
+            return [first_page]
+        # Step by what the server actually returned, in case it caps the
+        # page size below ours.
+        page_size = min(page_size, MAX_PAGE_SIZE, max(first_entries, 1))
+        offsets = range(page_size, total, page_size)
+        if not offsets:
+            return [first_page]
+
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+
+        def fetch_page(offset):
+            page_params = dict(params or {})
+            page_params.update({
+                'page[limit]': page_size,
+                'page[offset]': offset,
+            })
+            response = self.request(
+                'GET', url, endpoint=endpoint,
+                headers=headers, params=page_params
+            )
+            return response.json()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [first_page, *executor.map(fetch_page, offsets)]
+
+    def fetch_all_pages(self, url, access_token, page_size=DEFAULT_PAGE_SIZE,
+                        max_workers=DEFAULT_PAGE_WORKERS, endpoint='catalog'):
+        entries = []
+        for page in self.fetch_pages(
+            url, access_token, page_size, max_workers, endpoint
+        ):
+            entries.extend(page.get('data') or [])
+        return entries
+
+    def get_products_with_main_images(self, url, access_token,
+                                      page_size=DEFAULT_PAGE_SIZE,
+                                      max_workers=DEFAULT_PAGE_WORKERS):
+        products = {}
+        main_images = {}
+        pages = self.fetch_pages(
+            url, access_token, page_size, max_workers,
+            params={'include': 'main_image'}
+        )
+        for page in pages:
+            for product in page.get('data') or []:
+                products[product.get('id')] = product
+            included = page.get('included') or {}
+            for image in included.get('main_images') or []:
+                main_images[image.get('id')] = (
+                    image.get('link').get('href')
+                )
+        return products, main_images
+
+    def get_catalog(self, url, access_token):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'GET', url, endpoint='catalog', headers=headers
+        )
+        return response.json()
+
+    def get_product_detail(self, url, product_id, access_token):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'GET', f'{url}{product_id}/', endpoint='product', headers=headers
         )
-    if client_secret and SITE_CLIENT_TOKEN_LIFETIME:
+        return response.json().get('data')
+
+    def get_product_picture_url(self, url, picture_id, access_token):
+        headers = {
+            'Authorization': f'Bearer {access_token}'
+        }
+        response = self.request(
+            'GET', f'{url}{picture_id}', endpoint='file', headers=headers
+        )
+        return response.json().get('data').get('link').get('href')
+
+    def get_cart(self, url, access_token, client_id):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'GET', f'{url}{client_id}', endpoint='cart', headers=headers
+        )
+        return response.json()
+
+    def add_proudct_to_cart(self, url, product_id, quantity, access_token,
+                            client_id):
         logger.debug(
-            f'Time is now: {now} and token valid until: '
-            f'{datetime.datetime.fromtimestamp(SITE_CLIENT_TOKEN_LIFETIME)}'
-        )
-    if not client_secret and SITE_TOKEN and (
-        SITE_TOKEN_LIFETIME > datetime.datetime.timestamp(now)
-    ):
-        logger.debug(f'Getting old token {SITE_TOKEN}')
-        return SITE_TOKEN
-    elif not client_secret:
-        logger.debug('Requesting new token')
-        logger.debug(f'Old token: {SITE_TOKEN}')
-        data = {
-            'client_id': client_id,
-            'grant_type': 'implicit'
+            f'{url}, {product_id}, {quantity}, {access_token}, {client_id}'
+        )
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'X-MOLTIN-CURRENCY': 'RUB',
         }
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        token = response.json()
-        SITE_TOKEN_LIFETIME = token.get('expires')
-        SITE_TOKEN = token.get('access_token')
-        logger.debug(f'New token: {SITE_TOKEN}')
-        return SITE_TOKEN
-
-    if client_secret and SITE_CLIENT_TOKEN and (
-        SITE_CLIENT_TOKEN_LIFETIME > datetime.datetime.timestamp(now)
-    ):
-        logger.debug(f'Getting old token {SITE_CLIENT_TOKEN}')
-        return SITE_CLIENT_TOKEN
-    else:
+        json_data = {
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': quantity,
+            }
+        }
+        logger.debug(json_data)
+        response = self.request(
+            'POST',
+            f'{url}{client_id}/items',
+            endpoint='cart',
+            headers=headers,
+            json=json_data
+        )
+        return response.json()
+
+    def remove_products_from_cart(self, url, cart_product_id, access_token,
+                                  client_id):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'DELETE',
+            f'{url}{client_id}/items/{cart_product_id}',
+            endpoint='cart',
+            headers=headers
+        )
+        return response.json()
+
+    def get_cart_products(self, url, access_token, client_id):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'GET', f'{url}{client_id}/items', endpoint='cart', headers=headers
+        )
+        return response.json()
+
+    def get_pizzeries_coordinates(self, url, access_token):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request('GET', url, endpoint='flow', headers=headers)
+        return response.json().get('data')
+
+    def create_customer_address(self, url, access_token, location):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        json_data = {
+            'data': {
+                'type': 'entry',
+                'longitude': location.longitude,
+                'latitude': location.latitude,
+            }
+        }
+        logger.debug(json_data)
+        response = self.request(
+            'POST', url, endpoint='flow', headers=headers, json=json_data
+        )
+        return response.json().get('data').get('id')
+
+    def get_customer_address(self, url, access_token, id):
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        response = self.request(
+            'GET', f'{url}/{id}', endpoint='flow', headers=headers
+        )
+        return response.json().get('data')
+
+    def get_products_by_category_id(self, url, access_token, id):
+        filter_string = urllib.parse.quote_plus(f'eq(category.id,{id})')
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        params = {
+            'filter': filter_string,
+        }
+        response = self.request(
+            'GET', url, endpoint='catalog', params=params, headers=headers
+        )
+        products = response.json().get('data')
+        logger.debug(products)
+        return products
+
+    def get_products_by_category_slug(self, url, access_token, slug):
+        filter_string = urllib.parse.quote_plus(f'eq(slug,{slug})')
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+        }
+        params = {
+            'filter': filter_string,
+        }
+        response = self.request(
+            'GET', url, endpoint='catalog', params=params, headers=headers
+        )
+        products = response.json().get('data')
+        logger.debug(products)
+        return products
+
+
+class TokenManager(object):
+
+    def __init__(self, client=None, database=None,
+                 refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.client = client
+        self.database = database
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._locks = {}
+        self._timers = {}
+        self._guard = threading.Lock()
+
+    def get_token(self, url, client_id, client_secret=None):
+        key = self._get_key(client_id, client_secret)
+        token = self._tokens.get(key)
+        now = time.time()
+        if token and token['expires'] - self.refresh_margin > now:
+            logger.debug(f'Getting old token {token["access_token"]}')
+            return token['access_token']
+        if token and token['expires'] > now:
+            logger.debug(
+                'Token is about to expire at '
+                f'{datetime.datetime.fromtimestamp(token["expires"])}, '
+                'refreshing in background'
+            )
+            threading.Thread(
+                target=self.refresh,
+                args=(url, client_id, client_secret),
+                kwargs={'wait': False},
+                daemon=True,
+            ).start()
+            return token['access_token']
+        return self.refresh(url, client_id, client_secret)
+
+    def refresh(self, url, client_id, client_secret=None, wait=True):
+        key = self._get_key(client_id, client_secret)
+        lock = self._get_lock(key)
+        if not lock.acquire(blocking=wait):
+            return None
+        try:
+            token = self._tokens.get(key)
+            if token and self._is_fresh(token):
+                return token['access_token']
+            token = self._load_shared_token(key)
+            if not token:
+                token = self._request_shared_token(
+                    key, url, client_id, client_secret
+                )
+            self._tokens[key] = token
+            self._schedule_refresh(key, url, client_id, client_secret, token)
+            return token['access_token']
+        finally:
+            lock.release()
+
+    def stop(self):
+        with self._guard:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+    def _get_key(self, client_id, client_secret):
+        grant_type = 'client_credentials' if client_secret else 'implicit'
+        return f'elasticpath_token:{grant_type}:{client_id}'
+
+    def _get_lock(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _is_fresh(self, token):
+        return token['expires'] - self.refresh_margin > time.time()
+
+    def _schedule_refresh(self, key, url, client_id, client_secret, token):
+        delay = token['expires'] - self.refresh_margin - time.time()
+        if delay <= 0:
+            return
+        timer = threading.Timer(
+            delay, self._refresh_quietly, (url, client_id, client_secret)
+        )
+        timer.daemon = True
+        with self._guard:
+            old_timer = self._timers.pop(key, None)
+            if old_timer:
+                old_timer.cancel()
+            self._timers[key] = timer
+        timer.start()
+
+    def _refresh_quietly(self, url, client_id, client_secret):
+        try:
+            self.refresh(url, client_id, client_secret)
+        except (requests.RequestException, RedisError) as err:
+            logger.error(f'Background token refresh failed: {err}')
+
+    def _load_shared_token(self, key):
+        if not self.database:
+            return None
+        try:
+            stored_token = self.database.get(key)
+        except RedisError as err:
+            logger.error(f'Could not read shared token: {err}')
+            return None
+        if not stored_token:
+            return None
+        token = json.loads(stored_token)
+        if not self._is_fresh(token):
+            return None
+        logger.debug(f'Getting shared token {token["access_token"]}')
+        return token
+
+    def _request_shared_token(self, key, url, client_id, client_secret):
+        if not self.database:
+            return self._request_token(url, client_id, client_secret)
+        try:
+            with self.database.lock(
+                f'{key}:lock',
+                timeout=TOKEN_LOCK_TIMEOUT,
+                blocking_timeout=TOKEN_LOCK_TIMEOUT,
+            ):
+                token = self._load_shared_token(key)
+                if token:
+                    return token
+                token = self._request_token(url, client_id, client_secret)
+                self.database.set(
+                    key,
+                    json.dumps(token),
+                    ex=max(int(token['expires'] - time.time()), 1),
+                )
+                return token
+        except (LockError, RedisError) as err:
+            logger.error(f'Could not share token through database: {err}')
+            return self._request_token(url, client_id, client_secret)
+
+    def _request_token(self, url, client_id, client_secret):
         logger.debug('Requesting new token')
-        logger.debug(f'Old token: {SITE_CLIENT_TOKEN}')
         data = {
             'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': 'client_credentials'
+            'grant_type': 'implicit',
         }
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        token = response.json()
-        SITE_CLIENT_TOKEN_LIFETIME = token.get('expires')
-        SITE_CLIENT_TOKEN = token.get('access_token')
-        logger.debug(f'New token: {SITE_CLIENT_TOKEN}')
-        return SITE_CLIENT_TOKEN
+        if client_secret:
+            data['client_secret'] = client_secret
+            data['grant_type'] = 'client_credentials'
+        client = self.client or get_client()
+        token = client.request_token(url, data)
+        logger.debug(f'New token: {token.get("access_token")}')
+        return {
+            'access_token': token.get('access_token'),
+            'expires': token.get('expires'),
+        }
+
+
+def get_total(page):
+    return (page.get('meta') or {}).get('results', {}).get('total')
+
+
+def get_http_pool_size():
+    return int(os.getenv('PIZZA_SHOP_HTTP_POOL_SIZE', DEFAULT_POOL_SIZE))
+
+
+def get_client():
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            _client = ElasticpathClient(
+                pool_size=get_http_pool_size(),
+                retries=int(
+                    os.getenv('PIZZA_SHOP_HTTP_RETRIES', DEFAULT_RETRIES)
+                ),
+            )
+    return _client
+
+
+def set_client(client):
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def get_token_manager():
+    global _token_manager
+    if _token_manager is not None:
+        return _token_manager
+    # A second manager would request its own token and run its own
+    # refresh timer, so the refresh would no longer be single-flight.
+    with _token_manager_lock:
+        if _token_manager is None:
+            database = None
+            if is_database_configured():
+                database = get_database_connection()
+            _token_manager = TokenManager(database=database)
+    return _token_manager
+
+
+def get_token(url, client_id, client_secret=None):
+    return get_token_manager().get_token(url, client_id, client_secret)
+
+
+def get_page_size():
+    return int(os.getenv('PIZZA_SHOP_PAGE_SIZE', DEFAULT_PAGE_SIZE))
 
 
 def get_catalog(url, access_token):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_catalog(url, access_token)
+
+
+def iter_catalog(url, access_token, page_size=None):
+    return get_client().iter_entries(
+        url, access_token, page_size or get_page_size()
+    )
+
+
+def fetch_all_pages(url, access_token, page_size=None,
+                    max_workers=DEFAULT_PAGE_WORKERS):
+    return get_client().fetch_all_pages(
+        url, access_token, page_size or get_page_size(), max_workers
+    )
+
+
+def get_products_with_main_images(url, access_token, page_size=None,
+                                  max_workers=DEFAULT_PAGE_WORKERS):
+    return get_client().get_products_with_main_images(
+        url, access_token, page_size or get_page_size(), max_workers
+    )
 
 
 def get_product_detail(url, product_id, access_token):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(f'{url}{product_id}/', headers=headers)
-    response.raise_for_status()
-    return response.json().get('data')
+    return get_client().get_product_detail(url, product_id, access_token)
 
 
 def get_product_picture_url(url, picture_id, access_token):
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(
-        f'{url}{picture_id}', headers=headers
-    )
-    response.raise_for_status()
-    return response.json().get('data').get('link').get('href')
+    return get_client().get_product_picture_url(url, picture_id, access_token)
 
 
 def get_cart(url, access_token, client_id):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(f'{url}{client_id}', headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_cart(url, access_token, client_id)
 
 
 def add_proudct_to_cart(url, product_id, quantity, access_token, client_id):
-    logger.debug(
-        f'{url}, {product_id}, {quantity}, {access_token}, {client_id}'
+    return get_client().add_proudct_to_cart(
+        url, product_id, quantity, access_token, client_id
     )
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'X-MOLTIN-CURRENCY': 'RUB',
-    }
-    json_data = {
-        'data': {
-            'id': product_id,
-            'type': 'cart_item',
-            'quantity': quantity,
-        }
-    }
-    logger.debug(json_data)
-    response = requests.post(
-        f'{url}{client_id}/items', headers=headers, json=json_data
-    )
-    response.raise_for_status()
-    return response.json()
 
 
 def remove_products_from_cart(url, cart_product_id, access_token, client_id):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.delete(
-        f'{url}{client_id}/items/{cart_product_id}', headers=headers
+    return get_client().remove_products_from_cart(
+        url, cart_product_id, access_token, client_id
     )
-    response.raise_for_status()
-    return response.json()
 
 
 def get_cart_products(url, access_token, client_id):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(f'{url}{client_id}/items', headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client().get_cart_products(url, access_token, client_id)
 
 
 def get_pizzeries_coordinates(url, access_token):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json().get('data')
+    return get_client().get_pizzeries_coordinates(url, access_token)
+
+
+def iter_pizzeries_coordinates(url, access_token, page_size=None):
+    return get_client().iter_entries(
+        url, access_token, page_size or get_page_size(), endpoint='flow'
+    )
 
 
 def create_customer_address(url, access_token, location):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    json_data = {
-        'data': {
-            'type': 'entry',
-            'longitude': location.longitude,
-            'latitude': location.latitude,
-        }
-    }
-    logger.debug(json_data)
-    response = requests.post(url, headers=headers, json=json_data)
-    response.raise_for_status()
-    return response.json().get('data').get('id')
+    return get_client().create_customer_address(url, access_token, location)
 
 
 def get_customer_address(url, access_token, id):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-
-    response = requests.get(f'{url}/{id}', headers=headers)
-    response.raise_for_status()
-    return response.json().get('data')
+    return get_client().get_customer_address(url, access_token, id)
 
 
 def get_products_by_category_id(url, access_token, id):
-    filter_string = urllib.parse.quote_plus(f'eq(category.id,{id})')
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    params = {
-        'filter': filter_string,
-    }
-    response = requests.get(url, params=params, headers=headers)
-    response.raise_for_status()
-    products = response.json().get('data')
-    logger.debug(products)
-    return products
+    return get_client().get_products_by_category_id(url, access_token, id)
 
 
 def get_products_by_category_slug(url, access_token, slug):
-    filter_string = urllib.parse.quote_plus(f'eq(slug,{slug})')
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    params = {
-        'filter': filter_string,
-    }
-    response = requests.get(url, params=params, headers=headers)
-    response.raise_for_status()
-    products = response.json().get('data')
-    logger.debug(products)
-    return products
+    return get_client().get_products_by_category_slug(url, access_token, slug)
@@ -2,6 +2,8 @@ from dataclasses import dataclass
 
 import requests
 
+GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+
 
 @dataclass
 class Address:
@@ -9,19 +11,22 @@ class Address:
     longitude: float
 
 
-def fetch_coordinates(apikey, address):
-    base_url = 'https://geocode-maps.yandex.ru/1.x'
-    response = requests.get(base_url, params={
-        'geocode': address,
-        'apikey': apikey,
-        'format': 'json',
-    })
-    response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']
+def parse_coordinates(geocoder_response):
+    found_places = geocoder_response['response']['GeoObjectCollection']
     found_places = found_places['featureMember']
     if not found_places:
         return None
 
     most_relevant = found_places[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(' ')
-    return Address(latitude=lat, longitude=lon)
+    return Address(latitude=float(lat), longitude=float(lon))
+
+
+def fetch_coordinates(apikey, address):
+    response = requests.get(GEOCODER_URL, params={
+        'geocode': address,
+        'apikey': apikey,
+        'format': 'json',
+    })
+    response.raise_for_status()
+    return parse_coordinates(response.json())
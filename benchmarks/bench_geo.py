@@ -0,0 +1,353 @@
+"""Benchmark pizzeria selection, delivery tiers and the geocoding cache.
+
+Pizzerias and customers are synthetic points scattered around the
+pizzerias in addresses.json. Every implementation is checked against the
+KD-tree path for the nearest pizzeria and the delivery price. The original
+geopy loop is too slow for large sets, so it only sees a sample of
+customers, and the grid is skipped where its build would take minutes.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_geo --sizes 50,500,5000 --output geo.json
+"""
+import json
+import math
+import platform
+import random
+import time
+
+import click
+import numpy as np
+from geopy.distance import distance
+
+from api_yandex import Address
+from delivery_grid import DeliveryGrid
+from delivery_tiers import get_delivery_tiers
+from geocoding_cache import ADDRESS_ABBREVIATIONS, GeocodingCache
+from pizzeria import calculate_distance_and_price, get_closest_pizzeria
+from pizzeria import get_pizzeriza_range
+from pizzeria_distances import DistanceEngine
+from pizzeria_index import EARTH_RADIUS_M, PizzeriaIndex
+from pizzeria_registry import Pizzeria
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+PIZZERIA_SPREAD = 15000
+CUSTOMER_SPREAD = 30000
+
+
+def load_seeds(addresses):
+    return [
+        (
+            address['address']['full'],
+            float(address['coordinates']['lat']),
+            float(address['coordinates']['lon']),
+        ) for address in json.load(addresses)
+    ]
+
+
+def scatter(rng, seeds, count, spread):
+    points = []
+    for _ in range(count):
+        _, latitude, longitude = rng.choice(seeds)
+        meters = abs(rng.gauss(0, spread / 2))
+        angle = rng.uniform(0, 2 * math.pi)
+        points.append((
+            latitude + meters * math.sin(angle) / METERS_PER_DEGREE,
+            longitude + meters * math.cos(angle) / METERS_PER_DEGREE
+            / math.cos(math.radians(latitude)),
+        ))
+    return points
+
+
+def make_pizzerias(points):
+    return [
+        Pizzeria(
+            id=str(position),
+            alias=f'pizzeria-{position}',
+            address=f'synthetic {position}',
+            latitude=latitude,
+            longitude=longitude,
+            delivery_tg_id=None,
+        ) for position, (latitude, longitude) in enumerate(points)
+    ]
+
+
+def get_naive_closest(coords, pizzerias):
+    # The selection as it was before the index: geopy against everything.
+    return min(
+        (
+            {
+                'pizzeria': pizzeria,
+                'distance': distance(
+                    (coords.latitude, coords.longitude),
+                    (pizzeria.latitude, pizzeria.longitude)
+                ),
+            } for pizzeria in pizzerias
+        ),
+        key=get_pizzeriza_range
+    )
+
+
+def get_naive_price(meters):
+    # The if-chain calculate_distance_and_price used before tiers moved
+    # to config.
+    if meters < 500:
+        return 0
+    if meters < 5000:
+        return 100
+    if meters < 20000:
+        return 300
+    return 0
+
+
+def timed(function, *args):
+    started_at = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started_at
+
+
+def summarize(name, size, customers, elapsed, answers, reference,
+              build_seconds=None):
+    mismatches = sum(
+        answer != expected
+        for answer, expected in zip(answers, reference)
+    )
+    return {
+        'implementation': name,
+        'pizzerias': size,
+        'customers': customers,
+        'build_s': round(build_seconds, 4) if build_seconds else None,
+        'total_s': round(elapsed, 4),
+        'per_customer_us': round(elapsed * 1e6 / customers, 2),
+        'mismatches': mismatches,
+    }
+
+
+def get_answer(tiers, closest_pizzeria):
+    return (
+        closest_pizzeria['pizzeria'].id,
+        tiers.quote(closest_pizzeria).price,
+    )
+
+
+def get_naive_answer(closest_pizzeria):
+    return (
+        closest_pizzeria['pizzeria'].id,
+        get_naive_price(closest_pizzeria['distance'].m),
+    )
+
+
+def bench_pizzerias(rng, seeds, size, customers, naive_pairs,
+                    grid_max_pizzerias):
+    tiers = get_delivery_tiers()
+    pizzerias = make_pizzerias(scatter(rng, seeds, size, PIZZERIA_SPREAD))
+    coords = [
+        Address(latitude=latitude, longitude=longitude)
+        for latitude, longitude in scatter(
+            rng, seeds, customers, CUSTOMER_SPREAD
+        )
+    ]
+    results = []
+
+    index, index_build = timed(PizzeriaIndex, pizzerias)
+    reference, elapsed = timed(
+        lambda: [get_closest_pizzeria(coord, index) for coord in coords]
+    )
+    answers = [get_answer(tiers, closest) for closest in reference]
+    results.append(summarize(
+        'kd_index', size, customers, elapsed, answers, answers, index_build
+    ))
+
+    naive_customers = max(1, min(customers, naive_pairs // size))
+    naive, elapsed = timed(lambda: [
+        get_naive_answer(get_naive_closest(coord, pizzerias))
+        for coord in coords[:naive_customers]
+    ])
+    results.append(summarize(
+        'geopy_loop', size, naive_customers, elapsed, naive,
+        answers[:naive_customers]
+    ))
+
+    engine, engine_build = timed(
+        DistanceEngine, pizzerias, tiers.boundaries
+    )
+    latitudes = np.array([coord.latitude for coord in coords])
+    longitudes = np.array([coord.longitude for coord in coords])
+    (positions, meters), elapsed = timed(
+        engine.nearest_many, latitudes, longitudes
+    )
+    results.append(summarize(
+        'numpy_engine', size, customers, elapsed,
+        [
+            get_answer(tiers, {
+                'pizzeria': pizzerias[position],
+                'distance': distance(meters=pizzeria_meters),
+            }) for position, pizzeria_meters in zip(positions, meters)
+        ],
+        answers, engine_build
+    ))
+
+    if size <= grid_max_pizzerias:
+        grid, grid_build = timed(
+            DeliveryGrid.build, engine, 'bench', tiers.boundaries
+        )
+
+        def lookup(coord):
+            found = grid.lookup(coord.latitude, coord.longitude)
+            if not found:
+                return get_closest_pizzeria(coord, index)
+            pizzeria = pizzerias[found[0]]
+            return {
+                'pizzeria': pizzeria,
+                'distance': distance(
+                    (coord.latitude, coord.longitude),
+                    (pizzeria.latitude, pizzeria.longitude)
+                ),
+            }
+
+        grid_answers, elapsed = timed(
+            lambda: [lookup(coord) for coord in coords]
+        )
+        result = summarize(
+            'delivery_grid', size, customers, elapsed,
+            [get_answer(tiers, closest) for closest in grid_answers],
+            answers, grid_build
+        )
+        result['cells'] = len(grid)
+        result['grid_hits'] = sum(
+            grid.lookup(coord.latitude, coord.longitude) is not None
+            for coord in coords
+        )
+        results.append(result)
+
+    naive_prices, elapsed = timed(lambda: [
+        get_naive_answer(closest) for closest in reference
+    ])
+    results.append(summarize(
+        'tier_if_chain', size, customers, elapsed, naive_prices, answers
+    ))
+    prices, elapsed = timed(lambda: [
+        calculate_distance_and_price(closest)[2] for closest in reference
+    ])
+    results.append(summarize(
+        'tier_quote', size, customers, elapsed,
+        [
+            (closest['pizzeria'].id, price)
+            for closest, price in zip(reference, prices)
+        ],
+        answers
+    ))
+    quotes, elapsed = timed(tiers.quote_many, reference)
+    results.append(summarize(
+        'tier_quote_many', size, customers, elapsed,
+        [
+            (closest['pizzeria'].id, quote.price)
+            for closest, quote in zip(reference, quotes)
+        ],
+        answers
+    ))
+    return results
+
+
+def vary_address(rng, address):
+    words = address.split()
+    full_words = {
+        full_word: abbreviation
+        for abbreviation, full_word in ADDRESS_ABBREVIATIONS.items()
+    }
+    return ' '.join(
+        f'{full_words[word]}.' if word in full_words and rng.random() < 0.5
+        else word
+        for word in words
+    ).replace(',', rng.choice([',', ' ,', '']))
+
+
+def bench_geocoding(rng, seeds, lookups):
+    locations = {
+        address: Address(latitude=latitude, longitude=longitude)
+        for address, latitude, longitude in seeds
+    }
+    fetched = []
+
+    def fetcher(address):
+        fetched.append(address)
+        return locations.get(address)
+
+    cache = GeocodingCache(fetcher)
+    queries = [
+        vary_address(rng, rng.choice(list(locations)))
+        for _ in range(lookups)
+    ]
+    _, elapsed = timed(lambda: [cache.lookup(query) for query in queries])
+    return {
+        'lookups': lookups,
+        'distinct_addresses': len(locations),
+        'fetches': len(fetched),
+        'hit_ratio': round(1 - len(fetched) / lookups, 4),
+        'per_lookup_us': round(elapsed * 1e6 / lookups, 2),
+    }
+
+
+@click.command()
+@click.option(
+    '--addresses',
+    type=click.File('r', encoding='utf-8'),
+    default='addresses.json',
+    help='file with pizzeria addresses'
+)
+@click.option(
+    '--sizes',
+    default='50,500,5000,100000',
+    help='comma separated pizzeria counts'
+)
+@click.option('--customers', default=1000, help='customers per size')
+@click.option(
+    '--naive-pairs',
+    default=100000,
+    help='customer x pizzeria pairs the geopy loop may compute per size'
+)
+@click.option(
+    '--grid-max-pizzerias',
+    default=1000,
+    help='skip the grid above this size, its build is cells x pizzerias'
+)
+@click.option('--geocoding-lookups', default=10000)
+@click.option('--seed', default=17)
+@click.option(
+    '--output',
+    type=click.File('w', encoding='utf-8'),
+    default='-',
+    help='where to write JSON results'
+)
+def main(addresses, sizes, customers, naive_pairs, grid_max_pizzerias,
+         geocoding_lookups, seed, output):
+    seeds = load_seeds(addresses)
+    rng = random.Random(seed)
+    results = []
+    for size in (int(size) for size in sizes.split(',')):
+        click.echo(f'{size} pizzerias...', err=True)
+        results.extend(bench_pizzerias(
+            rng, seeds, size, customers, naive_pairs, grid_max_pizzerias
+        ))
+    report = {
+        'meta': {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'seed': seed,
+            'tier_boundaries': list(get_delivery_tiers().boundaries),
+        },
+        'pizzeria_selection': results,
+        'geocoding_cache': bench_geocoding(rng, seeds, geocoding_lookups),
+    }
+    json.dump(report, output, indent=4, ensure_ascii=False)
+    output.write('\n')
+    mismatches = sum(result['mismatches'] for result in results)
+    if mismatches:
+        raise click.ClickException(
+            f'{mismatches} answers differ from the KD-tree path'
+        )
+
+
+if __name__ == '__main__':
+    main()
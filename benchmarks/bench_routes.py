@@ -0,0 +1,98 @@
+"""Compare courier routes of batched orders with the order of arrival.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_routes --batches 200 --batch-size 8
+"""
+import json
+import math
+import random
+import statistics
+import time
+
+import click
+
+from courier_dispatch import (
+    get_distance_matrix, get_route_length, improve_two_opt,
+    order_nearest_neighbour
+)
+from pizzeria_index import EARTH_RADIUS_M
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def load_pizzerias(addresses):
+    return [
+        (
+            float(address['coordinates']['lat']),
+            float(address['coordinates']['lon']),
+        ) for address in json.load(addresses)
+    ]
+
+
+def make_batch(rng, origin, size, radius):
+    latitude, longitude = origin
+    stops = []
+    for _ in range(size):
+        meters = radius * math.sqrt(rng.random())
+        angle = rng.uniform(0, 2 * math.pi)
+        stops.append((
+            latitude + meters * math.sin(angle) / METERS_PER_DEGREE,
+            longitude + meters * math.cos(angle) / METERS_PER_DEGREE
+            / math.cos(math.radians(latitude)),
+        ))
+    return stops
+
+
+def measure(batches, planner):
+    lengths = []
+    started_at = time.perf_counter()
+    for origin, stops in batches:
+        distances = get_distance_matrix([origin, *stops]).tolist()
+        lengths.append(get_route_length(distances, planner(distances)))
+    elapsed = time.perf_counter() - started_at
+    return {
+        'total_km': round(sum(lengths) / 1000, 1),
+        'mean_km': round(statistics.mean(lengths) / 1000, 2),
+        'ms_per_batch': round(elapsed * 1000 / len(batches), 3),
+    }
+
+
+@click.command()
+@click.option(
+    '--addresses',
+    type=click.File('r', encoding='utf-8'),
+    default='addresses.json',
+    help='file with pizzeria addresses'
+)
+@click.option('--batches', default=200, help='number of courier batches')
+@click.option('--batch-size', default=8, help='orders in a batch')
+@click.option('--radius', default=5000, help='delivery radius in meters')
+@click.option('--seed', default=17)
+def main(addresses, batches, batch_size, radius, seed):
+    rng = random.Random(seed)
+    pizzerias = load_pizzerias(addresses)
+    batches = [
+        (origin, make_batch(rng, origin, batch_size, radius))
+        for origin in (rng.choice(pizzerias) for _ in range(batches))
+    ]
+    results = {
+        'arrival_order': measure(
+            batches, lambda distances: list(range(len(distances)))
+        ),
+        'nearest_neighbour': measure(batches, order_nearest_neighbour),
+        'nearest_neighbour_2opt': measure(
+            batches,
+            lambda distances: improve_two_opt(
+                distances, order_nearest_neighbour(distances)
+            )
+        ),
+    }
+    naive_km = results['arrival_order']['total_km']
+    for result in results.values():
+        result['saved'] = round(1 - result['total_km'] / naive_km, 3)
+    click.echo(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
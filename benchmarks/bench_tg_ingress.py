@@ -0,0 +1,143 @@
+"""Measure update-to-reply latency of polling and webhook ingress offline.
+
+Both modes run the real bot application against benchmarks.fake_telegram.
+In webhook mode the fake delivers updates to the Flask ingress blueprint,
+which queues them in (fake) Redis for the bot to consume.
+
+Install requirements-dev.txt (fakeredis, aiohttp), then run from the
+repository root:
+
+    python -m benchmarks.bench_tg_ingress --chats 10 --messages 10
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+
+import click
+from flask import Flask
+from werkzeug.serving import make_server
+
+import shop_bot_tg
+import telegram_ingress
+from benchmarks.bench_tg_load import BOT_TOKEN, stub_upstream
+from benchmarks.fake_telegram import FakeTelegram, start_fake_telegram
+
+WEBHOOK_SECRET = 'benchmark-secret'
+
+
+def make_start_update(chat_id):
+    return {
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def start_ingress(database):
+    telegram_ingress.get_database_connection = lambda: database
+    os.environ['PIZZA_SHOP_TG_WEBHOOK_SECRET'] = WEBHOOK_SECRET
+    app = Flask(__name__)
+    app.register_blueprint(telegram_ingress.telegram_ingress)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/telegram'
+
+
+async def inject_updates(fake_telegram, chats, messages, interval):
+    for _ in range(messages):
+        for chat_id in range(1, chats + 1):
+            await fake_telegram.inject(make_start_update(chat_id))
+            await asyncio.sleep(interval)
+
+
+async def run_polling(chats, messages, interval, latency):
+    fake_telegram = FakeTelegram(latency)
+    fake_telegram.expected_replies = chats * messages
+    runner, base_url = await start_fake_telegram(fake_telegram)
+    application = shop_bot_tg.build_application(BOT_TOKEN, base_url=base_url)
+    async with application:
+        await application.post_init(application)
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+        await application.start()
+        await inject_updates(fake_telegram, chats, messages, interval)
+        await fake_telegram.done.wait()
+        await application.updater.stop()
+        await application.stop()
+    await runner.cleanup()
+    return fake_telegram.get_latencies()
+
+
+async def run_webhook(chats, messages, interval, latency, database):
+    fake_telegram = FakeTelegram(latency)
+    fake_telegram.expected_replies = chats * messages
+    runner, base_url = await start_fake_telegram(fake_telegram)
+    server, webhook_url = start_ingress(database)
+    application = shop_bot_tg.build_application(BOT_TOKEN, base_url=base_url)
+    bot_task = asyncio.create_task(telegram_ingress.run_webhook(
+        application, database, webhook_url, secret=WEBHOOK_SECRET
+    ))
+    while not fake_telegram.webhook_url:
+        await asyncio.sleep(0.01)
+    await inject_updates(fake_telegram, chats, messages, interval)
+    await fake_telegram.done.wait()
+    bot_task.cancel()
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    server.shutdown()
+    await runner.cleanup()
+    return fake_telegram.get_latencies()
+
+
+def summarize(mode, latencies):
+    return {
+        'mode': mode,
+        'updates': len(latencies),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(
+            latencies[int(len(latencies) * 0.95) - 1] * 1000, 1
+        ),
+        'max_ms': round(latencies[-1] * 1000, 1),
+    }
+
+
+@click.command()
+@click.option('--chats', default=10)
+@click.option('--messages', default=10, help='updates per chat')
+@click.option('--interval', default=0.01, help='seconds between updates')
+@click.option(
+    '--upstream-latency',
+    default=0.05,
+    help='seconds every Elasticpath call takes'
+)
+@click.option(
+    '--telegram-latency',
+    default=0.03,
+    help='seconds every Bot API call takes'
+)
+def main(chats, messages, interval, upstream_latency, telegram_latency):
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    database = stub_upstream(upstream_latency)
+    results = [
+        summarize('polling', asyncio.run(run_polling(
+            chats, messages, interval, telegram_latency
+        ))),
+        summarize('webhook', asyncio.run(run_webhook(
+            chats, messages, interval, telegram_latency, database
+        ))),
+    ]
+    click.echo(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
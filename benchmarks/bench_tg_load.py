@@ -0,0 +1,180 @@
+"""Load the Telegram bot with concurrent users, sequential vs concurrent.
+
+Updates are fed straight into the application, the Bot API is replaced by
+an in-process fake with a fixed latency, and Elasticpath calls sleep for
+a fixed time, so the numbers only show how the runtime overlaps waiting.
+
+Install requirements-dev.txt (fakeredis, aiohttp), then run from the
+repository root:
+
+    python -m benchmarks.bench_tg_load --users 50 --messages 4
+"""
+import asyncio
+import json
+import statistics
+import time
+from collections import defaultdict
+
+import click
+import fakeredis
+from telegram.request import BaseRequest
+
+import shop_bot_tg
+import user_data_store
+from database_backend import StateStore
+
+BOT_TOKEN = '123456:benchmark'
+
+
+class FakeTelegramRequest(BaseRequest):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.replies = defaultdict(list)
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        result = True
+        if endpoint == 'getMe':
+            result = {
+                'id': 123456,
+                'is_bot': True,
+                'first_name': 'Pizza',
+                'username': 'pizza_bot',
+            }
+        elif endpoint == 'sendMessage':
+            chat_id = int(parameters['chat_id'])
+            self.replies[chat_id].append(time.perf_counter())
+            result = {
+                'message_id': len(self.replies[chat_id]),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': parameters.get('text', ''),
+            }
+            if sum(map(len, self.replies.values())) >= self.expected:
+                self.done.set()
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def make_start_update(update_id, chat_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def stub_upstream(upstream_latency):
+    catalog = {
+        'data': [
+            {'id': f'pizza-{number}', 'name': f'Pizza {number}'}
+            for number in range(20)
+        ],
+    }
+
+    def get_cached_catalog(url, access_token):
+        time.sleep(upstream_latency)
+        return catalog
+
+    database = fakeredis.FakeRedis()
+    shop_bot_tg.get_token = lambda *args, **kwargs: 'token'
+    shop_bot_tg.get_cached_catalog = get_cached_catalog
+    shop_bot_tg.get_versioned_catalog = (
+        lambda url, access_token: (get_cached_catalog(url, access_token), 1)
+    )
+    state_store = StateStore(database)
+    shop_bot_tg.get_database_connection = lambda: database
+    shop_bot_tg.get_state_store = lambda prefix='': state_store
+    user_data_store._user_data_store = user_data_store.UserDataStore(database)
+    return database
+
+
+async def run_load(concurrent_updates, users, messages, telegram_latency):
+    from telegram import Update
+
+    request = FakeTelegramRequest(telegram_latency)
+    request.expected = users * messages
+    application = shop_bot_tg.build_application(
+        BOT_TOKEN, concurrent_updates=concurrent_updates, request=request
+    )
+    await application.initialize()
+    await shop_bot_tg.set_blocking_executor(application)
+    await application.start()
+    sent_at = defaultdict(list)
+    started_at = time.perf_counter()
+    update_id = 0
+    for _ in range(messages):
+        for chat_id in range(1, users + 1):
+            update_id += 1
+            sent_at[chat_id].append(time.perf_counter())
+            await application.update_queue.put(Update.de_json(
+                make_start_update(update_id, chat_id), application.bot
+            ))
+    await request.done.wait()
+    elapsed = time.perf_counter() - started_at
+    await application.stop()
+    await application.shutdown()
+    latencies = sorted(
+        replied - sent
+        for chat_id, sent_times in sent_at.items()
+        for sent, replied in zip(sent_times, request.replies[chat_id])
+    )
+    return {
+        'concurrent_updates': concurrent_updates,
+        'updates': users * messages,
+        'total_s': round(elapsed, 3),
+        'updates_per_s': round(users * messages / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p95_ms': round(
+            latencies[int(len(latencies) * 0.95) - 1] * 1000, 1
+        ),
+    }
+
+
+@click.command()
+@click.option('--users', default=50, help='chats sending at the same time')
+@click.option('--messages', default=4, help='updates per chat')
+@click.option(
+    '--concurrency',
+    default=shop_bot_tg.CONCURRENT_UPDATES,
+    help='concurrent updates of the concurrent run'
+)
+@click.option(
+    '--upstream-latency',
+    default=0.05,
+    help='seconds every Elasticpath call takes'
+)
+@click.option(
+    '--telegram-latency',
+    default=0.03,
+    help='seconds every Bot API call takes'
+)
+def main(users, messages, concurrency, upstream_latency, telegram_latency):
+    stub_upstream(upstream_latency)
+    results = [
+        asyncio.run(run_load(
+            concurrent_updates, users, messages, telegram_latency
+        ))
+        for concurrent_updates in (False, concurrency)
+    ]
+    click.echo(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""A local stand-in for the Telegram Bot API.
+
+It answers the methods the shop bot uses, serves getUpdates long polls,
+and delivers updates to a registered webhook with the secret token header,
+so polling and webhook modes can be measured without Telegram.
+
+Run it next to the bot:
+
+    python -m benchmarks.fake_telegram --port 8081
+    PIZZA_SHOP_TG_BASE_URL=http://127.0.0.1:8081/bot python shop_bot_tg.py
+
+and post updates to http://127.0.0.1:8081/fake/updates.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+
+import aiohttp
+import click
+from aiohttp import web
+
+from telegram_ingress import TELEGRAM_SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    'id': 123456,
+    'is_bot': True,
+    'first_name': 'Pizza',
+    'username': 'pizza_bot',
+}
+
+
+class FakeTelegram(object):
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.updates = []
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.injected_at = defaultdict(list)
+        self.replies = defaultdict(list)
+        self.expected_replies = 0
+        self.done = asyncio.Event()
+        self._new_updates = asyncio.Condition()
+        self._session = None
+        self._next_update_id = 1
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/fake/updates', self.handle_inject)
+        app.router.add_post('/bot{token}/{method}', self.handle_method)
+        app.on_cleanup.append(self._close_session)
+        return app
+
+    async def inject(self, update):
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        chat_id = get_chat_id(update)
+        if chat_id is not None:
+            self.injected_at[chat_id].append(time.perf_counter())
+        if self.webhook_url:
+            await self._post_webhook(update)
+            return
+        async with self._new_updates:
+            self.updates.append(update)
+            self._new_updates.notify_all()
+
+    async def handle_inject(self, request):
+        await self.inject(await request.json())
+        return web.json_response({'ok': True})
+
+    async def handle_method(self, request):
+        await asyncio.sleep(self.latency)
+        method = request.match_info['method']
+        parameters = await get_parameters(request)
+        handler = getattr(self, f'api_{method}', None)
+        result = await handler(parameters) if handler else True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def api_getMe(self, parameters):
+        return BOT_USER
+
+    async def api_setWebhook(self, parameters):
+        self.webhook_url = parameters.get('url') or None
+        self.webhook_secret = parameters.get('secret_token')
+        return True
+
+    async def api_deleteWebhook(self, parameters):
+        self.webhook_url = None
+        self.webhook_secret = None
+        return True
+
+    async def api_getUpdates(self, parameters):
+        offset = int(parameters.get('offset') or 0)
+        timeout = float(parameters.get('timeout') or 0)
+        async with self._new_updates:
+            self.updates = [
+                update for update in self.updates
+                if update['update_id'] >= offset
+            ]
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(
+                        self._new_updates.wait(), timeout
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            return list(self.updates)
+
+    async def api_sendMessage(self, parameters):
+        chat_id = int(parameters['chat_id'])
+        self.replies[chat_id].append(time.perf_counter())
+        if sum(map(len, self.replies.values())) >= self.expected_replies:
+            self.done.set()
+        return {
+            'message_id': len(self.replies[chat_id]),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': parameters.get('text', ''),
+        }
+
+    def get_latencies(self):
+        return sorted(
+            replied - injected
+            for chat_id, injected_times in self.injected_at.items()
+            for injected, replied in zip(
+                injected_times, self.replies[chat_id]
+            )
+        )
+
+    async def _post_webhook(self, update):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        headers = {}
+        if self.webhook_secret:
+            headers[TELEGRAM_SECRET_HEADER] = self.webhook_secret
+        async with self._session.post(
+            self.webhook_url, json=update, headers=headers
+        ) as response:
+            if response.status != 200:
+                logger.error(f'Webhook answered {response.status}')
+
+    async def _close_session(self, app):
+        if self._session:
+            await self._session.close()
+
+
+def get_chat_id(update):
+    message = update.get('message') or (
+        update.get('callback_query') or {}
+    ).get('message')
+    if not message:
+        return None
+    return message['chat']['id']
+
+
+async def get_parameters(request):
+    if request.content_type == 'application/json':
+        return await request.json()
+    parameters = {}
+    for name, value in (await request.post()).items():
+        try:
+            parameters[name] = json.loads(value)
+        except (TypeError, ValueError):
+            parameters[name] = value
+    return parameters
+
+
+async def start_fake_telegram(fake_telegram, host='127.0.0.1', port=0):
+    runner = web.AppRunner(fake_telegram.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}/bot'
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8081)
+@click.option('--latency', default=0.0, help='seconds every method takes')
+def main(host, port, latency):
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(FakeTelegram(latency).make_app(), host=host, port=port)
+
+
+if __name__ == '__main__':
+    main()
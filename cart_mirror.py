@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError, WatchError
+
+from api_elasticpath import add_proudct_to_cart, get_cart_products
+from api_elasticpath import remove_products_from_cart
+from database_backend import get_database_connection, is_database_configured
+
+logger = logging.getLogger(__name__)
+
+CART_MIRROR_TTL = 86400
+CART_RECONCILE_INTERVAL = 60
+CART_MIRROR_PREFIX = 'cart_mirror'
+CART_WRITE_ATTEMPTS = 3
+
+_cart_mirror = None
+
+
+class CartMirror(object):
+
+    def __init__(self, database=None, ttl=CART_MIRROR_TTL,
+                 reconcile_interval=CART_RECONCILE_INTERVAL,
+                 prefix=CART_MIRROR_PREFIX):
+        self.database = database
+        self.ttl = ttl
+        self.reconcile_interval = reconcile_interval
+        self.prefix = prefix
+        self._carts = {}
+        self._sequences = {}
+        self._reconciling = set()
+        self._guard = threading.Lock()
+
+    def get_cart_products(self, url, access_token, user_id):
+        cart = self._read(user_id)
+        if not cart:
+            return self.reconcile(url, access_token, user_id)
+        if time.time() - cart['synced_at'] > self.reconcile_interval:
+            self._reconcile_in_background(url, access_token, user_id)
+        return cart['products']
+
+    def add_product(self, url, product_id, quantity, access_token, user_id):
+        sequence = self._next_sequence(user_id)
+        products = add_proudct_to_cart(
+            url, product_id, quantity, access_token, user_id
+        )
+        self._write(user_id, products, sequence)
+        return products
+
+    def remove_product(self, url, cart_product_id, access_token, user_id):
+        sequence = self._next_sequence(user_id)
+        products = remove_products_from_cart(
+            url, cart_product_id, access_token, user_id
+        )
+        self._write(user_id, products, sequence)
+        return products
+
+    def reconcile(self, url, access_token, user_id):
+        # A cart fetched while a mutation was under way may predate it, so
+        # it is only mirrored if no mutation started in the meantime.
+        sequence = self._get_sequence(user_id)
+        products = get_cart_products(url, access_token, user_id)
+        self._write(user_id, products, sequence, reconciling=True)
+        return products
+
+    def forget(self, user_id):
+        self._carts.pop(user_id, None)
+        if not self.database:
+            return
+        try:
+            self.database.delete(self._get_key(user_id))
+        except RedisError as err:
+            logger.error(f'Could not drop cart mirror {user_id}: {err}')
+
+    def _get_key(self, user_id):
+        return f'{self.prefix}:{user_id}'
+
+    def _get_sequence_key(self, user_id):
+        return f'{self.prefix}:{user_id}:sequence'
+
+    def _get_sequence(self, user_id):
+        if not self.database:
+            with self._guard:
+                return self._sequences.get(user_id, 0)
+        try:
+            return int(self.database.get(self._get_sequence_key(user_id)) or 0)
+        except RedisError as err:
+            logger.error(f'Could not read cart sequence {user_id}: {err}')
+            return None
+
+    def _next_sequence(self, user_id):
+        if not self.database:
+            with self._guard:
+                sequence = self._sequences.get(user_id, 0) + 1
+                self._sequences[user_id] = sequence
+                return sequence
+        sequence_key = self._get_sequence_key(user_id)
+        try:
+            pipeline = self.database.pipeline()
+            pipeline.incr(sequence_key)
+            pipeline.expire(sequence_key, self.ttl)
+            return pipeline.execute()[0]
+        except RedisError as err:
+            logger.error(f'Could not advance cart sequence {user_id}: {err}')
+            return None
+
+    def _reconcile_in_background(self, url, access_token, user_id):
+        with self._guard:
+            if user_id in self._reconciling:
+                return
+            self._reconciling.add(user_id)
+        threading.Thread(
+            target=self._reconcile_quietly,
+            args=(url, access_token, user_id),
+            daemon=True
+        ).start()
+
+    def _reconcile_quietly(self, url, access_token, user_id):
+        try:
+            self.reconcile(url, access_token, user_id)
+        except Exception as err:
+            logger.error(f'Could not reconcile cart {user_id}: {err}')
+        finally:
+            with self._guard:
+                self._reconciling.discard(user_id)
+
+    def _read(self, user_id):
+        if not self.database:
+            cart = self._carts.get(user_id)
+            if cart and time.time() - cart['synced_at'] < self.ttl:
+                return cart
+            return None
+        try:
+            cart = self.database.get(self._get_key(user_id))
+        except RedisError as err:
+            logger.error(f'Could not read cart mirror {user_id}: {err}')
+            return None
+        if not cart:
+            return None
+        return json.loads(cart)
+
+    def _write(self, user_id, products, sequence, reconciling=False):
+        if sequence is None:
+            # Without a sequence the write cannot be ordered; the next
+            # read fetches the cart from Elasticpath instead.
+            self.forget(user_id)
+            return
+        cart = {
+            'products': products,
+            'synced_at': time.time(),
+            'sequence': sequence,
+        }
+        if not self.database:
+            with self._guard:
+                if is_newer(cart, self._carts.get(user_id),
+                            self._sequences.get(user_id, 0), reconciling):
+                    self._carts[user_id] = cart
+            return
+        key = self._get_key(user_id)
+        sequence_key = self._get_sequence_key(user_id)
+        for _ in range(CART_WRITE_ATTEMPTS):
+            try:
+                with self.database.pipeline() as pipeline:
+                    pipeline.watch(key, sequence_key)
+                    stored_cart = pipeline.get(key)
+                    current_sequence = int(pipeline.get(sequence_key) or 0)
+                    if not is_newer(
+                        cart,
+                        stored_cart and json.loads(stored_cart),
+                        current_sequence,
+                        reconciling,
+                    ):
+                        logger.debug(f'Skipping stale cart of {user_id}')
+                        return
+                    pipeline.multi()
+                    pipeline.set(key, json.dumps(cart), ex=self.ttl)
+                    pipeline.execute()
+                    return
+            except WatchError:
+                continue
+            except RedisError as err:
+                logger.error(f'Could not write cart mirror {user_id}: {err}')
+                return
+        logger.error(f'Gave up writing cart mirror {user_id}')
+        self.forget(user_id)
+
+
+def is_newer(cart, stored_cart, current_sequence, reconciling):
+    if reconciling and cart['sequence'] != current_sequence:
+        return False
+    if stored_cart and stored_cart.get('sequence', 0) > cart['sequence']:
+        return False
+    return True
+
+
+def get_cart_mirror():
+    global _cart_mirror
+    if _cart_mirror is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _cart_mirror = CartMirror(
+            database=database,
+            reconcile_interval=int(os.getenv(
+                'PIZZA_SHOP_CART_RECONCILE_INTERVAL', CART_RECONCILE_INTERVAL
+            )),
+        )
+    return _cart_mirror
+
+
+def get_mirrored_cart_products(url, access_token, user_id):
+    return get_cart_mirror().get_cart_products(url, access_token, user_id)
+
+
+def reconcile_mirrored_cart(url, access_token, user_id):
+    return get_cart_mirror().reconcile(url, access_token, user_id)
+
+
+def add_product_to_mirrored_cart(url, product_id, quantity, access_token,
+                                 user_id):
+    return get_cart_mirror().add_product(
+        url, product_id, quantity, access_token, user_id
+    )
+
+
+def remove_product_from_mirrored_cart(url, cart_product_id, access_token,
+                                      user_id):
+    return get_cart_mirror().remove_product(
+        url, cart_product_id, access_token, user_id
+    )
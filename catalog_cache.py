@@ -0,0 +1,252 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from api_elasticpath import fetch_all_pages, get_product_detail
+from database_backend import get_database_connection, is_database_configured
+from database_backend import start_listener
+
+logger = logging.getLogger(__name__)
+
+CATALOG_TTL = 600
+CATALOG_STALE_TTL = 86400
+CATALOG_CACHE_PREFIX = 'catalog_cache'
+CATALOG_CACHE_CHANNEL = 'catalog_cache_invalidations'
+
+_catalog_cache = None
+_catalog_cache_lock = threading.Lock()
+
+
+class CatalogCache(object):
+
+    def __init__(self, ttl=CATALOG_TTL, stale_ttl=CATALOG_STALE_TTL,
+                 database=None, prefix=CATALOG_CACHE_PREFIX,
+                 channel=CATALOG_CACHE_CHANNEL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.database = database
+        self.prefix = prefix
+        self.channel = channel
+        self._entries = {}
+        self._locks = {}
+        self._refreshing = set()
+        self._guard = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'errors': 0,
+        }
+
+    @property
+    def stats(self):
+        with self._guard:
+            return dict(self._stats)
+
+    def get(self, key, loader, ttl=None):
+        return self.get_entry(key, loader, ttl)['value']
+
+    def get_entry(self, key, loader, ttl=None):
+        entry = self._entries.get(key) or self._load_shared_entry(key)
+        if entry:
+            age = time.time() - entry['fetched_at']
+            if age < entry['ttl']:
+                self._count('hits')
+                return entry
+            if age < entry['ttl'] + self.stale_ttl:
+                self._count('stale_hits')
+                self._refresh_in_background(key, loader, ttl)
+                return entry
+        self._count('misses')
+        return self._load(key, loader, ttl)
+
+    def invalidate(self, key=None):
+        if key is not None:
+            self.invalidate_keys([key])
+            return
+        self._forget()
+        if not self.database:
+            return
+        try:
+            shared_keys = list(
+                self.database.scan_iter(match=f'{self.prefix}:*')
+            )
+            if shared_keys:
+                self.database.delete(*shared_keys)
+            # Other processes keep their own copies in memory.
+            self.database.publish(self.channel, '')
+        except RedisError as err:
+            logger.error(f'Could not invalidate shared catalog cache: {err}')
+
+    def invalidate_keys(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self._forget(key)
+        if not self.database or not keys:
+            return
+        try:
+            pipeline = self.database.pipeline(transaction=False)
+            pipeline.delete(*(self._get_shared_key(key) for key in keys))
+            for key in keys:
+                pipeline.publish(self.channel, key)
+            pipeline.execute()
+        except RedisError as err:
+            logger.error(f'Could not invalidate shared catalog cache: {err}')
+
+    def subscribe(self):
+        if not self.database:
+            return None
+        # Invalidations sent while we were not listening are lost.
+        return start_listener(
+            self.database,
+            self.channel,
+            self._handle_invalidation,
+            reset=self._forget,
+        )
+
+    def _forget(self, key=None):
+        with self._guard:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _count(self, counter):
+        with self._guard:
+            self._stats[counter] += 1
+
+    def _get_lock(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _get_shared_key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def _load(self, key, loader, ttl):
+        with self._get_lock(key):
+            entry = self._entries.get(key)
+            if entry and time.time() - entry['fetched_at'] < entry['ttl']:
+                return entry
+            return self._store(key, loader(), ttl)
+
+    def _refresh_in_background(self, key, loader, ttl):
+        with self._guard:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        threading.Thread(
+            target=self._refresh, args=(key, loader, ttl), daemon=True
+        ).start()
+
+    def _refresh(self, key, loader, ttl):
+        try:
+            self._store(key, loader(), ttl)
+            self._count('refreshes')
+        except Exception as err:
+            self._count('errors')
+            logger.error(f'Could not refresh catalog cache {key}: {err}')
+        finally:
+            with self._guard:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value, ttl):
+        entry = {
+            'value': value,
+            'fetched_at': time.time(),
+            'ttl': ttl or self.ttl,
+            'version': get_version(value),
+        }
+        self._entries[key] = entry
+        if not self.database:
+            return entry
+        try:
+            self.database.set(
+                self._get_shared_key(key),
+                json.dumps(entry),
+                ex=int(entry['ttl'] + self.stale_ttl),
+            )
+        except RedisError as err:
+            logger.error(f'Could not share catalog cache {key}: {err}')
+        return entry
+
+    def _load_shared_entry(self, key):
+        if not self.database:
+            return None
+        try:
+            stored_entry = self.database.get(self._get_shared_key(key))
+        except RedisError as err:
+            logger.error(f'Could not read shared catalog cache {key}: {err}')
+            return None
+        if not stored_entry:
+            return None
+        entry = json.loads(stored_entry)
+        if 'version' not in entry:
+            entry['version'] = get_version(entry['value'])
+        self._entries[key] = entry
+        return entry
+
+    def _handle_invalidation(self, key):
+        logger.debug(f'Catalog cache invalidated: {key or "everything"}')
+        self._forget(key or None)
+
+
+def get_version(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def get_catalog_cache():
+    global _catalog_cache
+    if _catalog_cache is not None:
+        return _catalog_cache
+    # A second cache would start a second invalidation listener.
+    with _catalog_cache_lock:
+        if _catalog_cache is not None:
+            return _catalog_cache
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        catalog_cache = CatalogCache(
+            ttl=int(os.getenv('PIZZA_SHOP_CATALOG_TTL', CATALOG_TTL)),
+            database=database,
+        )
+        catalog_cache.subscribe()
+        _catalog_cache = catalog_cache
+    return _catalog_cache
+
+
+def get_cached_catalog(url, access_token):
+    return get_catalog_cache().get(
+        f'catalog:{url}',
+        lambda: {'data': fetch_all_pages(url, access_token)}
+    )
+
+
+def get_versioned_catalog(url, access_token):
+    entry = get_catalog_cache().get_entry(
+        f'catalog:{url}',
+        lambda: {'data': fetch_all_pages(url, access_token)}
+    )
+    return entry['value'], entry['version']
+
+
+def get_cached_product_detail(url, product_id, access_token):
+    return get_catalog_cache().get(
+        f'product:{product_id}',
+        lambda: get_product_detail(url, product_id, access_token)
+    )
+
+
+def invalidate_cached_products(url, product_ids):
+    """Drop the product list at url and the details of product_ids."""
+    get_catalog_cache().invalidate_keys([
+        f'catalog:{url}',
+        *(f'product:{product_id}' for product_id in product_ids),
+    ])
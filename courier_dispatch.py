@@ -0,0 +1,353 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from pytils.numeral import get_plural
+from redis.exceptions import RedisError, WatchError
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown
+
+from database_backend import get_database_connection, is_database_configured
+from pizzeria_distances import to_unit_vectors
+from pizzeria_index import EARTH_RADIUS_M
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_WINDOW = 120
+DISPATCH_MAX_BATCH = 10
+TWO_OPT_MAX_PASSES = 50
+DISPATCH_PREFIX = 'courier_batch'
+MESSAGE_LIMIT = 4096
+SEND_ATTEMPTS = 3
+ROUTE_URL = 'https://yandex.ru/maps/?rtext={points}&rtt=auto'
+
+DeliveryOrder = namedtuple(
+    'DeliveryOrder',
+    ['chat_id', 'latitude', 'longitude', 'cart', 'created_at']
+)
+
+_courier_dispatcher = None
+
+
+def get_distance_matrix(points):
+    vectors = to_unit_vectors(
+        [latitude for latitude, _ in points],
+        [longitude for _, longitude in points]
+    )
+    squared_chords = np.clip(2 - 2 * np.matmul(vectors, vectors.T), 0, 4)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(squared_chords) / 2)
+
+
+def get_route_length(distances, route):
+    return sum(
+        distances[start][end] for start, end in zip(route, route[1:])
+    )
+
+
+def order_nearest_neighbour(distances):
+    route = [0]
+    unvisited = set(range(1, len(distances)))
+    while unvisited:
+        last = distances[route[-1]]
+        closest = min(unvisited, key=lambda stop: last[stop])
+        route.append(closest)
+        unvisited.remove(closest)
+    return route
+
+
+def improve_two_opt(distances, route, max_passes=TWO_OPT_MAX_PASSES):
+    # The courier starts at the pizzeria and does not have to come back,
+    # so the route is an open path with a fixed first point.
+    route = list(route)
+    last = len(route) - 1
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, last):
+            for j in range(i + 1, last + 1):
+                before, first = route[i - 1], route[i]
+                end = route[j]
+                delta = distances[before][end] - distances[before][first]
+                if j < last:
+                    after = route[j + 1]
+                    delta += distances[first][after] - distances[end][after]
+                if delta < -1e-6:
+                    route[i:j + 1] = reversed(route[i:j + 1])
+                    improved = True
+        if not improved:
+            break
+    return route
+
+
+def plan_route(origin, stops):
+    """Order stops for a courier leaving origin.
+
+    Returns the positions of stops in visiting order and the route
+    length in meters.
+    """
+    if not stops:
+        return [], 0
+    distances = get_distance_matrix([origin, *stops]).tolist()
+    route = improve_two_opt(distances, order_nearest_neighbour(distances))
+    return (
+        [stop - 1 for stop in route[1:]],
+        get_route_length(distances, route),
+    )
+
+
+class CourierDispatcher(object):
+    """Collects paid orders per courier and sends each batch as one route.
+
+    With a database the pending batches live in Redis, so a restart only
+    delays them: restore() reschedules their windows on startup.
+    """
+
+    def __init__(self, window=DISPATCH_WINDOW, max_batch=DISPATCH_MAX_BATCH,
+                 database=None, prefix=DISPATCH_PREFIX):
+        self.window = window
+        self.max_batch = max_batch
+        self.database = database
+        self.prefix = prefix
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    async def submit(self, job_queue, pizzeria, order):
+        delivery_tg_id = pizzeria.get('delivery-tg-id')
+        batch_size, started_at = await asyncio.to_thread(
+            self._append, delivery_tg_id, pizzeria, order
+        )
+        logger.debug(
+            f'Order {order.chat_id} waits for courier {delivery_tg_id}, '
+            f'{batch_size} in batch'
+        )
+        # The window job only claims the batch it was started for, so a
+        # batch that was already sent full leaves the next one alone.
+        if batch_size >= self.max_batch:
+            job_queue.run_once(
+                self._dispatch_job, 0, data=(delivery_tg_id, None)
+            )
+        elif batch_size == 1:
+            job_queue.run_once(
+                self._dispatch_job,
+                self.window,
+                data=(delivery_tg_id, started_at)
+            )
+
+    def restore(self, job_queue):
+        try:
+            pending = self._get_pending()
+        except RedisError as err:
+            logger.error(f'Could not restore courier batches: {err}')
+            return
+        for delivery_tg_id, batch in pending.items():
+            delay = max(0, batch['started_at'] + self.window - time.time())
+            logger.debug(
+                f'Restoring batch of courier {delivery_tg_id} in {delay:.0f} s'
+            )
+            job_queue.run_once(
+                self._dispatch_job,
+                delay,
+                data=(delivery_tg_id, batch['started_at'])
+            )
+
+    async def flush(self, bot):
+        try:
+            pending = await asyncio.to_thread(self._get_pending)
+        except RedisError as err:
+            logger.error(f'Could not flush courier batches: {err}')
+            return
+        for delivery_tg_id in pending:
+            claimed = await asyncio.to_thread(self._claim, delivery_tg_id)
+            if claimed:
+                await self.dispatch(bot, *claimed)
+
+    async def _dispatch_job(self, context):
+        delivery_tg_id, started_at = context.job.data
+        claimed = await asyncio.to_thread(
+            self._claim,
+            delivery_tg_id,
+            started_at=started_at,
+            min_size=self.max_batch if started_at is None else 0,
+        )
+        if claimed:
+            await self.dispatch(context.bot, *claimed)
+
+    async def dispatch(self, bot, pizzeria, orders):
+        origin = (
+            float(pizzeria.get('latitude')),
+            float(pizzeria.get('longitude')),
+        )
+        route, meters = plan_route(
+            origin, [(order.latitude, order.longitude) for order in orders]
+        )
+        orders = [orders[position] for position in route]
+        delivery_tg_id = pizzeria.get('delivery-tg-id')
+        logger.debug(
+            f'Dispatching {len(orders)} orders to '
+            f'{delivery_tg_id}, route {meters:.0f} m'
+        )
+        for message in self.format_route(origin, orders, meters):
+            await send_route_message(bot, delivery_tg_id, message)
+
+    @staticmethod
+    def format_route(origin, orders, meters):
+        """Return the route as MarkdownV2 messages within Telegram's limit."""
+        points = '~'.join(
+            f'{latitude},{longitude}' for latitude, longitude in [
+                origin,
+                *((order.latitude, order.longitude) for order in orders),
+            ]
+        )
+        orders_count = get_plural(len(orders), 'заказ, заказа, заказов')
+        blocks = [
+            escape_markdown(
+                f'Маршрут: {orders_count}, {meters / 1000:.1f} км',
+                version=2
+            ) + '\n'
+            f'[Открыть маршрут в картах]({ROUTE_URL.format(points=points)})',
+        ]
+        for number, order in enumerate(orders, start=1):
+            waiting = (time.time() - order.created_at) // 60
+            blocks.append(escape_markdown(
+                f'{number}. Заказ {order.chat_id}, ждёт {waiting:.0f} мин, '
+                f'{order.latitude:.6f}, {order.longitude:.6f}',
+                version=2
+            ) + '\n' + order.cart)
+        return pack_messages(blocks)
+
+    def _get_orders_key(self, delivery_tg_id):
+        return f'{self.prefix}:{delivery_tg_id}'
+
+    def _get_pending_key(self):
+        return f'{self.prefix}:pending'
+
+    def _append(self, delivery_tg_id, pizzeria, order):
+        started_at = time.time()
+        if not self.database:
+            with self._lock:
+                batch = self._batches.setdefault(delivery_tg_id, {
+                    'pizzeria': pizzeria,
+                    'started_at': started_at,
+                    'orders': [],
+                })
+                batch['orders'].append(order)
+                return len(batch['orders']), batch['started_at']
+        pipeline = self.database.pipeline()
+        pipeline.hsetnx(self._get_pending_key(), delivery_tg_id, json.dumps({
+            'pizzeria': dict(pizzeria),
+            'started_at': started_at,
+        }))
+        pipeline.rpush(
+            self._get_orders_key(delivery_tg_id), json.dumps(order)
+        )
+        pipeline.hget(self._get_pending_key(), delivery_tg_id)
+        _, batch_size, batch = pipeline.execute()
+        return batch_size, json.loads(batch)['started_at']
+
+    def _get_pending(self):
+        if not self.database:
+            with self._lock:
+                return dict(self._batches)
+        return {
+            delivery_tg_id.decode('utf-8'): json.loads(batch)
+            for delivery_tg_id, batch in self.database.hgetall(
+                self._get_pending_key()
+            ).items()
+        }
+
+    def _claim(self, delivery_tg_id, started_at=None, min_size=0):
+        if not self.database:
+            with self._lock:
+                batch = self._batches.get(delivery_tg_id)
+                if not is_claimable(batch, started_at, min_size):
+                    return None
+                del self._batches[delivery_tg_id]
+                return batch['pizzeria'], batch['orders']
+        orders_key = self._get_orders_key(delivery_tg_id)
+        pending_key = self._get_pending_key()
+        while True:
+            try:
+                with self.database.pipeline() as pipeline:
+                    pipeline.watch(orders_key, pending_key)
+                    batch = pipeline.hget(pending_key, delivery_tg_id)
+                    if not batch:
+                        return None
+                    batch = json.loads(batch)
+                    batch['orders'] = [
+                        DeliveryOrder(*json.loads(order))
+                        for order in pipeline.lrange(orders_key, 0, -1)
+                    ]
+                    if not is_claimable(batch, started_at, min_size):
+                        return None
+                    pipeline.multi()
+                    pipeline.delete(orders_key)
+                    pipeline.hdel(pending_key, delivery_tg_id)
+                    pipeline.execute()
+                    return batch['pizzeria'], batch['orders']
+            except WatchError:
+                continue
+
+
+def is_claimable(batch, started_at, min_size):
+    if not batch or len(batch['orders']) < max(min_size, 1):
+        return False
+    return started_at is None or batch['started_at'] == started_at
+
+
+def pack_messages(blocks, limit=MESSAGE_LIMIT):
+    messages = []
+    for block in blocks:
+        # A block over the limit on its own is cut between its lines.
+        parts = [block]
+        if len(block) > limit:
+            parts = pack_messages(block.split('\n'), limit)
+        for part in parts:
+            if messages and len(messages[-1]) + len(part) + 2 <= limit:
+                messages[-1] += '\n\n' + part
+            else:
+                messages.append(part[:limit])
+    return messages
+
+
+async def send_route_message(bot, chat_id, text):
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            return await bot.send_message(
+                chat_id,
+                text,
+                parse_mode=ParseMode.MARKDOWN_V2,
+                disable_web_page_preview=True,
+            )
+        except BadRequest as err:
+            logger.error(f'Telegram rejected route part for {chat_id}: {err}')
+            break
+        except RetryAfter as err:
+            await asyncio.sleep(err.retry_after)
+        except NetworkError as err:
+            logger.error(f'Could not send route part to {chat_id}: {err}')
+            await asyncio.sleep(attempt)
+    logger.error(f'Dropped route part for courier {chat_id}: {text}')
+    return None
+
+
+def get_courier_dispatcher():
+    global _courier_dispatcher
+    if _courier_dispatcher is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _courier_dispatcher = CourierDispatcher(
+            window=int(os.getenv(
+                'PIZZA_SHOP_DISPATCH_WINDOW', DISPATCH_WINDOW
+            )),
+            max_batch=int(os.getenv(
+                'PIZZA_SHOP_DISPATCH_MAX_BATCH', DISPATCH_MAX_BATCH
+            )),
+            database=database,
+        )
+    return _courier_dispatcher
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from redis.exceptions import RedisError
+
+from api_elasticpath import create_customer_address, get_token
+from database_backend import get_database_connection, is_database_configured
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_ADDRESS_TTL = 30 * 86400
+CUSTOMER_ADDRESS_PRECISION = 4
+CUSTOMER_ADDRESS_PREFIX = 'customer_address'
+CUSTOMER_ADDRESS_WORKERS = 2
+
+_customer_address_store = None
+
+
+class CustomerAddressStore(object):
+
+    def __init__(self, writer, database=None, ttl=CUSTOMER_ADDRESS_TTL,
+                 precision=CUSTOMER_ADDRESS_PRECISION,
+                 prefix=CUSTOMER_ADDRESS_PREFIX,
+                 max_workers=CUSTOMER_ADDRESS_WORKERS):
+        self.writer = writer
+        self.database = database
+        self.ttl = ttl
+        self.precision = precision
+        self.prefix = prefix
+        self._addresses = {}
+        self._writing = set()
+        self._guard = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='customer-address'
+        )
+
+    def remember(self, user_id, location):
+        key = self._get_key(user_id, location)
+        address = self._read(key)
+        if address:
+            logger.debug(f'Reusing customer address {address}')
+        else:
+            address = {
+                'latitude': float(location.latitude),
+                'longitude': float(location.longitude),
+                'entry_id': None,
+            }
+            self._write(key, address)
+        if not address['entry_id']:
+            self._create_in_background(key, location)
+        return address
+
+    def _get_key(self, user_id, location):
+        # Rounded to about 11 m, so the same spot sent twice maps to the
+        # same flow entry.
+        latitude = round(float(location.latitude), self.precision)
+        longitude = round(float(location.longitude), self.precision)
+        return f'{self.prefix}:{user_id}:{latitude}:{longitude}'
+
+    def _create_in_background(self, key, location):
+        with self._guard:
+            if key in self._writing:
+                return
+            self._writing.add(key)
+        self._executor.submit(self._create_quietly, key, location)
+
+    def _create_quietly(self, key, location):
+        try:
+            entry_id = self.writer(location)
+            address = self._read(key) or {
+                'latitude': float(location.latitude),
+                'longitude': float(location.longitude),
+            }
+            address['entry_id'] = entry_id
+            self._write(key, address)
+            logger.debug(f'Created customer address {entry_id}')
+        except Exception as err:
+            logger.error(f'Could not create customer address {key}: {err}')
+        finally:
+            with self._guard:
+                self._writing.discard(key)
+
+    def _read(self, key):
+        if not self.database:
+            address = self._addresses.get(key)
+            return dict(address) if address else None
+        try:
+            address = self.database.get(key)
+        except RedisError as err:
+            logger.error(f'Could not read customer address {key}: {err}')
+            return None
+        if not address:
+            return None
+        return json.loads(address)
+
+    def _write(self, key, address):
+        if not self.database:
+            self._addresses[key] = dict(address)
+            return
+        try:
+            self.database.set(key, json.dumps(address), ex=self.ttl)
+        except RedisError as err:
+            logger.error(f'Could not write customer address {key}: {err}')
+
+
+def create_remote_customer_address(location):
+    access_token = get_token(
+        'https://api.moltin.com/oauth/access_token',
+        os.getenv('PIZZA_SHOP_CLIENT_ID'),
+        client_secret=os.getenv('PIZZA_SHOP_CLIENT_SECRET', None)
+    )
+    return create_customer_address(
+        'https://api.moltin.com/v2/flows/customer-address/entries',
+        access_token,
+        location
+    )
+
+
+def get_customer_address_store():
+    global _customer_address_store
+    if _customer_address_store is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _customer_address_store = CustomerAddressStore(
+            create_remote_customer_address, database=database
+        )
+    return _customer_address_store
+
+
+def remember_customer_address(user_id, location):
+    return get_customer_address_store().remember(user_id, location)
@@ -1,12 +1,35 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 import redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+DATABASE_POOL_SIZE = 20
+DATABASE_POOL_TIMEOUT = 5
+STATE_CACHE_SIZE = 0
+STATE_CACHE_TTL = 300
+STATE_INVALIDATION_CHANNEL = 'state_invalidations'
+SUBSCRIPTION_RETRY_DELAY = 5
+
+_database = None
+_connection_pools = {}
+_state_stores = {}
+_pools_lock = threading.Lock()
+_state_stores_lock = threading.Lock()
 
 
 class Database(object):
 
     def __init__(self, database_host, database_port, database_password):
-        self.db = redis.Redis(
-            host=database_host, port=database_port, password=database_password
-        )
+        self.db = redis.Redis(connection_pool=get_connection_pool(
+            database_host, database_port, database_password
+        ))
 
     def set_(self, field, value):
         self.db.set(field, value)
@@ -14,3 +37,187 @@ class Database(object):
     def get(self, field):
         value = self.db.get(field)
         return value
+
+
+class StateStore(object):
+    """Conversation states of one bot, one Redis key per chat.
+
+    With cache_size set, states are also kept in process and every write
+    publishes the key, so other processes drop their cached copy.
+    """
+
+    def __init__(self, database, prefix='', cache_size=STATE_CACHE_SIZE,
+                 cache_ttl=STATE_CACHE_TTL,
+                 channel=STATE_INVALIDATION_CHANNEL):
+        self.database = database
+        self.prefix = prefix
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.channel = channel
+        self.instance_id = uuid.uuid4().hex
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_state(self, chat_id):
+        key = self._get_key(chat_id)
+        found, state = self._get_cached(key)
+        if found:
+            return state
+        state = self.database.get(key)
+        if state is not None:
+            state = state.decode('utf-8')
+        self._remember(key, state)
+        return state
+
+    def set_state(self, chat_id, state, pipeline=None):
+        key = self._get_key(chat_id)
+        execute = pipeline is None
+        if execute:
+            pipeline = self.database.pipeline(transaction=False)
+        pipeline.set(key, state)
+        if self.cache_size:
+            pipeline.publish(self.channel, f'{self.instance_id} {key}')
+        if execute:
+            pipeline.execute()
+        self._remember(key, state)
+
+    def pipeline(self):
+        return self.database.pipeline(transaction=False)
+
+    def subscribe(self):
+        if not self.cache_size:
+            return None
+        # Anything written while we were not listening may be stale now.
+        return start_listener(
+            self.database,
+            self.channel,
+            self._handle_invalidation,
+            reset=self._forget,
+        )
+
+    def _get_key(self, chat_id):
+        return f'{self.prefix}{chat_id}'
+
+    def _get_cached(self, key):
+        if not self.cache_size:
+            return False, None
+        with self._lock:
+            entry = self._states.get(key)
+            if not entry:
+                return False, None
+            state, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._states[key]
+                return False, None
+            self._states.move_to_end(key)
+            return True, state
+
+    def _remember(self, key, state):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._states[key] = (state, time.monotonic() + self.cache_ttl)
+            self._states.move_to_end(key)
+            while len(self._states) > self.cache_size:
+                self._states.popitem(last=False)
+
+    def _forget(self, key=None):
+        with self._lock:
+            if key is None:
+                self._states.clear()
+            else:
+                self._states.pop(key, None)
+
+    def _handle_invalidation(self, data):
+        instance_id, key = data.split(' ', 1)
+        if instance_id != self.instance_id:
+            self._forget(key)
+
+
+def is_database_configured():
+    return bool(os.getenv('PIZZA_SHOP_DATABASE_HOST'))
+
+
+def get_connection_pool(host=None, port=None, password=None):
+    pool_key = (
+        host or os.getenv('PIZZA_SHOP_DATABASE_HOST'),
+        port or os.getenv('PIZZA_SHOP_DATABASE_PORT') or 6379,
+        password or os.getenv('PIZZA_SHOP_DATABASE_PASSWORD'),
+    )
+    with _pools_lock:
+        if pool_key not in _connection_pools:
+            host, port, password = pool_key
+            _connection_pools[pool_key] = redis.BlockingConnectionPool(
+                host=host,
+                port=port,
+                password=password,
+                max_connections=int(os.getenv(
+                    'PIZZA_SHOP_DATABASE_POOL_SIZE', DATABASE_POOL_SIZE
+                )),
+                timeout=DATABASE_POOL_TIMEOUT,
+            )
+        return _connection_pools[pool_key]
+
+
+def get_database_connection():
+    global _database
+    if _database is None:
+        _database = redis.Redis(connection_pool=get_connection_pool())
+    return _database
+
+
+def get_state_store(prefix=''):
+    state_store = _state_stores.get(prefix)
+    if state_store is not None:
+        return state_store
+    # A second store would start a second invalidation listener.
+    with _state_stores_lock:
+        state_store = _state_stores.get(prefix)
+        if state_store is not None:
+            return state_store
+        state_store = StateStore(
+            get_database_connection(),
+            prefix=prefix,
+            cache_size=int(os.getenv(
+                'PIZZA_SHOP_STATE_CACHE_SIZE', STATE_CACHE_SIZE
+            )),
+            cache_ttl=int(os.getenv(
+                'PIZZA_SHOP_STATE_CACHE_TTL', STATE_CACHE_TTL
+            )),
+        )
+        if state_store.subscribe():
+            logger.debug(f'Caching conversation states of {prefix!r}')
+        _state_stores[prefix] = state_store
+    return state_store
+
+
+def start_listener(database, channel, on_message, reset=None):
+    """Call on_message with every message on channel in a daemon thread.
+
+    The thread subscribes again after Redis errors. Messages published
+    meanwhile are lost, so reset, if given, runs after every failure and
+    every subscription.
+    """
+    thread = threading.Thread(
+        target=listen,
+        args=(database, channel, on_message, reset),
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+def listen(database, channel, on_message, reset=None):
+    while True:
+        try:
+            pubsub = database.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(channel)
+            if reset:
+                reset()
+            for message in pubsub.listen():
+                on_message(message['data'].decode('utf-8'))
+        except RedisError as err:
+            logger.error(f'Subscription to {channel} failed: {err}')
+            if reset:
+                reset()
+            time.sleep(SUBSCRIPTION_RETRY_DELAY)
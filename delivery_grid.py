@@ -0,0 +1,200 @@
+import json
+import logging
+import math
+import os
+
+import numpy as np
+
+from pizzeria_distances import DELIVERY_TIER_BOUNDARIES, MATRIX_CELLS
+from pizzeria_index import EARTH_RADIUS_M, SPHERE_ERROR
+
+logger = logging.getLogger(__name__)
+
+# Cells have the size of geohash precision 7: 17 latitude bits and
+# 18 longitude bits, about 153 x 153 m in the tropics and 153 x 86 m
+# in Moscow.
+LATITUDE_BITS = 17
+LONGITUDE_BITS = 18
+CELL_LATITUDE = 180 / 2 ** LATITUDE_BITS
+CELL_LONGITUDE = 360 / 2 ** LONGITUDE_BITS
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+AMBIGUOUS_CELL = -1
+TIER_BITS = 4
+BUILD_BATCH = 16
+
+
+def get_cell_keys(latitudes, longitudes):
+    rows = np.floor(
+        (np.asarray(latitudes, dtype=np.float64) + 90) / CELL_LATITUDE
+    ).astype(np.int64)
+    columns = np.floor(
+        (np.asarray(longitudes, dtype=np.float64) + 180) / CELL_LONGITUDE
+    ).astype(np.int64)
+    return (rows << LONGITUDE_BITS) | columns
+
+
+def get_unique_keys(keys):
+    keys = np.sort(keys)
+    if not len(keys):
+        return keys
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+
+def get_cell_centers(keys):
+    rows = keys >> LONGITUDE_BITS
+    columns = keys & (2 ** LONGITUDE_BITS - 1)
+    return (
+        (rows + 0.5) * CELL_LATITUDE - 90,
+        (columns + 0.5) * CELL_LONGITUDE - 180,
+    )
+
+
+class DeliveryGrid(object):
+
+    def __init__(self, keys, cells, version,
+                 boundaries=DELIVERY_TIER_BOUNDARIES):
+        self.keys = keys
+        self.cells = cells
+        self.version = version
+        self.boundaries = tuple(boundaries)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, engine, version, boundaries=DELIVERY_TIER_BOUNDARIES):
+        boundaries = np.asarray(sorted(boundaries), dtype=np.float64)
+        keys = cls._get_service_area(engine, boundaries[-1])
+        cells = np.empty(len(keys), dtype=np.int32)
+        chunk_size = max(1, MATRIX_CELLS // max(len(engine), 1))
+        for start in range(0, len(keys), chunk_size):
+            end = start + chunk_size
+            latitudes, longitudes = get_cell_centers(keys[start:end])
+            distances = engine.haversine(latitudes, longitudes)
+            if distances.shape[1] > 1:
+                closest = np.partition(distances, 1, axis=1)
+                nearest_meters, runner_up = closest[:, 0], closest[:, 1]
+            else:
+                nearest_meters = distances[:, 0]
+                runner_up = np.full(len(nearest_meters), np.inf)
+            positions = np.argmin(distances, axis=1)
+            tiers = np.searchsorted(boundaries, nearest_meters, side='right')
+            # Any point of the cell is within the half diagonal of its
+            # center, and the sphere may be off by SPHERE_ERROR.
+            half_diagonal = 0.5 * METERS_PER_DEGREE * np.hypot(
+                CELL_LATITUDE,
+                CELL_LONGITUDE * np.cos(np.radians(latitudes))
+            )
+            margin = half_diagonal + nearest_meters * SPHERE_ERROR
+            ambiguous = (
+                (runner_up - nearest_meters <= 2 * margin)
+                | np.any(
+                    np.abs(nearest_meters[:, np.newaxis] - boundaries)
+                    <= margin[:, np.newaxis],
+                    axis=1
+                )
+            )
+            chunk_cells = (positions << TIER_BITS | tiers).astype(np.int32)
+            chunk_cells[ambiguous] = AMBIGUOUS_CELL
+            cells[start:end] = chunk_cells
+        logger.debug(
+            f'Built delivery grid of {len(keys)} cells, '
+            f'{np.count_nonzero(cells == AMBIGUOUS_CELL)} ambiguous'
+        )
+        return cls(keys, cells, version, boundaries)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'grid.json')) as grid_file:
+            meta = json.load(grid_file)
+        mmap_mode = 'r' if mmap else None
+        return cls(
+            np.load(os.path.join(path, 'keys.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'cells.npy'), mmap_mode=mmap_mode),
+            meta['version'],
+            meta['boundaries'],
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'keys.npy'), self.keys)
+        np.save(os.path.join(path, 'cells.npy'), self.cells)
+        with open(os.path.join(path, 'grid.json'), 'w') as grid_file:
+            json.dump(
+                {
+                    'version': self.version,
+                    'boundaries': list(self.boundaries),
+                },
+                grid_file
+            )
+
+    def lookup(self, latitude, longitude):
+        key = (
+            int((latitude + 90) // CELL_LATITUDE) << LONGITUDE_BITS
+            | int((longitude + 180) // CELL_LONGITUDE)
+        )
+        slot = int(np.searchsorted(self.keys, key))
+        if slot == len(self.keys) or self.keys[slot] != key:
+            return None
+        cell = int(self.cells[slot])
+        if cell == AMBIGUOUS_CELL:
+            return None
+        return cell >> TIER_BITS, cell & (2 ** TIER_BITS - 1)
+
+    def lookup_many(self, latitudes, longitudes):
+        keys = get_cell_keys(latitudes, longitudes)
+        if not len(self.keys):
+            unknown = np.full(len(keys), AMBIGUOUS_CELL)
+            return unknown, unknown
+        slots = np.searchsorted(self.keys, keys)
+        slots = np.minimum(slots, len(self.keys) - 1)
+        found = self.keys[slots] == keys
+        cells = np.where(found, self.cells[slots], AMBIGUOUS_CELL)
+        # Cells outside the service area are farther than the last
+        # boundary from every pizzeria, but which one is the nearest is
+        # still unknown, so they fall back like ambiguous cells do.
+        unknown = cells == AMBIGUOUS_CELL
+        positions = np.where(unknown, AMBIGUOUS_CELL, cells >> TIER_BITS)
+        tiers = np.where(unknown, AMBIGUOUS_CELL, cells & (2 ** TIER_BITS - 1))
+        return positions, tiers
+
+    @staticmethod
+    def _get_service_area(engine, radius):
+        latitude_span = radius / METERS_PER_DEGREE + CELL_LATITUDE
+        batches = []
+        for start in range(0, len(engine), BUILD_BATCH):
+            batch_keys = []
+            for latitude, longitude in zip(
+                engine.latitudes[start:start + BUILD_BATCH],
+                engine.longitudes[start:start + BUILD_BATCH]
+            ):
+                longitude_span = latitude_span / max(
+                    math.cos(math.radians(
+                        min(abs(latitude) + latitude_span, 89.9)
+                    )),
+                    1e-6
+                )
+                first_row, first_column = divmod(
+                    int(get_cell_keys(
+                        latitude - latitude_span, longitude - longitude_span
+                    )),
+                    2 ** LONGITUDE_BITS
+                )
+                last_row, last_column = divmod(
+                    int(get_cell_keys(
+                        latitude + latitude_span, longitude + longitude_span
+                    )),
+                    2 ** LONGITUDE_BITS
+                )
+                rows = np.arange(first_row, last_row + 1, dtype=np.int64)
+                columns = np.arange(
+                    first_column, last_column + 1, dtype=np.int64
+                )
+                batch_keys.append((
+                    (rows[:, np.newaxis] << LONGITUDE_BITS)
+                    | columns[np.newaxis, :]
+                ).ravel())
+            batches.append(get_unique_keys(np.concatenate(batch_keys)))
+        if not batches:
+            return np.empty(0, dtype=np.int64)
+        return get_unique_keys(np.concatenate(batches))
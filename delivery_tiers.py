@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+from bisect import bisect_right
+from collections import namedtuple
+from textwrap import dedent
+
+import numpy as np
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DELIVERY_TIERS = (
+    {
+        'name': 'less_than_500_m',
+        'up_to': 500,
+        'price': 0,
+        'delivery': True,
+        'message': (
+            'Mожет, заберете пиццу из нашей пиццерии неподалёку? Она всего в '
+            '{meters:.2f} метрах от вас! вот её адрес: {address} \n\n'
+            'А можем и бесплатно доставить, нам не сложно.'
+        ),
+    },
+    {
+        'name': 'less_than_5_km',
+        'up_to': 5000,
+        'price': 100,
+        'delivery': True,
+        'message': (
+            '''
+            Похоже, придется ехать до вас на самокате.
+            Доставка будет стоить 100 рублей. Доставляем или самовывоз?'
+            '''
+        ),
+    },
+    {
+        'name': 'less_than_20_km',
+        'up_to': 20000,
+        'price': 300,
+        'delivery': True,
+        'message': 'Доставка будет стоить 300 рублей.',
+    },
+    {
+        'name': 'more_than_20_km',
+        'up_to': None,
+        'price': 0,
+        'delivery': False,
+        'message': (
+            'Простите, но так далеко мы пиццу не доставим.\n'
+            'Ближайшая пиццерия аж в {kilometers:.2f} километрах от вас!'
+        ),
+    },
+)
+
+DeliveryQuote = namedtuple(
+    'DeliveryQuote', ['tier', 'message', 'markup', 'price']
+)
+
+_delivery_tiers = None
+
+
+class DeliveryTier(namedtuple(
+    'DeliveryTier',
+    ['name', 'up_to', 'price', 'delivery', 'template', 'markup']
+)):
+    __slots__ = ()
+
+    @classmethod
+    def from_config(cls, config):
+        buttons = []
+        if config.get('delivery', True):
+            buttons.append(
+                [InlineKeyboardButton('Доставка', callback_data='delivery')]
+            )
+        buttons.append(
+            [InlineKeyboardButton('Самовывоз', callback_data='pickup')]
+        )
+        return cls(
+            name=config['name'],
+            up_to=config.get('up_to'),
+            price=config.get('price', 0),
+            delivery=config.get('delivery', True),
+            template=dedent(config['message']),
+            markup=InlineKeyboardMarkup(buttons),
+        )
+
+    def get_message(self, meters, address=None):
+        if '{' not in self.template:
+            return self.template
+        return self.template.format(
+            meters=meters, kilometers=meters / 1000, address=address
+        )
+
+
+class DeliveryTierTable(object):
+
+    def __init__(self, tiers):
+        tiers = sorted(
+            tiers,
+            key=lambda tier: float('inf') if tier.get('up_to') is None
+            else tier['up_to']
+        )
+        if not tiers or tiers[-1].get('up_to') is not None:
+            raise ValueError('The last delivery tier must have no up_to')
+        self.tiers = tuple(DeliveryTier.from_config(tier) for tier in tiers)
+        self.thresholds = tuple(tier.up_to for tier in self.tiers[:-1])
+        self._thresholds = np.asarray(self.thresholds, dtype=np.float64)
+
+    def select(self, meters):
+        return self.tiers[bisect_right(self.thresholds, meters)]
+
+    def select_many(self, meters):
+        return np.searchsorted(self._thresholds, meters, side='right')
+
+
+class DeliveryTiers(object):
+
+    def __init__(self, tiers=DEFAULT_DELIVERY_TIERS, pizzerias=None):
+        self.default = DeliveryTierTable(tiers)
+        self.overrides = {}
+        tier_configs = {tier['name']: tier for tier in tiers}
+        for pizzeria_key, overrides in (pizzerias or {}).items():
+            self.overrides[pizzeria_key] = DeliveryTierTable([
+                dict(tier_config, **overrides.get(name, {}))
+                for name, tier_config in tier_configs.items()
+            ])
+        self.boundaries = tuple(sorted({
+            threshold
+            for table in (self.default, *self.overrides.values())
+            for threshold in table.thresholds
+        }))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as config_file:
+            config = json.load(config_file)
+        return cls(
+            config.get('tiers', DEFAULT_DELIVERY_TIERS),
+            config.get('pizzerias'),
+        )
+
+    def get_table(self, pizzeria):
+        if self.overrides and pizzeria is not None:
+            for key in (pizzeria.get('id'), pizzeria.get('alias')):
+                if key in self.overrides:
+                    return self.overrides[key]
+        return self.default
+
+    def quote(self, closest_pizzeria):
+        pizzeria = closest_pizzeria.get('pizzeria')
+        meters = closest_pizzeria.get('distance').m
+        tier = self.get_table(pizzeria).select(meters)
+        return self._get_quote(tier, pizzeria, meters)
+
+    def quote_many(self, closest_pizzerias):
+        closest_pizzerias = list(closest_pizzerias)
+        tables = {}
+        for row, closest_pizzeria in enumerate(closest_pizzerias):
+            table = self.get_table(closest_pizzeria.get('pizzeria'))
+            tables.setdefault(id(table), (table, []))[1].append(row)
+        quotes = [None] * len(closest_pizzerias)
+        for table, rows in tables.values():
+            meters = np.fromiter(
+                (closest_pizzerias[row].get('distance').m for row in rows),
+                dtype=np.float64,
+                count=len(rows)
+            )
+            for row, row_meters, position in zip(
+                rows, meters, table.select_many(meters)
+            ):
+                quotes[row] = self._get_quote(
+                    table.tiers[position],
+                    closest_pizzerias[row].get('pizzeria'),
+                    float(row_meters)
+                )
+        return quotes
+
+    def _get_quote(self, tier, pizzeria, meters):
+        address = pizzeria.get('address') if pizzeria is not None else None
+        return DeliveryQuote(
+            tier=tier,
+            message=tier.get_message(meters, address),
+            markup=tier.markup,
+            price=tier.price,
+        )
+
+
+def get_delivery_tiers():
+    global _delivery_tiers
+    if _delivery_tiers is None:
+        path = os.getenv('PIZZA_SHOP_DELIVERY_TIERS')
+        if path:
+            logger.debug(f'Loading delivery tiers from {path}')
+            _delivery_tiers = DeliveryTiers.load(path)
+        else:
+            _delivery_tiers = DeliveryTiers()
+    return _delivery_tiers
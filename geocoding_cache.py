@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from api_yandex import Address, fetch_coordinates
+from database_backend import get_database_connection, is_database_configured
+
+logger = logging.getLogger(__name__)
+
+GEOCODING_CACHE_SIZE = 4096
+GEOCODING_TTL = 30 * 86400
+GEOCODING_NEGATIVE_TTL = 86400
+GEOCODING_CACHE_PREFIX = 'geocode'
+
+ADDRESS_ABBREVIATIONS = {
+    'ул': 'улица',
+    'пр-т': 'проспект',
+    'пр-кт': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'наб': 'набережная',
+    'ш': 'шоссе',
+    'пл': 'площадь',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'мкр': 'микрорайон',
+    'г': 'город',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'обл': 'область',
+    'р-н': 'район',
+}
+ADDRESS_SEPARATORS = re.compile(r'[\s.,;:"«»()]+')
+
+_geocoding_cache = None
+
+
+def normalize_address(address):
+    words = ADDRESS_SEPARATORS.split(address.lower().replace('ё', 'е'))
+    return ' '.join(
+        ADDRESS_ABBREVIATIONS.get(word, word) for word in words if word
+    )
+
+
+class GeocodingCache(object):
+
+    def __init__(self, fetcher, database=None, max_size=GEOCODING_CACHE_SIZE,
+                 ttl=GEOCODING_TTL, negative_ttl=GEOCODING_NEGATIVE_TTL,
+                 prefix=GEOCODING_CACHE_PREFIX):
+        self.fetcher = fetcher
+        self.database = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+        self._addresses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, address):
+        key = normalize_address(address)
+        if not key:
+            return None
+        found, location = self._get_local(key)
+        if found:
+            return location
+        found, location = self._get_shared(key)
+        if not found:
+            logger.debug(f'Geocoding {key}')
+            location = self.fetcher(address)
+            if location:
+                location = Address(
+                    latitude=float(location.latitude),
+                    longitude=float(location.longitude),
+                )
+            self._put_shared(key, location)
+        self._put_local(key, location)
+        return location
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._addresses.get(key)
+            if not entry:
+                return False, None
+            location, expires_at = entry
+            if expires_at < time.time():
+                del self._addresses[key]
+                return False, None
+            self._addresses.move_to_end(key)
+            return True, location
+
+    def _put_local(self, key, location):
+        ttl = self.ttl if location else self.negative_ttl
+        with self._lock:
+            self._addresses[key] = (location, time.time() + ttl)
+            self._addresses.move_to_end(key)
+            while len(self._addresses) > self.max_size:
+                self._addresses.popitem(last=False)
+
+    def _get_shared(self, key):
+        if not self.database:
+            return False, None
+        try:
+            stored_location = self.database.get(f'{self.prefix}:{key}')
+        except RedisError as err:
+            logger.error(f'Could not read geocoding cache: {err}')
+            return False, None
+        if not stored_location:
+            return False, None
+        stored_location = json.loads(stored_location)
+        if not stored_location:
+            return True, None
+        return True, Address(**stored_location)
+
+    def _put_shared(self, key, location):
+        if not self.database:
+            return
+        stored_location = None
+        if location:
+            stored_location = {
+                'latitude': location.latitude,
+                'longitude': location.longitude,
+            }
+        try:
+            self.database.set(
+                f'{self.prefix}:{key}',
+                json.dumps(stored_location),
+                ex=self.ttl if location else self.negative_ttl,
+            )
+        except RedisError as err:
+            logger.error(f'Could not write geocoding cache: {err}')
+
+
+def get_geocoding_cache(apikey):
+    global _geocoding_cache
+    if _geocoding_cache is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _geocoding_cache = GeocodingCache(
+            lambda address: fetch_coordinates(apikey, address),
+            database=database,
+            max_size=int(os.getenv(
+                'PIZZA_SHOP_GEOCODING_CACHE_SIZE', GEOCODING_CACHE_SIZE
+            )),
+        )
+    return _geocoding_cache
+
+
+def fetch_cached_coordinates(apikey, address):
+    return get_geocoding_cache(apikey).lookup(address)
@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from redis.exceptions import RedisError
+
+from api_elasticpath import get_product_picture_url
+from database_backend import get_database_connection, is_database_configured
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_SIZE = 1024
+IMAGE_CACHE_HASH = 'elasticpath_file_urls'
+IMAGE_RESOLVE_WORKERS = 8
+
+_image_resolver = None
+
+
+class ImageUrlResolver(object):
+
+    def __init__(self, database=None, max_size=IMAGE_CACHE_SIZE,
+                 hash_name=IMAGE_CACHE_HASH,
+                 max_workers=IMAGE_RESOLVE_WORKERS):
+        self.database = database
+        self.max_size = max_size
+        self.hash_name = hash_name
+        self.max_workers = max_workers
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, url, file_id, access_token):
+        return self.resolve_many(url, [file_id], access_token)[file_id]
+
+    def resolve_many(self, url, file_ids, access_token):
+        file_ids = list(dict.fromkeys(file_ids))
+        resolved = self._get_local(file_ids)
+        missing = [file_id for file_id in file_ids if file_id not in resolved]
+        if missing:
+            shared = self._get_shared(missing)
+            self._put_local(shared)
+            resolved.update(shared)
+            missing = [
+                file_id for file_id in missing if file_id not in shared
+            ]
+        if missing:
+            logger.debug(f'Resolving picture urls for {missing}')
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(missing))
+            ) as executor:
+                hrefs = executor.map(
+                    lambda file_id: get_product_picture_url(
+                        url, file_id, access_token
+                    ),
+                    missing
+                )
+                fetched = dict(zip(missing, hrefs))
+            self._put_local(fetched)
+            self._put_shared(fetched)
+            resolved.update(fetched)
+        return resolved
+
+    def remember(self, hrefs):
+        self._put_local(hrefs)
+        self._put_shared(hrefs)
+
+    def warm(self, url, file_ids, access_token):
+        resolved = self.resolve_many(url, file_ids, access_token)
+        logger.debug(f'Warmed {len(resolved)} picture urls')
+        return resolved
+
+    def _get_local(self, file_ids):
+        resolved = {}
+        with self._lock:
+            for file_id in file_ids:
+                href = self._urls.get(file_id)
+                if href:
+                    self._urls.move_to_end(file_id)
+                    resolved[file_id] = href
+        return resolved
+
+    def _put_local(self, hrefs):
+        with self._lock:
+            for file_id, href in hrefs.items():
+                self._urls[file_id] = href
+                self._urls.move_to_end(file_id)
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+
+    def _get_shared(self, file_ids):
+        if not self.database:
+            return {}
+        try:
+            hrefs = self.database.hmget(self.hash_name, file_ids)
+        except RedisError as err:
+            logger.error(f'Could not read shared picture urls: {err}')
+            return {}
+        return {
+            file_id: href.decode('utf-8')
+            for file_id, href in zip(file_ids, hrefs) if href
+        }
+
+    def _put_shared(self, hrefs):
+        if not self.database or not hrefs:
+            return
+        try:
+            self.database.hset(self.hash_name, mapping=hrefs)
+        except RedisError as err:
+            logger.error(f'Could not share picture urls: {err}')
+
+
+def get_image_resolver():
+    global _image_resolver
+    if _image_resolver is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _image_resolver = ImageUrlResolver(
+            database=database,
+            max_size=int(
+                os.getenv('PIZZA_SHOP_IMAGE_CACHE_SIZE', IMAGE_CACHE_SIZE)
+            ),
+        )
+    return _image_resolver
+
+
+def get_cached_picture_url(url, picture_id, access_token):
+    return get_image_resolver().resolve(url, picture_id, access_token)
+
+
+def get_cached_picture_urls(url, picture_ids, access_token):
+    return get_image_resolver().resolve_many(url, picture_ids, access_token)
+
+
+def get_main_image_id(product):
+    relationships = product.get('relationships') or {}
+    main_image = (relationships.get('main_image') or {}).get('data')
+    if main_image:
+        return main_image.get('id')
+    return None
+
+
+def get_main_image_ids(products):
+    image_ids = []
+    for product in products:
+        image_id = get_main_image_id(product)
+        if image_id:
+            image_ids.append(image_id)
+    return image_ids
+
+
+def warm_image_cache(url, picture_ids, access_token):
+    try:
+        get_image_resolver().warm(url, picture_ids, access_token)
+    except Exception as err:
+        logger.error(f'Could not warm picture urls: {err}')
@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+MENU_PAGE_SIZE = 8
+MENU_PAGE_PREFIX = 'menu_page '
+
+_menu_keyboards = None
+
+
+class MenuKeyboards(object):
+    """Menu keyboard pages, rebuilt only when the catalog version changes."""
+
+    def __init__(self, page_size=MENU_PAGE_SIZE):
+        self.page_size = page_size
+        self.version = None
+        self._pages = ()
+        self._lock = threading.Lock()
+
+    def get_markup(self, goods, version, page=0):
+        with self._lock:
+            if version != self.version:
+                self._pages = build_menu_pages(goods, self.page_size)
+                self.version = version
+                logger.debug(
+                    f'Built {len(self._pages)} menu pages for {version}'
+                )
+            pages = self._pages
+        return pages[min(max(page, 0), len(pages) - 1)]
+
+
+def build_menu_pages(goods, page_size=MENU_PAGE_SIZE):
+    rows = [
+        [InlineKeyboardButton(good.get('name'), callback_data=good.get('id'))]
+        for good in goods
+    ]
+    chunks = [
+        rows[start:start + page_size]
+        for start in range(0, len(rows), page_size)
+    ] or [[]]
+    pages = []
+    for page, chunk in enumerate(chunks):
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton(
+                f'⬅️ {page}', callback_data=f'{MENU_PAGE_PREFIX}{page - 1}'
+            ))
+        if page < len(chunks) - 1:
+            navigation.append(InlineKeyboardButton(
+                f'{page + 2} ➡️', callback_data=f'{MENU_PAGE_PREFIX}{page + 1}'
+            ))
+        if navigation:
+            chunk = chunk + [navigation]
+        pages.append(InlineKeyboardMarkup(chunk))
+    return tuple(pages)
+
+
+def get_menu_page(callback_data):
+    if not callback_data or not callback_data.startswith(MENU_PAGE_PREFIX):
+        return None
+    try:
+        return int(callback_data[len(MENU_PAGE_PREFIX):])
+    except ValueError:
+        return None
+
+
+def get_menu_keyboards():
+    global _menu_keyboards
+    if _menu_keyboards is None:
+        _menu_keyboards = MenuKeyboards(page_size=int(
+            os.getenv('PIZZA_SHOP_MENU_PAGE_SIZE', MENU_PAGE_SIZE)
+        ))
+    return _menu_keyboards
@@ -0,0 +1,71 @@
+import json
+import logging
+
+from redis.exceptions import RedisError
+
+from database_backend import get_database_connection, is_database_configured
+
+logger = logging.getLogger(__name__)
+
+PHOTO_CACHE_HASH = 'telegram_photo_file_ids'
+
+_photo_cache = None
+
+
+class TelegramPhotoCache(object):
+
+    def __init__(self, database=None, hash_name=PHOTO_CACHE_HASH):
+        self.database = database
+        self.hash_name = hash_name
+        self._photos = {}
+
+    def get(self, product_id, image_id):
+        photo = self._read(product_id)
+        if not photo:
+            return None
+        if photo.get('image_id') != image_id:
+            logger.debug(f'Main image of {product_id} changed to {image_id}')
+            self.forget(product_id)
+            return None
+        return photo.get('file_id')
+
+    def remember(self, product_id, image_id, file_id):
+        photo = {'image_id': image_id, 'file_id': file_id}
+        self._photos[product_id] = photo
+        if not self.database:
+            return
+        try:
+            self.database.hset(self.hash_name, product_id, json.dumps(photo))
+        except RedisError as err:
+            logger.error(f'Could not store telegram file id: {err}')
+
+    def forget(self, product_id):
+        self._photos.pop(product_id, None)
+        if not self.database:
+            return
+        try:
+            self.database.hdel(self.hash_name, product_id)
+        except RedisError as err:
+            logger.error(f'Could not drop telegram file id: {err}')
+
+    def _read(self, product_id):
+        if not self.database:
+            return self._photos.get(product_id)
+        try:
+            photo = self.database.hget(self.hash_name, product_id)
+        except RedisError as err:
+            logger.error(f'Could not read telegram file id: {err}')
+            return self._photos.get(product_id)
+        if not photo:
+            return None
+        return json.loads(photo)
+
+
+def get_photo_cache():
+    global _photo_cache
+    if _photo_cache is None:
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        _photo_cache = TelegramPhotoCache(database=database)
+    return _photo_cache
@@ -1,78 +1,67 @@
 from geopy.distance import distance
-from telegram import InlineKeyboardButton
+
+from delivery_tiers import get_delivery_tiers
+from pizzeria_index import SHORTLIST_SIZE, SPHERE_ERROR, PizzeriaIndex
+
+_pizzeria_index = None
 
 
 def calculate_distance_and_price(pizzeria):
-    message_to_customer = {
-        'less_than_5_km': (
-            '''
-            Похоже, придется ехать до вас на самокате.
-            Доставка будет стоить 100 рублей. Доставляем или самовывоз?'
-            '''
-        ),
-        'less_than_500_m': (
-            'Mожет, заберете пиццу из нашей пиццерии неподалёку? Она всего в '
-            f'{pizzeria.get("distance").m:.2f} метрах от вас! вот её адрес: '
-            f'{pizzeria.get("address")} \n\n'
-            'А можем и бесплатно доставить, нам не сложно.'
-        ),
-        'less_than_20_km': 'Доставка будет стоить 300 рублей.',
-        'more_than_20_km': (
-            'Простите, но так далеко мы пиццу не доставим.\n'
-            f'Ближайшая пиццерия аж в {pizzeria.get("distance").km:.2f} '
-            'километрах от вас!'
-        )
-    }
+    quote = get_delivery_tiers().quote(pizzeria)
+    return quote.message, quote.markup, quote.price
 
-    if pizzeria.get('distance').m < 500:
-        message = message_to_customer['less_than_500_m']
-        delivery_price = 0
-        markup = [
-            [InlineKeyboardButton('Доставка', callback_data='delivery'), ],
-            [InlineKeyboardButton('Самовывоз', callback_data='pickup'), ]
-        ]
-        return message, markup, delivery_price
 
-    if pizzeria.get('distance').m < 5000:
-        message = message_to_customer['less_than_5_km']
-        markup = [
-            [InlineKeyboardButton('Доставка', callback_data='delivery'), ],
-            [InlineKeyboardButton('Самовывоз', callback_data='pickup'), ]
-        ]
-        delivery_price = 100
-        return message, markup, delivery_price
+def get_pizzeriza_range(pizzeria):
+    return pizzeria.get('distance').m
 
-    if pizzeria.get('distance').m < 20000:
-        message = message_to_customer['less_than_20_km']
-        markup = [
-            [InlineKeyboardButton('Доставка', callback_data='delivery'), ],
-            [InlineKeyboardButton('Самовывоз', callback_data='pickup'), ]
-        ]
-        delivery_price = 300
-        return message, markup, delivery_price
 
-    message = message_to_customer['more_than_20_km']
-    markup = [
-        [InlineKeyboardButton('Самовывоз', callback_data='pickup'), ]
-    ]
-    delivery_price = 0
-    return message, markup, delivery_price
+def get_pizzeries_key(pizzeries):
+    return tuple(
+        (
+            pizzeria.get('id'),
+            pizzeria.get('latitude'),
+            pizzeria.get('longitude'),
+        ) for pizzeria in pizzeries
+    )
 
 
-def get_pizzeriza_range(pizzeria):
-    return pizzeria.get('distance').m
+def get_pizzeria_index(pizzeries):
+    global _pizzeria_index
+    if isinstance(pizzeries, PizzeriaIndex):
+        return pizzeries
+    pizzeries = list(pizzeries)
+    index_key = get_pizzeries_key(pizzeries)
+    if not _pizzeria_index or _pizzeria_index[0] != index_key:
+        _pizzeria_index = (index_key, PizzeriaIndex(pizzeries))
+    return _pizzeria_index[1]
 
 
 def get_closest_pizzeria(coords, pizzeries):
-    pizzeria_distances = []
-    for pizzeria in pizzeries:
-        pizza_distance = distance(
-            (coords.latitude, coords.longitude),
-            (pizzeria.get('latitude'), pizzeria.get('longitude'))
+    index = get_pizzeria_index(pizzeries)
+    shortlist_size = SHORTLIST_SIZE
+    while True:
+        shortlist = index.nearest(
+            coords.latitude, coords.longitude, shortlist_size
+        )
+        closest_pizzeria = min(
+            (
+                {
+                    'pizzeria': index.pizzerias[position],
+                    'distance': distance(
+                        (coords.latitude, coords.longitude),
+                        (
+                            index.pizzerias[position].get('latitude'),
+                            index.pizzerias[position].get('longitude'),
+                        )
+                    ),
+                } for _, position in shortlist
+            ),
+            key=get_pizzeriza_range
         )
-        pizzeria_range = {
-            'pizzeria': pizzeria,
-            'distance': pizza_distance,
-        }
-        pizzeria_distances.append(pizzeria_range)
-    return min(pizzeria_distances, key=get_pizzeriza_range)
+        farthest_candidate = shortlist[-1][0]
+        # A farther pizzeria on the sphere can still be closer on the
+        # ellipsoid, so widen the shortlist until that is ruled out.
+        if (shortlist_size >= len(index) or farthest_candidate >
+                get_pizzeriza_range(closest_pizzeria) * (1 + SPHERE_ERROR)):
+            return closest_pizzeria
+        shortlist_size *= 2
@@ -0,0 +1,113 @@
+import numpy as np
+from geopy.distance import distance
+
+from pizzeria_index import EARTH_RADIUS_M, SPHERE_ERROR
+
+DELIVERY_TIER_BOUNDARIES = (500, 5000, 20000)
+MATRIX_CELLS = 4_000_000
+
+
+def to_unit_vectors(latitudes, longitudes):
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitudes = np.cos(latitudes)
+    return np.ascontiguousarray(np.stack(
+        (
+            cos_latitudes * np.cos(longitudes),
+            cos_latitudes * np.sin(longitudes),
+            np.sin(latitudes),
+        ),
+        axis=-1
+    ))
+
+
+class DistanceEngine(object):
+
+    def __init__(self, pizzerias, boundaries=DELIVERY_TIER_BOUNDARIES):
+        self.pizzerias = list(pizzerias)
+        self.boundaries = np.asarray(sorted(boundaries), dtype=np.float64)
+        self.latitudes = np.ascontiguousarray(
+            [float(pizzeria.get('latitude')) for pizzeria in self.pizzerias],
+            dtype=np.float64
+        )
+        self.longitudes = np.ascontiguousarray(
+            [float(pizzeria.get('longitude')) for pizzeria in self.pizzerias],
+            dtype=np.float64
+        )
+        self._vectors = to_unit_vectors(self.latitudes, self.longitudes)
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def haversine(self, latitudes, longitudes):
+        # Great-circle distance through the chord between unit vectors,
+        # the same value as the haversine formula but a single matrix
+        # product for a whole block of customers.
+        vectors = to_unit_vectors(latitudes, longitudes)
+        squared_chords = np.clip(
+            2 - 2 * np.matmul(vectors, self._vectors.T), 0, 4
+        )
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(squared_chords) / 2)
+
+    def nearest(self, latitude, longitude):
+        positions, meters = self.nearest_many([latitude], [longitude])
+        return int(positions[0]), float(meters[0])
+
+    def nearest_many(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        positions = np.empty(len(latitudes), dtype=np.int64)
+        meters = np.empty(len(latitudes), dtype=np.float64)
+        chunk_size = max(1, MATRIX_CELLS // max(len(self), 1))
+        for start in range(0, len(latitudes), chunk_size):
+            end = start + chunk_size
+            distances = self.haversine(
+                latitudes[start:end], longitudes[start:end]
+            )
+            chunk_positions = np.argmin(distances, axis=1)
+            chunk_meters = distances[
+                np.arange(len(chunk_positions)), chunk_positions
+            ]
+            for row in self._get_ambiguous_rows(distances, chunk_meters):
+                chunk_positions[row], chunk_meters[row] = self._refine(
+                    latitudes[start + row],
+                    longitudes[start + row],
+                    distances[row],
+                    chunk_meters[row]
+                )
+            positions[start:end] = chunk_positions
+            meters[start:end] = chunk_meters
+        return positions, meters
+
+    def get_tiers(self, meters):
+        return np.searchsorted(self.boundaries, meters, side='right')
+
+    def _get_ambiguous_rows(self, distances, nearest_meters):
+        # Haversine is only trusted where the sphere/ellipsoid error can
+        # change neither the tier nor which pizzeria is the nearest.
+        tolerance = nearest_meters * SPHERE_ERROR
+        near_boundary = np.any(
+            np.abs(nearest_meters[:, np.newaxis] - self.boundaries)
+            <= tolerance[:, np.newaxis],
+            axis=1
+        )
+        if distances.shape[1] > 1:
+            runner_up = np.partition(distances, 1, axis=1)[:, 1]
+            near_tie = runner_up - nearest_meters <= 2 * tolerance
+        else:
+            near_tie = np.zeros(len(nearest_meters), dtype=bool)
+        return np.flatnonzero(near_boundary | near_tie)
+
+    def _refine(self, latitude, longitude, distances, nearest_meters):
+        candidates = np.flatnonzero(
+            distances <= nearest_meters * (1 + 2 * SPHERE_ERROR)
+        )
+        geodesic_meters = [
+            distance(
+                (latitude, longitude),
+                (self.latitudes[position], self.longitudes[position])
+            ).m
+            for position in candidates
+        ]
+        best = int(np.argmin(geodesic_meters))
+        return candidates[best], geodesic_meters[best]
@@ -0,0 +1,82 @@
+import heapq
+import math
+
+EARTH_RADIUS_M = 6371008.8
+SHORTLIST_SIZE = 8
+# A spherical distance differs from the WGS-84 geodesic by less than 0.6%.
+SPHERE_ERROR = 0.006
+
+
+def to_unit_vector(latitude, longitude):
+    latitude = math.radians(float(latitude))
+    longitude = math.radians(float(longitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def chord_to_meters(chord):
+    return 2 * EARTH_RADIUS_M * math.asin(min(chord / 2, 1.0))
+
+
+class PizzeriaIndex(object):
+
+    def __init__(self, pizzerias):
+        self.pizzerias = list(pizzerias)
+        points = [
+            (
+                to_unit_vector(
+                    pizzeria.get('latitude'), pizzeria.get('longitude')
+                ),
+                position,
+            )
+            for position, pizzeria in enumerate(self.pizzerias)
+        ]
+        self._tree = self._build(points, 0)
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def nearest(self, latitude, longitude, k=SHORTLIST_SIZE):
+        target = to_unit_vector(latitude, longitude)
+        found = []
+        self._search(self._tree, target, k, found)
+        return [
+            (chord_to_meters(math.sqrt(-squared_chord)), position)
+            for squared_chord, position in sorted(found, reverse=True)
+        ]
+
+    def _build(self, points, axis):
+        if not points:
+            return None
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        next_axis = (axis + 1) % 3
+        return (
+            points[median][0],
+            points[median][1],
+            axis,
+            self._build(points[:median], next_axis),
+            self._build(points[median + 1:], next_axis),
+        )
+
+    def _search(self, node, target, k, found):
+        if node is None:
+            return
+        point, position, axis, left, right = node
+        squared_chord = sum(
+            (point[i] - target[i]) ** 2 for i in range(3)
+        )
+        # found is a max-heap of the k closest points by squared chord
+        if len(found) < k:
+            heapq.heappush(found, (-squared_chord, position))
+        elif squared_chord < -found[0][0]:
+            heapq.heapreplace(found, (-squared_chord, position))
+
+        offset = target[axis] - point[axis]
+        near, far = (left, right) if offset < 0 else (right, left)
+        self._search(near, target, k, found)
+        if len(found) < k or offset ** 2 < -found[0][0]:
+            self._search(far, target, k, found)
@@ -0,0 +1,277 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from geopy.distance import distance
+
+from api_elasticpath import get_token, iter_pizzeries_coordinates
+from database_backend import get_database_connection, is_database_configured
+from database_backend import start_listener
+from delivery_grid import DeliveryGrid
+from delivery_tiers import get_delivery_tiers
+from pizzeria import get_closest_pizzeria
+from pizzeria_distances import DELIVERY_TIER_BOUNDARIES, DistanceEngine
+from pizzeria_index import PizzeriaIndex
+
+logger = logging.getLogger(__name__)
+
+PIZZERIA_REGISTRY_TTL = 3600
+PIZZERIA_REGISTRY_CHANNEL = 'pizzeria_registry'
+
+_pizzeria_registry = None
+_pizzeria_registry_lock = threading.Lock()
+
+
+class Pizzeria(namedtuple(
+    'Pizzeria',
+    ['id', 'alias', 'address', 'latitude', 'longitude', 'delivery_tg_id']
+)):
+    __slots__ = ()
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(
+            id=entry.get('id'),
+            alias=entry.get('alias'),
+            address=entry.get('address'),
+            latitude=float(entry.get('latitude')),
+            longitude=float(entry.get('longitude')),
+            delivery_tg_id=entry.get('delivery-tg-id'),
+        )
+
+    def as_entry(self):
+        return {
+            'id': self.id,
+            'alias': self.alias,
+            'address': self.address,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+            'delivery-tg-id': self.delivery_tg_id,
+        }
+
+    def get(self, key, default=None):
+        if key == 'delivery-tg-id':
+            return self.delivery_tg_id
+        if key in self._fields and key != 'delivery_tg_id':
+            return getattr(self, key)
+        return default
+
+
+class PizzeriaRegistry(object):
+
+    def __init__(self, loader, ttl=PIZZERIA_REGISTRY_TTL, database=None,
+                 channel=PIZZERIA_REGISTRY_CHANNEL, boundaries=None):
+        self.loader = loader
+        self.boundaries = boundaries or DELIVERY_TIER_BOUNDARIES
+        self.ttl = ttl
+        self.database = database
+        self.channel = channel
+        self.version = None
+        self._pizzerias = None
+        self._index = None
+        self._grid = None
+        self._grid_path = None
+        self._loaded_at = 0
+        self._refreshing = False
+        self._grid_lock = threading.Lock()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def pizzerias(self):
+        self._ensure_loaded()
+        return self._pizzerias
+
+    def get_index(self):
+        self._ensure_loaded()
+        return self._index
+
+    def get_grid(self):
+        self._ensure_loaded()
+        with self._lock:
+            return self._get_current_grid()
+
+    def get_closest(self, coords):
+        self._ensure_loaded()
+        with self._lock:
+            index = self._index
+            grid = self._get_current_grid()
+        found = grid and grid.lookup(coords.latitude, coords.longitude)
+        if not found:
+            return get_closest_pizzeria(coords, index)
+        pizzeria = index.pizzerias[found[0]]
+        return {
+            'pizzeria': pizzeria,
+            'distance': distance(
+                (coords.latitude, coords.longitude),
+                (pizzeria.latitude, pizzeria.longitude)
+            ),
+        }
+
+    def enable_grid(self, path=None):
+        self._grid_path = path
+        self.add_listener(self._rebuild_grid_in_background)
+        if self._pizzerias is not None:
+            self._rebuild_grid_in_background(self)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def refresh(self):
+        pizzerias = tuple(
+            Pizzeria.from_entry(entry) for entry in self.loader()
+        )
+        version = hashlib.sha256(
+            json.dumps(pizzerias, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+        with self._lock:
+            changed = version != self.version
+            if changed:
+                self._pizzerias = pizzerias
+                self._index = PizzeriaIndex(pizzerias)
+                self.version = version
+            self._loaded_at = time.time()
+        logger.debug(f'Loaded {len(pizzerias)} pizzerias, version {version}')
+        if changed:
+            for callback in self._listeners:
+                callback(self)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0
+
+    def subscribe(self):
+        if not self.database:
+            return None
+        return start_listener(self.database, self.channel, self._handle_update)
+
+    def _ensure_loaded(self):
+        if self._pizzerias is None:
+            with self._load_lock:
+                if self._pizzerias is None:
+                    self.refresh()
+            return
+        if time.time() - self._loaded_at > self.ttl:
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_quietly, daemon=True).start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as err:
+            logger.error(f'Could not refresh pizzerias: {err}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _get_current_grid(self):
+        grid = self._grid
+        if grid is None or grid.version != self.version:
+            return None
+        return grid
+
+    def _rebuild_grid_in_background(self, registry):
+        threading.Thread(target=self._rebuild_grid, daemon=True).start()
+
+    def _rebuild_grid(self):
+        # A rebuild that is already running picks up newer versions
+        # itself, so concurrent refreshes do not stack up builds.
+        if not self._grid_lock.acquire(blocking=False):
+            return
+        try:
+            while self._grid is None or self._grid.version != self.version:
+                with self._lock:
+                    version = self.version
+                    pizzerias = self._pizzerias
+                self._grid = self._load_grid(version, pizzerias)
+        except Exception as err:
+            logger.error(f'Could not build delivery grid: {err}')
+        finally:
+            self._grid_lock.release()
+
+    def _load_grid(self, version, pizzerias):
+        if self._grid_path:
+            try:
+                grid = DeliveryGrid.load(self._grid_path)
+                if (grid.version == version
+                        and grid.boundaries == tuple(self.boundaries)):
+                    return grid
+            except (OSError, ValueError, KeyError) as err:
+                logger.debug(f'No saved delivery grid: {err}')
+        started_at = time.monotonic()
+        grid = DeliveryGrid.build(
+            DistanceEngine(pizzerias, self.boundaries),
+            version,
+            self.boundaries
+        )
+        logger.debug(
+            f'Built delivery grid for version {version} '
+            f'in {time.monotonic() - started_at:.2f}s'
+        )
+        if self._grid_path:
+            grid.save(self._grid_path)
+        return grid
+
+    def _handle_update(self, data):
+        logger.debug(f'Pizzeria registry message: {data}')
+        self.invalidate()
+        self._refresh_in_background()
+
+
+def load_pizzerias():
+    access_token = get_token(
+        'https://api.moltin.com/oauth/access_token',
+        os.getenv('PIZZA_SHOP_CLIENT_ID')
+    )
+    return iter_pizzeries_coordinates(
+        'https://api.moltin.com/v2/flows/pizzeria/entries',
+        access_token
+    )
+
+
+def publish_pizzeria_update():
+    if not is_database_configured():
+        return
+    get_database_connection().publish(PIZZERIA_REGISTRY_CHANNEL, 'invalidate')
+
+
+def get_pizzeria_registry():
+    global _pizzeria_registry
+    if _pizzeria_registry is not None:
+        return _pizzeria_registry
+    # Bot worker threads and Flask threads both get here; a second
+    # registry would start its own subscriber and grid build.
+    with _pizzeria_registry_lock:
+        if _pizzeria_registry is not None:
+            return _pizzeria_registry
+        database = None
+        if is_database_configured():
+            database = get_database_connection()
+        pizzeria_registry = PizzeriaRegistry(
+            load_pizzerias,
+            ttl=int(os.getenv(
+                'PIZZA_SHOP_PIZZERIA_TTL', PIZZERIA_REGISTRY_TTL
+            )),
+            database=database,
+            boundaries=get_delivery_tiers().boundaries,
+        )
+        # Building the grid takes seconds of CPU per pizzeria version, so
+        # processes only do it when asked to.
+        if os.getenv('PIZZA_SHOP_DELIVERY_GRID', '0') != '0':
+            pizzeria_registry.enable_grid(
+                os.getenv('PIZZA_SHOP_DELIVERY_GRID_PATH')
+            )
+        pizzeria_registry.subscribe()
+        _pizzeria_registry = pizzeria_registry
+    return _pizzeria_registry
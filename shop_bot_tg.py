@@ -1,58 +1,93 @@
+import asyncio
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import dedent
 
 from dotenv import load_dotenv
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram import ParseMode, ShippingOption, Update
-from telegram.ext import CallbackContext, CallbackQueryHandler, CommandHandler
-from telegram.ext import Filters, MessageHandler, PreCheckoutQueryHandler
-from telegram.ext import ShippingQueryHandler, Updater
-from telegram.utils.helpers import escape_markdown
-
-from api_elasticpath import add_proudct_to_cart, create_customer_address
-from api_elasticpath import get_cart, get_cart_products, get_catalog
-from api_elasticpath import get_customer_address, get_pizzeries_coordinates
-from api_elasticpath import get_product_detail, get_product_picture_url
-from api_elasticpath import get_token, remove_products_from_cart
-from api_yandex import fetch_coordinates
-from database_backend import get_database_connection
-from pizzeria import calculate_distance_and_price, get_closest_pizzeria
+from telegram import ShippingOption, Update
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler
+from telegram.ext import ContextTypes, MessageHandler, PreCheckoutQueryHandler
+from telegram.ext import ShippingQueryHandler, filters
+from telegram.helpers import escape_markdown
+
+from api_elasticpath import get_http_pool_size, get_token
+from cart_mirror import add_product_to_mirrored_cart
+from cart_mirror import get_mirrored_cart_products, reconcile_mirrored_cart
+from cart_mirror import remove_product_from_mirrored_cart
+from catalog_cache import get_cached_catalog, get_cached_product_detail
+from catalog_cache import get_versioned_catalog
+from courier_dispatch import DeliveryOrder, get_courier_dispatcher
+from customer_addresses import remember_customer_address
+from database_backend import get_database_connection, get_state_store
+from geocoding_cache import fetch_cached_coordinates
+from image_cache import get_cached_picture_url, get_main_image_ids
+from image_cache import warm_image_cache
+from menu_keyboards import get_menu_keyboards, get_menu_page
+from photo_cache import get_photo_cache
+from pizzeria import calculate_distance_and_price
+from pizzeria_registry import get_pizzeria_registry
+from telegram_ingress import run_webhook
+from update_scheduler import ChatLaneUpdateProcessor
+from user_data_store import get_context_types
 
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 FEEDBACK_TIMER = 3600
+CONCURRENT_UPDATES = 64
+LANE_REPORT_INTERVAL = 60
 
 
-def start(update: Update, context: CallbackContext) -> str:
-    logger.debug('HANDLE_START')
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
+async def get_access_token(**kwargs):
+    return await asyncio.to_thread(
+        get_token,
         'https://api.moltin.com/oauth/access_token',
-        client_id
+        os.getenv('PIZZA_SHOP_CLIENT_ID'),
+        **kwargs
     )
-    logger.debug(f'access_token: {access_token}')
-    goods = get_catalog('https://api.moltin.com/v2/products', access_token)
-    logger.debug(f'goods: {goods}')
-    keyboard = [[InlineKeyboardButton(
-        good.get('name'), callback_data=good.get('id')
-    )] for good in goods.get('data', None)]
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.message.reply_text('Please choose: ', reply_markup=reply_markup)
+
+async def start(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> str:
+    logger.debug('HANDLE_START')
+    access_token = await get_access_token()
+    logger.debug(f'access_token: {access_token}')
+    await update.message.reply_text(
+        'Please choose: ', reply_markup=await get_menu_markup(access_token)
+    )
     return "HANDLE_MENU"
 
 
-def handle_menu(update: Update, context: CallbackContext) -> str:
+async def get_menu_markup(access_token, page=0):
+    goods, version = await asyncio.to_thread(
+        get_versioned_catalog,
+        'https://api.moltin.com/v2/products', access_token
+    )
+    return get_menu_keyboards().get_markup(goods.get('data'), version, page)
+
+
+async def handle_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> str:
     logger.debug('HANDLE_MENU')
     query = update.callback_query
     logger.debug(query.data)
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id
-    )
-    pizza = get_product_detail(
+    access_token = await get_access_token()
+    page = get_menu_page(query.data)
+    if page is not None:
+        await query.answer()
+        await query.edit_message_reply_markup(
+            reply_markup=await get_menu_markup(access_token, page)
+        )
+        return 'HANDLE_MENU'
+    pizza = await asyncio.to_thread(
+        get_cached_product_detail,
         'https://api.moltin.com/v2/products/',
         query.data,
         access_token
@@ -69,7 +104,7 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
 
     _{escape_markdown(pizza.get('description'), version=2)}_
     '''
-    context.bot.delete_message(
+    await context.bot.delete_message(
         chat_id=query.message.chat.id,
         message_id=query.message.message_id
     )
@@ -92,20 +127,18 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
         )
 
     if pizza_picture_id:
-        url = get_product_picture_url(
-            'https://api.moltin.com/v2/files/',
+        await reply_with_product_photo(
+            query.message,
+            pizza.get('id'),
             pizza_picture_id,
-            access_token
-        )
-        query.message.reply_photo(
-            url,
+            access_token,
             caption=dedent(pizza_detail),
             reply_markup=reply_markup,
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return 'HANDLE_DESCRIPTION'
 
-    query.message.reply_text(
+    await query.message.reply_text(
         text=dedent(pizza_detail),
         reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN_V2
@@ -113,6 +146,30 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
     return 'HANDLE_DESCRIPTION'
 
 
+async def reply_with_product_photo(message, product_id, picture_id,
+                                   access_token, **kwargs):
+    photo_cache = get_photo_cache()
+    file_id = await asyncio.to_thread(photo_cache.get, product_id, picture_id)
+    if file_id:
+        try:
+            return await message.reply_photo(file_id, **kwargs)
+        except BadRequest as err:
+            logger.error(f'Telegram rejected cached photo {file_id}: {err}')
+            await asyncio.to_thread(photo_cache.forget, product_id)
+    url = await asyncio.to_thread(
+        get_cached_picture_url,
+        'https://api.moltin.com/v2/files/',
+        picture_id,
+        access_token
+    )
+    sent_message = await message.reply_photo(url, **kwargs)
+    await asyncio.to_thread(
+        photo_cache.remember,
+        product_id, picture_id, sent_message.photo[-1].file_id
+    )
+    return sent_message
+
+
 def build_pizzas_menu(pizzas):
     logger.debug('HANDLE PIZZAS MENU')
     keyboard = []
@@ -138,40 +195,30 @@ def build_pizzas_menu(pizzas):
     return product_cart, keyboard
 
 
-def handle_description(update: Update, context: CallbackContext) -> str:
+async def handle_description(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> str:
     logger.debug('Handle description')
     query = update.callback_query
-    good = context.user_data.get("chosen")
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id
-    )
+    user_data = await asyncio.to_thread(context.user_data.load)
+    good = user_data.get("chosen")
+    access_token = await get_access_token()
     logger.debug(f'access_token: {access_token}')
     user_choice = query.data
     logger.debug(f'handle_desc: {user_choice}')
     logger.debug(f'handle_desc: {query}')
     logger.debug(f'handle_desc: (choses) {good}')
     if user_choice == 'Back':
-        goods = get_catalog('https://api.moltin.com/v2/products', access_token)
-        logger.debug(f'goods: {goods}')
-        keyboard = [[InlineKeyboardButton(
-            good.get('name'), callback_data=good.get('id')
-        )] for good in goods.get('data', None)]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         logger.debug(query.message)
-        query.message.reply_text('Please choose: ', reply_markup=reply_markup)
+        await query.message.reply_text(
+            'Please choose: ', reply_markup=await get_menu_markup(access_token)
+        )
         return 'HANDLE_MENU'
     if 'add' in user_choice:
-        query.answer(text='Пицца добавлена в корзину', show_alert=False)
+        await query.answer(text='Пицца добавлена в корзину', show_alert=False)
         logger.debug(user_choice)
-        cart = get_cart(
-            'https://api.moltin.com/v2/carts/',
-            access_token,
-            str(update.effective_user.id)
-        )
-        logger.debug('have a cart')
-        cart = add_proudct_to_cart(
+        cart = await asyncio.to_thread(
+            add_product_to_mirrored_cart,
             'https://api.moltin.com/v2/carts/',
             good,
             1,
@@ -181,7 +228,8 @@ def handle_description(update: Update, context: CallbackContext) -> str:
         logger.debug(f'added products: {cart}')
         return 'HANDLE_DESCRIPTION'
 
-    products = get_cart_products(
+    products = await asyncio.to_thread(
+        get_mirrored_cart_products,
         'https://api.moltin.com/v2/carts/',
         access_token,
         str(update.effective_user.id)
@@ -207,7 +255,7 @@ def handle_description(update: Update, context: CallbackContext) -> str:
         f"*К оплате: {escape_markdown(total_formatted, version=2)}*"
     )
     logger.debug(dedent(product_cart))
-    query.message.reply_text(
+    await query.message.reply_text(
         text=dedent(product_cart),
         reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN_V2
@@ -215,26 +263,21 @@ def handle_description(update: Update, context: CallbackContext) -> str:
     return 'HANDLE_CART'
 
 
-def handle_cart(update: Update, context: CallbackContext) -> str:
+async def handle_cart(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> str:
     query = update.callback_query
     logger.debug(f'Handle CART {query.data}')
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id
-    )
+    access_token = await get_access_token()
     if query.data in ('menu', 'Back'):
         logger.debug('going to menu')
-        goods = get_catalog('https://api.moltin.com/v2/products', access_token)
-        logger.debug(f'goods: {goods}')
-        keyboard = [[InlineKeyboardButton(
-            good.get('name'), callback_data=good.get('id')
-        )] for good in goods.get('data', None)]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.message.reply_text('Please choose: ', reply_markup=reply_markup)
+        await query.message.reply_text(
+            'Please choose: ', reply_markup=await get_menu_markup(access_token)
+        )
         return 'HANDLE_MENU'
     if query.data == 'Basket':
-        products = get_cart_products(
+        products = await asyncio.to_thread(
+            get_mirrored_cart_products,
             'https://api.moltin.com/v2/carts/',
             access_token,
             str(update.effective_user.id)
@@ -259,29 +302,25 @@ def handle_cart(update: Update, context: CallbackContext) -> str:
         product_cart += (
             f"*К оплате: {escape_markdown(total_formatted, version=2)}*"
         )
-        query.message.reply_text(
+        await query.message.reply_text(
             text=dedent(product_cart),
             reply_markup=reply_markup,
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return 'HANDLE_CART'
     if query.data == 'pay':
-        query.message.reply_text(
+        await query.message.reply_text(
             'Хорошо. пришлите нам ваш адрес текстом или геолокацию.'
         )
         return 'HANDLE_WAITING'
 
-    remove_products_from_cart(
+    products = await asyncio.to_thread(
+        remove_product_from_mirrored_cart,
         'https://api.moltin.com/v2/carts/',
         query.data,
         access_token,
         str(update.effective_user.id)
     )
-    products = get_cart_products(
-        'https://api.moltin.com/v2/carts/',
-        access_token,
-        str(update.effective_user.id)
-    )
     product_cart, keyboard = build_pizzas_menu(products.get('data'))
     keyboard.append(
         [InlineKeyboardButton('В меню', callback_data='menu'), ]
@@ -302,7 +341,7 @@ def handle_cart(update: Update, context: CallbackContext) -> str:
         f"*К оплате: {escape_markdown(price_formatted, version=2)}*"
     )
     logger.debug(product_cart)
-    query.message.reply_text(
+    await query.message.reply_text(
         text=dedent(product_cart),
         reply_markup=reply_markup,
         parse_mode=ParseMode.MARKDOWN_V2
@@ -310,65 +349,55 @@ def handle_cart(update: Update, context: CallbackContext) -> str:
     return 'HANDLE_CART'
 
 
-def handle_waiting(update: Update, context: CallbackContext) -> None:
+async def handle_waiting(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
     logger.debug('Handle waiting')
     location = update.message.location
     users_reply = update.message.text
     if users_reply:
         yandex_api_key = os.getenv('PIZZA_SHOP_YA_TOKEN')
-        location = fetch_coordinates(yandex_api_key, users_reply)
+        location = await asyncio.to_thread(
+            fetch_cached_coordinates, yandex_api_key, users_reply
+        )
         logger.debug(location)
     if not location:
-        update.message.reply_text(
+        await update.message.reply_text(
             'Не удалось определить адрес. Попробуйте ещё раз.'
         )
         return 'HANDLE_WAITING'
 
     current_position = location.latitude, location.longitude
     logger.debug(current_position)
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id
-    )
-    pizzeries = get_pizzeries_coordinates(
-        'https://api.moltin.com/v2/flows/pizzeria/entries',
-        access_token
-    )
-    logger.debug(pizzeries)
-    closest_pizzeria = get_closest_pizzeria(location, pizzeries)
-    context.user_data['pizzeria'] = closest_pizzeria
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    internal_access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id,
-        client_secret=os.getenv('PIZZA_SHOP_CLIENT_SECRET', None)
+    closest_pizzeria = await asyncio.to_thread(
+        get_pizzeria_registry().get_closest, location
     )
-    context.user_data['user_coordinates'] = create_customer_address(
-        'https://api.moltin.com/v2/flows/customer-address/entries',
-        internal_access_token,
-        location
+    context.user_data['user_coordinates'] = await asyncio.to_thread(
+        remember_customer_address, update.effective_user.id, location
     )
     logger.debug(closest_pizzeria)
     message_to_customer, markup, delivery_price = calculate_distance_and_price(
         closest_pizzeria
     )
+    # user_data is stored as JSON, so keep the entry and plain meters.
+    context.user_data['pizzeria'] = {
+        'pizzeria': closest_pizzeria.get('pizzeria').as_entry(),
+        'distance': closest_pizzeria.get('distance').m,
+    }
     context.user_data['delivery'] = delivery_price
     logger.debug(message_to_customer)
-    reply_markup = InlineKeyboardMarkup(markup)
-    update.message.reply_text(
-        dedent(message_to_customer), reply_markup=reply_markup
-    )
+    await update.message.reply_text(message_to_customer, reply_markup=markup)
     return 'HANDLE_DELIVERY'
 
 
-def handle_delivery(
-    update: Update, context: CallbackContext
+async def handle_delivery(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     logger.debug('Handle delivery')
     query = update.callback_query
     logger.debug(query.data)
-    nearest_pizzeria = context.user_data.get("pizzeria")
+    user_data = await asyncio.to_thread(context.user_data.load)
+    nearest_pizzeria = user_data.get("pizzeria")
     logger.debug(nearest_pizzeria)
     if query.data == 'pickup':
         message = escape_markdown(
@@ -377,21 +406,12 @@ def handle_delivery(
             'До встречи в пиццерии 😁',
             version=2)
     else:
-        location = context.user_data.get('user_coordinates')
+        location = user_data.get('user_coordinates')
         logger.debug(f'sending {location}')
-        client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-        access_token = get_token(
-            'https://api.moltin.com/oauth/access_token',
-            client_id
-        )
-        location = get_customer_address(
-            'https://api.moltin.com/v2/flows/customer-address/entries',
-            access_token,
-            location
-        )
-        delivery_tg = nearest_pizzeria.get("pizzeria").get("delivery-tg-id")
-        bot = update.callback_query.bot
-        products = get_cart_products(
+        access_token = await get_access_token()
+        # The courier gets what Elasticpath holds, not the mirror.
+        products = await asyncio.to_thread(
+            reconcile_mirrored_cart,
             'https://api.moltin.com/v2/carts/',
             access_token,
             str(update.effective_user.id)
@@ -407,21 +427,21 @@ def handle_delivery(
         product_cart += (
             f"*К оплате: {escape_markdown(total_formatted, version=2)}*"
         )
-        bot.send_message(
-            delivery_tg,
-            dedent(product_cart),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        bot.send_location(
-            delivery_tg,
-            latitude=location.get('latitude'),
-            longitude=location.get('longitude')
+        await get_courier_dispatcher().submit(
+            context.job_queue,
+            nearest_pizzeria.get('pizzeria'),
+            DeliveryOrder(
+                chat_id=query.message.chat_id,
+                latitude=float(location.get('latitude')),
+                longitude=float(location.get('longitude')),
+                cart=dedent(product_cart),
+                created_at=time.time(),
+            )
         )
-        logger.debug(f'get delivery id: {delivery_tg}')
         context.job_queue.run_once(
             remind_to_give_feedback,
             FEEDBACK_TIMER,
-            context=query.message.chat_id
+            data=query.message.chat_id
         )
         message = escape_markdown(
             'Вашу пиццу привезет курьер по указанному адресу:\n'
@@ -431,7 +451,7 @@ def handle_delivery(
         'Оплата', callback_data='payment_mode'
     ), ], ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.message.reply_text(
+    await query.message.reply_text(
         message,
         parse_mode=ParseMode.MARKDOWN_V2,
         reply_markup=reply_markup
@@ -440,19 +460,19 @@ def handle_delivery(
     return 'PAYMENT'
 
 
-def remind_to_give_feedback(context: CallbackContext):
+async def remind_to_give_feedback(context: ContextTypes.DEFAULT_TYPE):
     message = '''
         Приятного аппетита! *место для рекламы*
 
         *сообщение что делать если пицца не пришла*
     '''
-    context.bot.send_message(
-        chat_id=context.job.context, text=dedent(message)
+    await context.bot.send_message(
+        chat_id=context.job.data, text=dedent(message)
     )
 
 
-def start_with_shipping_callback(
-    update: Update, context: CallbackContext
+async def start_with_shipping_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     chat_id = update.callback_query.message.chat_id
 
@@ -461,12 +481,10 @@ def start_with_shipping_callback(
     payload = "Custom-Payload"
     provider_token = os.getenv('PIZZA_SHOP_PAY_TOKEN')
     currency = "RUB"
-    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
-    access_token = get_token(
-        'https://api.moltin.com/oauth/access_token',
-        client_id
-    )
-    products = get_cart_products(
+    access_token = await get_access_token()
+    # Charge what Elasticpath holds, never a possibly stale mirror.
+    products = await asyncio.to_thread(
+        reconcile_mirrored_cart,
         'https://api.moltin.com/v2/carts/',
         access_token,
         str(update.effective_user.id)
@@ -480,7 +498,7 @@ def start_with_shipping_callback(
     )
     prices = [LabeledPrice(label="Заказ", amount=price * 100), ]
 
-    context.bot.send_invoice(
+    await context.bot.send_invoice(
         chat_id, title, description, payload,
         provider_token, currency, prices,
         need_name=True, need_phone_number=True,
@@ -489,48 +507,55 @@ def start_with_shipping_callback(
     return 'SHIPPING_CALLBACK'
 
 
-def shipping_callback(update: Update, context: CallbackContext) -> None:
+async def shipping_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
     query = update.shipping_query
     if query.invoice_payload != 'Custom-Payload':
-        context.bot.answer_shipping_query(
+        await context.bot.answer_shipping_query(
             shipping_query_id=query.id, ok=False,
             error_message="Something went wrong..."
         )
         return
 
     options = list()
-    delivery = context.user_data.get('delivery')
+    user_data = await asyncio.to_thread(context.user_data.load)
+    delivery = user_data.get('delivery')
     options.append(
         ShippingOption(
             '1', 'Доставка', [LabeledPrice('delivery', delivery * 100)]
         )
     )
-    context.bot.answer_shipping_query(
+    await context.bot.answer_shipping_query(
         shipping_query_id=query.id, ok=True, shipping_options=options
     )
 
 
-def precheckout_callback(update: Update, context: CallbackContext) -> None:
+async def precheckout_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
     query = update.pre_checkout_query
     if query.invoice_payload != 'Custom-Payload':
-        context.bot.answer_pre_checkout_query(
+        await context.bot.answer_pre_checkout_query(
             pre_checkout_query_id=query.id, ok=False,
             error_message="Something went wrong...")
         return
-    context.bot.answer_pre_checkout_query(
+    await context.bot.answer_pre_checkout_query(
         pre_checkout_query_id=query.id, ok=True
     )
 
 
-def successful_payment_callback(
-    update: Update, context: CallbackContext
+async def successful_payment_callback(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     # do something after successful receive of payment?
-    update.message.reply_text("Заказ оплачен! Спасибо!")
+    await update.message.reply_text("Заказ оплачен! Спасибо!")
 
 
-def handle_users_reply(update: Update, context: CallbackContext) -> None:
-    db = get_database_connection()
+async def handle_users_reply(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    state_store = get_state_store()
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -539,10 +564,6 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
         chat_id = update.callback_query.message.chat_id
     else:
         return
-    if user_reply == '/start':
-        user_state = 'START'
-    else:
-        user_state = db.get(chat_id).decode("utf-8")
 
     states_functions = {
         'START': start,
@@ -554,34 +575,169 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
         'PAYMENT': start_with_shipping_callback,
         'SHIPPING_CALLBACK': shipping_callback,
     }
+    if user_reply == '/start':
+        user_state = 'START'
+    else:
+        user_state = await asyncio.to_thread(state_store.get_state, chat_id)
     state_handler = states_functions[user_state]
     try:
         logger.debug(f'Getting into {user_state}')
-        next_state = state_handler(update, context)
-        db.set(chat_id, next_state)
+        next_state = await state_handler(update, context)
+        await asyncio.to_thread(
+            save_state, state_store, chat_id, next_state, context.user_data
+        )
     except Exception as err:
         logger.error(err)
 
 
+def save_state(state_store, chat_id, state, user_data=None):
+    # One round trip for the next state and whatever the handler changed
+    # in user_data.
+    pipeline = state_store.pipeline()
+    if user_data is not None:
+        user_data.flush(pipeline)
+    state_store.set_state(chat_id, state, pipeline)
+    pipeline.execute()
+
+
+def warm_caches():
+    client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
+    try:
+        access_token = get_token(
+            'https://api.moltin.com/oauth/access_token',
+            client_id
+        )
+        goods = get_cached_catalog(
+            'https://api.moltin.com/v2/products', access_token
+        )
+    except Exception as err:
+        logger.error(err)
+        return
+    warm_image_cache(
+        'https://api.moltin.com/v2/files/',
+        get_main_image_ids(goods.get('data')),
+        access_token
+    )
+    try:
+        get_pizzeria_registry().refresh()
+    except Exception as err:
+        logger.error(err)
+
+
+async def start_application(application):
+    await set_blocking_executor(application)
+    # Batches that waited for a courier when the bot last stopped.
+    get_courier_dispatcher().restore(application.job_queue)
+
+
+async def stop_application(application):
+    await get_courier_dispatcher().flush(application.bot)
+
+
+async def set_blocking_executor(application):
+    # Handlers call the sync Elasticpath and Yandex clients through this
+    # executor: the caches in front of them are shared with the Messenger
+    # bot and are synchronous, so there is no separate async client.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+        # As many threads as pooled Elasticpath connections, so every
+        # thread can keep its connection alive.
+        max_workers=int(os.getenv(
+            'PIZZA_SHOP_TG_BLOCKING_WORKERS', get_http_pool_size()
+        )),
+        thread_name_prefix='blocking',
+    ))
+
+
+async def report_chat_lanes(context: ContextTypes.DEFAULT_TYPE):
+    context.application.update_processor.report_queue_depths()
+
+
+def add_handlers(application):
+    application.add_handler(CallbackQueryHandler(handle_users_reply))
+    application.add_handler(MessageHandler(
+        filters.TEXT | filters.LOCATION, handle_users_reply
+    ))
+    application.add_handler(CommandHandler('start', handle_users_reply))
+    application.add_handler(ShippingQueryHandler(shipping_callback))
+    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    application.add_handler(MessageHandler(
+        filters.SUCCESSFUL_PAYMENT, successful_payment_callback
+    ))
+
+
+def get_concurrent_updates():
+    concurrent_updates = os.getenv(
+        'PIZZA_SHOP_TG_CONCURRENT_UPDATES', str(CONCURRENT_UPDATES)
+    )
+    try:
+        concurrent_updates = int(concurrent_updates)
+    except ValueError:
+        concurrent_updates = -1
+    if concurrent_updates < 0:
+        raise SystemExit(
+            'PIZZA_SHOP_TG_CONCURRENT_UPDATES must be 0 or a positive '
+            f'number, got {os.getenv("PIZZA_SHOP_TG_CONCURRENT_UPDATES")!r}'
+        )
+    return concurrent_updates
+
+
+def build_application(token, concurrent_updates=None, request=None,
+                      base_url=None):
+    if concurrent_updates is None:
+        concurrent_updates = get_concurrent_updates()
+    # Updates of one chat must run in order: each reads the state the
+    # previous one wrote. One lane is the same as no lanes at all.
+    if not isinstance(concurrent_updates, ChatLaneUpdateProcessor):
+        if concurrent_updates < 0:
+            raise ValueError('concurrent_updates must not be negative')
+        if concurrent_updates > 1:
+            concurrent_updates = ChatLaneUpdateProcessor(concurrent_updates)
+        else:
+            concurrent_updates = False
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(concurrent_updates)
+        .context_types(get_context_types())
+        .post_init(start_application)
+        .post_stop(stop_application)
+    )
+    if request:
+        builder = builder.request(request)
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    add_handlers(application)
+    report_interval = int(os.getenv(
+        'PIZZA_SHOP_TG_LANE_REPORT_INTERVAL', LANE_REPORT_INTERVAL
+    ))
+    if concurrent_updates and report_interval:
+        application.job_queue.run_repeating(
+            report_chat_lanes, report_interval, first=report_interval
+        )
+    return application
+
+
 def main():
     load_dotenv()
     logging.basicConfig(level=logging.DEBUG, format=FORMAT)
-    token = os.getenv("PIZZA_SHOP_TG_BOTID")
-    updater = Updater(token)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    dispatcher.add_handler(
-        MessageHandler(Filters.text | Filters.location, handle_users_reply))
-    dispatcher.add_handler(
-        CommandHandler('start', handle_users_reply, pass_job_queue=True),
-    )
-    dispatcher.add_handler(ShippingQueryHandler(shipping_callback))
-    dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    dispatcher.add_handler(MessageHandler(
-        Filters.successful_payment, successful_payment_callback
+    threading.Thread(target=warm_caches, daemon=True).start()
+    application = build_application(
+        os.getenv('PIZZA_SHOP_TG_BOTID'),
+        base_url=os.getenv('PIZZA_SHOP_TG_BASE_URL'),
+    )
+    if os.getenv('PIZZA_SHOP_TG_MODE', 'polling') != 'webhook':
+        application.run_polling()
+        return
+    secret = os.getenv('PIZZA_SHOP_TG_WEBHOOK_SECRET')
+    if not secret:
+        raise SystemExit('Webhook mode needs PIZZA_SHOP_TG_WEBHOOK_SECRET')
+    asyncio.run(run_webhook(
+        application,
+        get_database_connection(),
+        os.getenv('PIZZA_SHOP_TG_WEBHOOK_URL'),
+        secret=secret,
     ))
-    updater.start_polling()
-    updater.idle()
 
 
 if __name__ == '__main__':
@@ -1,19 +1,30 @@
+import hashlib
 import json
 import logging
 import os
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from textwrap import dedent
 
-import redis
 import requests
 from dotenv import load_dotenv
 from flask import Flask, request
 
-from api_elasticpath import add_proudct_to_cart, get_cart, get_cart_products
-from api_elasticpath import get_catalog, get_product_detail
-from api_elasticpath import get_product_picture_url
+from api_elasticpath import get_product_detail, iter_catalog
 from api_elasticpath import get_products_by_category_slug, get_token
-from api_elasticpath import remove_products_from_cart
+from api_elasticpath import get_products_with_main_images
+from cart_mirror import add_product_to_mirrored_cart
+from cart_mirror import get_mirrored_cart_products
+from cart_mirror import remove_product_from_mirrored_cart
+from catalog_cache import invalidate_cached_products
+from database_backend import get_database_connection, get_state_store
+from image_cache import get_cached_picture_url, get_cached_picture_urls
+from image_cache import get_image_resolver, get_main_image_id
+from image_cache import get_main_image_ids, warm_image_cache
+from telegram_ingress import telegram_ingress
 
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -22,35 +33,56 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG, format=FORMAT)
 
 app = Flask(__name__)
+app.register_blueprint(telegram_ingress)
 
 LOGO_ID = '682e8af6-5d7a-4bb3-bb31-e1f1f8a858f3'
 CATEGORY_LOGO_ID = 'b3f6ee38-ce6e-4273-8ead-ef103327b44b'
 BASKET_LOGO_ID = '1e21b975-bd32-4cf1-9445-40ad420461f7'
+MENU_WORKERS = 8
+MENU_FINGERPRINTS = 'menu_fingerprints'
 
 
-def handle_users_reply(sender_id, message_text):
-    database = redis.Redis(
-        host=os.getenv('PIZZA_SHOP_DATABASE_HOST'),
-        port=os.getenv('PIZZA_SHOP_DATABASE_PORT'),
-        password=os.getenv('PIZZA_SHOP_DATABASE_PASSWORD')
+def warm_logos():
+    try:
+        access_token = get_token(
+            'https://api.moltin.com/oauth/access_token',
+            os.getenv('PIZZA_SHOP_CLIENT_ID')
+        )
+    except Exception as err:
+        logger.error(err)
+        return
+    warm_image_cache(
+        'https://api.moltin.com/v2/files/',
+        [LOGO_ID, CATEGORY_LOGO_ID, BASKET_LOGO_ID],
+        access_token
     )
+
+
+def create_app():
+    """Return the app after starting the logo warm-up, for gunicorn."""
+    threading.Thread(target=warm_logos, daemon=True).start()
+    return app
+
+
+def handle_users_reply(sender_id, message_text):
+    state_store = get_state_store('facebook_')
     states_functions = {
         'START': handle_start,
         'HANDLE_MENU': handle_order,
     }
-    recorded_state = database.get(f'facebook_{sender_id}')
+    recorded_state = state_store.get_state(sender_id)
     logger.debug(f'Handle users reply: recorded state - {recorded_state}')
     if (not recorded_state
-            or recorded_state.decode('utf-8') not in states_functions.keys()):
+            or recorded_state not in states_functions.keys()):
         user_state = 'START'
     else:
-        user_state = recorded_state.decode('utf-8')
+        user_state = recorded_state
     if message_text == '/start':
         user_state = 'START'
     logger.debug(f'User_state: {user_state}')
     state_handler = states_functions[user_state]
     next_state = state_handler(sender_id, message_text)
-    database.set(f'facebook_{sender_id}', next_state)
+    state_store.set_state(sender_id, next_state)
 
 
 @app.route('/', methods=['GET'])
@@ -71,15 +103,188 @@ def verify():
     return "Hello world", 200
 
 
+@contextmanager
+def measure_phase(timings, phase):
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.monotonic() - started_at, 3)
+
+
+def fetch_categories(access_token, timings):
+    with measure_phase(timings, 'categories'):
+        return list(iter_catalog(
+            'https://api.moltin.com/v2/categories',
+            access_token
+        ))
+
+
+def fetch_products(access_token, timings):
+    with measure_phase(timings, 'products'):
+        return get_products_with_main_images(
+            'https://api.moltin.com/v2/products',
+            access_token
+        )
+
+
+def get_category_product_ids(executor, categories, access_token):
+    category_products = {}
+    unknown_slugs = []
+    for category in categories:
+        products = (
+            (category.get('relationships') or {})
+            .get('products', {})
+            .get('data')
+        )
+        if products is None:
+            unknown_slugs.append(category.get('slug'))
+            continue
+        category_products[category.get('slug')] = [
+            product.get('id') for product in products
+        ]
+    found_categories = executor.map(
+        lambda slug: get_products_by_category_slug(
+            'https://api.moltin.com/v2/categories',
+            access_token,
+            slug
+        ),
+        unknown_slugs
+    )
+    for slug, goods in zip(unknown_slugs, found_categories):
+        logger.debug(f'Front page category: {goods}')
+        category_products[slug] = [
+            product.get('id')
+            for product in goods[0].get('relationships').get('products')
+            .get('data')
+        ]
+    return category_products
+
+
+def build_category_menu(products, categories, picture_urls):
+    pizzas = [
+        {
+            'title': 'Меню',
+            'image_url': picture_urls[LOGO_ID],
+            'subtitle': 'Здесь вы можете выбрать один из вариантов',
+            'buttons': [
+                {
+                    'type': 'postback',
+                    'title': 'Корзина',
+                    'payload': json.dumps(
+                        {'basket': 'recipient_id'}
+                    ),
+                },
+                {
+                    'type': 'postback',
+                    'title': 'Акции',
+                    'payload': json.dumps({"category": 'front_page'}),
+                },
+                {
+                    'type': 'postback',
+                    'title': 'Сделать заказ',
+                    'payload': 'DEVELOPER_DEFINED_PAYLOAD',
+                },
+            ],
+        }
+    ]
+    for full_pizza in products:
+        title = f'''
+            "{full_pizza.get('name')} "
+            "({full_pizza.get('price')[0].get('amount')} руб.)"
+        '''
+        pizzas.append(
+            {
+                'title': dedent(title),
+                'image_url': picture_urls.get(
+                    get_main_image_id(full_pizza)
+                ),
+                'subtitle': full_pizza.get('description'),
+                'buttons': [
+                    {
+                        'type': 'postback',
+                        'title': 'Добавить в корзину',
+                        'payload': json.dumps(
+                            {"add_to_basket": full_pizza.get('id')}
+                        ),
+                    },
+                ],
+            }
+        )
+
+    category_buttons = [
+        {
+            'type': 'postback',
+            'title': category.get('name'),
+            'payload': json.dumps({"category": category.get('slug')}),
+        } for category in categories
+    ]
+    logger.debug(f'Categroy_buttons {category_buttons}')
+    pizzas.append(
+        {
+            'title': 'Не нашли нужную пиццу?',
+            'image_url': picture_urls[CATEGORY_LOGO_ID],
+            'subtitle':
+                'Остальные пиццы можно посмотреть в одной из категорий',
+            'buttons': random.sample(
+                category_buttons, min(3, len(category_buttons))
+            ),
+        }
+    )
+    return pizzas
+
+
+def get_menu_fingerprint(products, categories):
+    fingerprint_source = {
+        'logos': [LOGO_ID, CATEGORY_LOGO_ID],
+        'categories': [
+            [category.get('slug'), category.get('name')]
+            for category in categories
+        ],
+        'products': [
+            [
+                product.get('id'),
+                (product.get('meta') or {})
+                .get('timestamps', {})
+                .get('updated_at'),
+                product.get('price'),
+                get_main_image_id(product),
+            ]
+            for product in products
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint_source, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def get_changed_menus(database, fingerprints, force=False):
+    menus = list(fingerprints)
+    pipeline = database.pipeline(transaction=False)
+    pipeline.hgetall(MENU_FINGERPRINTS)
+    for menu in menus:
+        pipeline.exists(menu)
+    stored_fingerprints, *menus_exist = pipeline.execute()
+    stored_fingerprints = {
+        menu.decode('utf-8'): fingerprint.decode('utf-8')
+        for menu, fingerprint in stored_fingerprints.items()
+    }
+    removed_menus = set(stored_fingerprints) - set(menus)
+    if removed_menus:
+        database.hdel(MENU_FINGERPRINTS, *removed_menus)
+    return [
+        menu for menu, menu_exists in zip(menus, menus_exist)
+        if force
+        or not menu_exists
+        or stored_fingerprints.get(menu) != fingerprints[menu]
+    ]
+
+
 @app.route('/update', methods=['POST'])
 def update_webhook():
     data = request.get_json()
     logger.debug(f'findme {data}')
-    database = redis.Redis(
-        host=os.getenv('PIZZA_SHOP_DATABASE_HOST'),
-        port=os.getenv('PIZZA_SHOP_DATABASE_PORT'),
-        password=os.getenv('PIZZA_SHOP_DATABASE_PASSWORD')
-    )
+    database = get_database_connection()
     client_id = os.getenv('PIZZA_SHOP_CLIENT_ID')
     logger.debug(f'Client_id: {client_id}')
     access_token = get_token(
@@ -87,106 +292,94 @@ def update_webhook():
         client_id
     )
     logger.debug(f'access_token: {access_token}')
-    categories = get_catalog(
-        'https://api.moltin.com/v2/categories',
-        access_token
-    )
-    menus = [category.get("slug") for category in categories.get("data")]
-    logger.debug(f'Our current categories: {menus}')
-    for menu in menus:
-        goods = get_products_by_category_slug(
-            'https://api.moltin.com/v2/categories',
-            access_token,
-            menu
-        )
-        logger.debug(f'Front page category: {goods}')
-        picture_url = get_product_picture_url(
-            'https://api.moltin.com/v2/files/',
-            LOGO_ID,
-            access_token
+    timings = {}
+    workers = int(os.getenv('PIZZA_SHOP_MENU_WORKERS', MENU_WORKERS))
+    with measure_phase(timings, 'total'), \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        products_future = executor.submit(
+            fetch_products, access_token, timings
         )
-        pizzas = [
-            {
-                'title': 'Меню',
-                'image_url': picture_url,
-                'subtitle': 'Здесь вы можете выбрать один из вариантов',
-                'buttons': [
-                    {
-                        'type': 'postback',
-                        'title': 'Корзина',
-                        'payload': json.dumps(
-                            {'basket': 'recipient_id'}
-                        ),
-                    },
-                    {
-                        'type': 'postback',
-                        'title': 'Акции',
-                        'payload': json.dumps({"category": 'front_page'}),
-                    },
-                    {
-                        'type': 'postback',
-                        'title': 'Сделать заказ',
-                        'payload': 'DEVELOPER_DEFINED_PAYLOAD',
-                    },
-                ],
+        categories = fetch_categories(access_token, timings)
+        menus = [category.get("slug") for category in categories]
+        logger.debug(f'Our current categories: {menus}')
+        with measure_phase(timings, 'category_products'):
+            category_products = get_category_product_ids(
+                executor, categories, access_token
+            )
+        products, main_images = products_future.result()
+
+        with measure_phase(timings, 'missing_products'):
+            missing_ids = {
+                product_id
+                for product_ids in category_products.values()
+                for product_id in product_ids
+                if product_id not in products
             }
-        ]
-        for pizza in goods[0].get('relationships').get('products').get('data'):
-            full_pizza = get_product_detail(
-                'https://api.moltin.com/v2/products/',
-                pizza.get('id'),
-                access_token
+            missing_products = executor.map(
+                lambda product_id: get_product_detail(
+                    'https://api.moltin.com/v2/products/',
+                    product_id,
+                    access_token
+                ),
+                missing_ids
             )
-            full_pizza_img = full_pizza.get('relationships').get('main_image')
-            picture_url = get_product_picture_url(
-                'https://api.moltin.com/v2/files/',
-                full_pizza_img.get('data').get('id'),
-                access_token
+            for product in missing_products:
+                products[product.get('id')] = product
+
+        with measure_phase(timings, 'fingerprints'):
+            category_menus = {
+                menu: [
+                    products[product_id]
+                    for product_id in category_products[menu]
+                ]
+                for menu in menus
+            }
+            fingerprints = {
+                menu: get_menu_fingerprint(menu_products, categories)
+                for menu, menu_products in category_menus.items()
+            }
+            changed_menus = get_changed_menus(
+                database, fingerprints, force=bool(request.args.get('force'))
             )
-            title = f'''
-                "{full_pizza.get('name')} "
-                "({full_pizza.get('price')[0].get('amount')} руб.)"
-            '''
-            pizzas.append(
-                {
-                    'title': dedent(title),
-                    'image_url': picture_url,
-                    'subtitle': full_pizza.get('description'),
-                    'buttons': [
-                        {
-                            'type': 'postback',
-                            'title': 'Добавить в корзину',
-                            'payload': json.dumps(
-                                {"add_to_basket": full_pizza.get('id')}
-                            ),
-                        },
-                    ],
-                }
+        logger.info(f'Changed menus: {changed_menus}')
+        if changed_menus:
+            with measure_phase(timings, 'pictures'):
+                get_image_resolver().remember(main_images)
+                menu_products = [
+                    product
+                    for menu in changed_menus
+                    for product in category_menus[menu]
+                ]
+                picture_ids = [LOGO_ID, CATEGORY_LOGO_ID]
+                picture_ids.extend(
+                    image_id for image_id in get_main_image_ids(menu_products)
+                    if image_id not in main_images
+                )
+                picture_urls = dict(main_images)
+                picture_urls.update(get_cached_picture_urls(
+                    'https://api.moltin.com/v2/files/',
+                    picture_ids,
+                    access_token
+                ))
+
+            with measure_phase(timings, 'templates'):
+                pipeline = database.pipeline(transaction=False)
+                for menu in changed_menus:
+                    pizzas = build_category_menu(
+                        category_menus[menu], categories, picture_urls
+                    )
+                    pipeline.set(menu, json.dumps(pizzas))
+                pipeline.hset(MENU_FINGERPRINTS, mapping={
+                    menu: fingerprints[menu] for menu in changed_menus
+                })
+                pipeline.execute()
+            # Only the products of changed menus can have changed, so the
+            # cached details of every other product stay warm.
+            invalidate_cached_products(
+                'https://api.moltin.com/v2/products',
+                {product.get('id') for product in menu_products}
             )
-        picture_url = get_product_picture_url(
-            'https://api.moltin.com/v2/files/',
-            CATEGORY_LOGO_ID,
-            access_token
-        )
-
-        category_buttons = [
-            {
-                'type': 'postback',
-                'title': category.get('name'),
-                'payload': json.dumps({"category": category.get('slug')}),
-            } for category in categories.get('data')
-        ]
-        logger.debug(f'Categroy_buttons {category_buttons}')
-        pizzas.append(
-            {
-                'title': 'Не нашли нужную пиццу?',
-                'image_url': picture_url,
-                'subtitle':
-                    'Остальные пиццы можно посмотреть в одной из категорий',
-                'buttons': random.sample(category_buttons, 3),
-            }
-        )
-        database.set(menu, json.dumps(pizzas))
+    logger.info(f'Menu rebuild timings: {timings}')
     return 'ok', 200
 
 
@@ -253,18 +446,12 @@ def handle_order(recipient_id, message_text):
             'https://api.moltin.com/oauth/access_token',
             client_id
         )
-        cart = get_cart(
+        remove_product_from_mirrored_cart(
             'https://api.moltin.com/v2/carts/',
+            product_to_remove,
             access_token,
             str(recipient_id)
         )
-        if cart:
-            remove_products_from_cart(
-                'https://api.moltin.com/v2/carts/',
-                product_to_remove,
-                access_token,
-                str(recipient_id)
-            )
         get_basket_menu(recipient_id)
         return 'HANDLE_MENU'
     if message_text_string.get('add_to_basket', None):
@@ -274,34 +461,28 @@ def handle_order(recipient_id, message_text):
             'https://api.moltin.com/oauth/access_token',
             client_id
         )
-        cart = get_cart(
+        add_product_to_mirrored_cart(
             'https://api.moltin.com/v2/carts/',
+            message_text_string.get('add_to_basket', None),
+            1,
             access_token,
             str(recipient_id)
         )
-        if cart:
-            add_proudct_to_cart(
-                'https://api.moltin.com/v2/carts/',
-                message_text_string.get('add_to_basket', None),
-                1,
-                access_token,
-                str(recipient_id)
-            )
-            json_data = {
-                'recipient': {
-                    'id': recipient_id,
-                },
-                'message': {
-                    'text': 'Пицца добавлена в корзину'
-                }
+        json_data = {
+            'recipient': {
+                'id': recipient_id,
+            },
+            'message': {
+                'text': 'Пицца добавлена в корзину'
             }
-            logger.debug(json_data)
-            params = {"access_token": os.environ["PIZZA_SHOP_FB_TOKEN"]}
-            response = requests.post(
-                "https://graph.facebook.com/v2.6/me/messages",
-                params=params, json=json_data
-            )
-            response.raise_for_status()
+        }
+        logger.debug(json_data)
+        params = {"access_token": os.environ["PIZZA_SHOP_FB_TOKEN"]}
+        response = requests.post(
+            "https://graph.facebook.com/v2.6/me/messages",
+            params=params, json=json_data
+        )
+        response.raise_for_status()
         get_basket_menu(recipient_id)
         return 'HANDLE_MENU'
     return 'HANDLE_MENU'
@@ -333,34 +514,28 @@ def handle_start(recipient_id, message_text):
             'https://api.moltin.com/oauth/access_token',
             client_id
         )
-        cart = get_cart(
+        add_product_to_mirrored_cart(
             'https://api.moltin.com/v2/carts/',
+            message_text_string.get('add_to_basket', None),
+            1,
             access_token,
             str(recipient_id)
         )
-        if cart:
-            add_proudct_to_cart(
-                'https://api.moltin.com/v2/carts/',
-                message_text_string.get('add_to_basket', None),
-                1,
-                access_token,
-                str(recipient_id)
-            )
-            json_data = {
-                'recipient': {
-                    'id': recipient_id,
-                },
-                'message': {
-                    'text': 'Пицца добавлена в корзину'
-                }
+        json_data = {
+            'recipient': {
+                'id': recipient_id,
+            },
+            'message': {
+                'text': 'Пицца добавлена в корзину'
             }
-            logger.debug(json_data)
-            params = {"access_token": os.environ["PIZZA_SHOP_FB_TOKEN"]}
-            response = requests.post(
-                "https://graph.facebook.com/v2.6/me/messages",
-                params=params, json=json_data
-            )
-            response.raise_for_status()
+        }
+        logger.debug(json_data)
+        params = {"access_token": os.environ["PIZZA_SHOP_FB_TOKEN"]}
+        response = requests.post(
+            "https://graph.facebook.com/v2.6/me/messages",
+            params=params, json=json_data
+        )
+        response.raise_for_status()
         return 'START'
     elif message_text_string.get('basket', None):
         logger.debug('BASKET')
@@ -372,11 +547,7 @@ def handle_start(recipient_id, message_text):
 
 
 def send_menu(menu, recipient_id):
-    database = redis.Redis(
-        host=os.getenv('PIZZA_SHOP_DATABASE_HOST'),
-        port=os.getenv('PIZZA_SHOP_DATABASE_PORT'),
-        password=os.getenv('PIZZA_SHOP_DATABASE_PASSWORD')
-    )
+    database = get_database_connection()
     params = {
         'access_token': os.getenv('PIZZA_SHOP_FB_TOKEN'),
     }
@@ -417,13 +588,13 @@ def get_basket_menu(recipient_id):
         client_id
     )
     logger.debug(f'access_token: {access_token}')
-    goods = get_cart_products(
+    goods = get_mirrored_cart_products(
         'https://api.moltin.com/v2/carts/',
         access_token,
         str(recipient_id)
     )
 
-    picture_url = get_product_picture_url(
+    picture_url = get_cached_picture_url(
         'https://api.moltin.com/v2/files/',
         BASKET_LOGO_ID,
         access_token
@@ -508,4 +679,4 @@ def get_basket_menu(recipient_id):
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
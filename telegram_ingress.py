@@ -0,0 +1,208 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import time
+import uuid
+from functools import partial
+
+from flask import Blueprint, request
+from redis.exceptions import RedisError, WatchError
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from database_backend import get_database_connection
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_UPDATES_QUEUE = 'telegram_updates'
+ACKNOWLEDGE_GROUP = 1000
+TELEGRAM_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+INGRESS_POLL_TIMEOUT = 5
+CONSUMER_LEASE = 30
+
+telegram_ingress = Blueprint('telegram_ingress', __name__)
+
+
+@telegram_ingress.route('/telegram', methods=['POST'])
+def receive_telegram_update():
+    # Acknowledge as soon as the update is queued; the bot process does
+    # the work, so Telegram never waits for Elasticpath.
+    # Without a secret anyone could post updates, fake payments included.
+    secret = os.getenv('PIZZA_SHOP_TG_WEBHOOK_SECRET')
+    if not secret or not hmac.compare_digest(
+        request.headers.get(TELEGRAM_SECRET_HEADER, ''), secret
+    ):
+        return 'forbidden', 403
+    try:
+        get_database_connection().rpush(
+            TELEGRAM_UPDATES_QUEUE, request.get_data()
+        )
+    except RedisError as err:
+        logger.error(f'Could not queue Telegram update: {err}')
+        return 'unavailable', 503
+    return 'ok', 200
+
+
+class UpdateConsumer(object):
+    """One bot process reading the queued Telegram updates.
+
+    Taken updates wait in the consumer's own processing list until their
+    handlers have run. While the consumer is alive it renews a lease;
+    the lists of consumers whose lease has expired are moved back onto
+    the queue, under a lock, by whichever consumer checks first.
+
+    Updates of one chat are handled in order only within one consumer,
+    so several consumers on one queue may reorder a chat's updates.
+    """
+
+    def __init__(self, database, queue=TELEGRAM_UPDATES_QUEUE,
+                 consumer_id=None, lease=CONSUMER_LEASE):
+        self.database = database
+        self.queue = queue
+        self.consumer_id = consumer_id or uuid.uuid4().hex
+        self.lease = lease
+        self.processing = self._get_processing_key(self.consumer_id)
+
+    def heartbeat(self):
+        pipeline = self.database.pipeline(transaction=False)
+        pipeline.set(
+            self._get_lease_key(self.consumer_id), 1, ex=self.lease
+        )
+        pipeline.sadd(self._get_consumers_key(), self.consumer_id)
+        pipeline.execute()
+        return self.requeue_expired()
+
+    def take(self, timeout):
+        return self.database.blmove(
+            self.queue, self.processing, timeout, 'LEFT', 'RIGHT'
+        )
+
+    def acknowledge(self, item):
+        self.database.lrem(self.processing, 1, item)
+
+    def requeue_expired(self):
+        lock_key = self._get_lock_key()
+        if not self.database.set(
+            lock_key, self.consumer_id, nx=True, ex=self.lease
+        ):
+            return 0
+        requeued = 0
+        try:
+            for consumer_id in self.database.smembers(
+                self._get_consumers_key()
+            ):
+                consumer_id = consumer_id.decode('utf-8')
+                if not self.database.exists(self._get_lease_key(consumer_id)):
+                    requeued += self._requeue(consumer_id)
+        finally:
+            self._unlock(lock_key)
+        if requeued:
+            logger.debug(
+                f'Requeued {requeued} unacknowledged Telegram updates'
+            )
+        return requeued
+
+    def release(self):
+        """Give the lease up so unfinished updates are queued again now."""
+        self.database.delete(self._get_lease_key(self.consumer_id))
+        return self.requeue_expired()
+
+    def _requeue(self, consumer_id):
+        processing = self._get_processing_key(consumer_id)
+        requeued = 0
+        while self.database.lmove(processing, self.queue, 'RIGHT', 'LEFT'):
+            requeued += 1
+        self.database.srem(self._get_consumers_key(), consumer_id)
+        return requeued
+
+    def _unlock(self, lock_key):
+        with self.database.pipeline() as pipeline:
+            try:
+                pipeline.watch(lock_key)
+                if pipeline.get(lock_key) != self.consumer_id.encode('utf-8'):
+                    return
+                pipeline.multi()
+                pipeline.delete(lock_key)
+                pipeline.execute()
+            except WatchError:
+                pass
+
+    def _get_processing_key(self, consumer_id):
+        return f'{self.queue}:processing:{consumer_id}'
+
+    def _get_lease_key(self, consumer_id):
+        return f'{self.queue}:lease:{consumer_id}'
+
+    def _get_consumers_key(self):
+        return f'{self.queue}:consumers'
+
+    def _get_lock_key(self):
+        return f'{self.queue}:requeue'
+
+
+async def consume_updates(application, consumer,
+                          timeout=INGRESS_POLL_TIMEOUT):
+    """Feed queued updates to the application until cancelled."""
+    pending = {}
+    application.add_handler(
+        TypeHandler(Update, partial(acknowledge_update, consumer, pending)),
+        group=ACKNOWLEDGE_GROUP,
+    )
+    heartbeat_at = 0
+    while True:
+        try:
+            if time.monotonic() >= heartbeat_at:
+                await asyncio.to_thread(consumer.heartbeat)
+                heartbeat_at = time.monotonic() + consumer.lease / 3
+            item = await asyncio.to_thread(consumer.take, timeout)
+        except RedisError as err:
+            logger.error(f'Could not read Telegram updates: {err}')
+            await asyncio.sleep(timeout)
+            continue
+        if not item:
+            continue
+        try:
+            update = Update.de_json(json.loads(item), application.bot)
+        except ValueError as err:
+            logger.error(f'Dropping malformed Telegram update: {err}')
+            await asyncio.to_thread(consumer.acknowledge, item)
+            continue
+        pending[update.update_id] = item
+        await application.update_queue.put(update)
+
+
+async def acknowledge_update(consumer, pending, update, context):
+    item = pending.pop(update.update_id, None)
+    if not item:
+        return
+    try:
+        await asyncio.to_thread(consumer.acknowledge, item)
+    except RedisError as err:
+        logger.error(f'Could not acknowledge Telegram update: {err}')
+
+
+async def run_webhook(application, database, webhook_url, secret):
+    if not secret:
+        raise ValueError('Webhook mode needs a secret token')
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            webhook_url,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        consumer = UpdateConsumer(database)
+        try:
+            await consume_updates(application, consumer)
+        finally:
+            await application.stop()
+            try:
+                await asyncio.to_thread(consumer.release)
+            except RedisError as err:
+                logger.error(f'Could not release Telegram updates: {err}')
+            if application.post_stop:
+                await application.post_stop(application)
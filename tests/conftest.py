@@ -0,0 +1,75 @@
+import random
+from bisect import bisect_right
+
+import pytest
+from geopy.distance import distance
+
+from api_yandex import Address
+from pizzeria_distances import DELIVERY_TIER_BOUNDARIES
+from pizzeria_registry import Pizzeria
+
+MOSCOW = (55.75, 37.62)
+
+
+def make_pizzerias(rng, count):
+    pizzerias = []
+    for position in range(count):
+        point = distance(meters=rng.uniform(0, 15000)).destination(
+            MOSCOW, rng.uniform(0, 360)
+        )
+        pizzerias.append(Pizzeria(
+            id=str(position),
+            alias=f'pizzeria-{position}',
+            address=f'address {position}',
+            latitude=point.latitude,
+            longitude=point.longitude,
+            delivery_tg_id=None,
+        ))
+    return pizzerias
+
+
+def make_customers(rng, pizzerias, count):
+    customers = []
+    for _ in range(count):
+        point = distance(meters=rng.uniform(0, 30000)).destination(
+            MOSCOW, rng.uniform(0, 360)
+        )
+        customers.append(Address(point.latitude, point.longitude))
+    # Customers right at the tier boundaries of some pizzeria.
+    for boundary in DELIVERY_TIER_BOUNDARIES:
+        for offset in (-1, 0, 1):
+            pizzeria = rng.choice(pizzerias)
+            point = distance(meters=boundary + offset).destination(
+                (pizzeria.latitude, pizzeria.longitude), rng.uniform(0, 360)
+            )
+            customers.append(Address(point.latitude, point.longitude))
+    return customers
+
+
+def get_naive_closest(coords, pizzerias):
+    meters, position = min(
+        (
+            distance(
+                (coords.latitude, coords.longitude),
+                (pizzeria.latitude, pizzeria.longitude)
+            ).m,
+            position,
+        ) for position, pizzeria in enumerate(pizzerias)
+    )
+    return meters, position, bisect_right(DELIVERY_TIER_BOUNDARIES, meters)
+
+
+@pytest.fixture(scope='session')
+def pizzerias():
+    return make_pizzerias(random.Random(7), 25)
+
+
+@pytest.fixture(scope='session')
+def customers(pizzerias):
+    return make_customers(random.Random(11), pizzerias, 300)
+
+
+@pytest.fixture(scope='session')
+def expected(pizzerias, customers):
+    """Meters, position and tier of the nearest pizzeria by a geopy loop."""
+    return [get_naive_closest(coords, pizzerias) for coords in customers]
@@ -0,0 +1,186 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import api_elasticpath
+from api_elasticpath import TokenManager
+
+TOKEN_URL = 'https://api.moltin.com/oauth/access_token'
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition was not met in time')
+        time.sleep(0.01)
+
+
+class FakeTokenClient(object):
+
+    def __init__(self, lifetime=3600, delay=0):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.requests = []
+
+    def request_token(self, url, data):
+        self.requests.append(data)
+        time.sleep(self.delay)
+        return {
+            'access_token': f'token-{len(self.requests)}',
+            'expires': time.time() + self.lifetime,
+        }
+
+
+def get_tokens_at_once(manager, count=8):
+    start = threading.Barrier(count)
+    tokens = []
+
+    def get_token():
+        start.wait()
+        tokens.append(manager.get_token(TOKEN_URL, 'client'))
+
+    threads = [threading.Thread(target=get_token) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return tokens
+
+
+def test_concurrent_callers_share_one_token_request():
+    client = FakeTokenClient(delay=0.05)
+    manager = TokenManager(client=client)
+    assert get_tokens_at_once(manager) == ['token-1'] * 8
+    assert len(client.requests) == 1
+    manager.stop()
+
+
+def test_expiring_token_is_served_while_refreshing():
+    client = FakeTokenClient(lifetime=10)
+    manager = TokenManager(client=client, refresh_margin=60)
+    assert manager.get_token(TOKEN_URL, 'client') == 'token-1'
+    # Inside the refresh margin the old token is still returned.
+    assert manager.get_token(TOKEN_URL, 'client') == 'token-1'
+    wait_for(lambda: len(client.requests) == 2)
+    manager.stop()
+
+
+def test_token_is_shared_through_redis():
+    database = fakeredis.FakeRedis()
+    client = FakeTokenClient()
+    first = TokenManager(client=client, database=database)
+    second = TokenManager(client=client, database=database)
+    assert get_tokens_at_once(first, 4) == ['token-1'] * 4
+    assert second.get_token(TOKEN_URL, 'client') == 'token-1'
+    assert len(client.requests) == 1
+    first.stop()
+    second.stop()
+
+
+def test_refresh_is_scheduled_before_expiry():
+    client = FakeTokenClient(lifetime=60.1)
+    manager = TokenManager(client=client, refresh_margin=60)
+    manager.get_token(TOKEN_URL, 'client')
+    wait_for(lambda: len(client.requests) >= 2)
+    manager.stop()
+
+
+def test_secret_selects_client_credentials():
+    client = FakeTokenClient()
+    manager = TokenManager(client=client)
+    manager.get_token(TOKEN_URL, 'client', 'secret')
+    assert client.requests == [{
+        'client_id': 'client',
+        'client_secret': 'secret',
+        'grant_type': 'client_credentials',
+    }]
+    manager.stop()
+
+
+@pytest.mark.parametrize('getter, name', [
+    ('get_token_manager', '_token_manager'),
+    ('get_client', '_client'),
+])
+def test_concurrent_first_calls_share_one_instance(monkeypatch, getter,
+                                                   name):
+    monkeypatch.setattr(api_elasticpath, name, None)
+    start = threading.Barrier(8)
+    instances = []
+
+    def get_instance():
+        start.wait()
+        instances.append(getattr(api_elasticpath, getter)())
+
+    threads = [threading.Thread(target=get_instance) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(instance) for instance in instances}) == 1
+
+
+class FakeResponse(object):
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeCatalog(object):
+    """Pages through entry ids like Elasticpath, capping page[limit]."""
+
+    url = 'https://api.moltin.com/v2/products'
+
+    def __init__(self, total, cap=100):
+        self.total = total
+        self.cap = cap
+        self.requests = []
+
+    def request(self, method, url, endpoint='default', params=None,
+                **kwargs):
+        if params is None:
+            _, query = url.split('?')
+            params = dict(part.split('=') for part in query.split('&'))
+        limit = min(int(params['page[limit]']), self.cap)
+        offset = int(params['page[offset]'])
+        self.requests.append(offset)
+        next_offset = offset + limit
+        return FakeResponse({
+            'data': [
+                {'id': entry_id}
+                for entry_id in range(offset, min(next_offset, self.total))
+            ],
+            'meta': {'results': {'total': self.total}},
+            'links': {
+                'next': (
+                    f'{self.url}?page[limit]={limit}'
+                    f'&page[offset]={next_offset}'
+                ),
+            },
+        })
+
+
+@pytest.mark.parametrize('page_size', [25, 100, 250])
+@pytest.mark.parametrize('total', [0, 99, 100, 101, 340])
+def test_pages_cover_the_whole_catalog(monkeypatch, page_size, total):
+    client = api_elasticpath.ElasticpathClient()
+    catalog = FakeCatalog(total)
+    monkeypatch.setattr(client, 'request', catalog.request)
+    entries = list(client.iter_entries(catalog.url, 'token', page_size))
+    assert [entry['id'] for entry in entries] == list(range(total))
+    fetched = client.fetch_all_pages(catalog.url, 'token', page_size)
+    assert [entry['id'] for entry in fetched] == list(range(total))
+
+
+def test_server_cap_below_page_size_is_followed(monkeypatch):
+    client = api_elasticpath.ElasticpathClient()
+    catalog = FakeCatalog(120, cap=50)
+    monkeypatch.setattr(client, 'request', catalog.request)
+    fetched = client.fetch_all_pages(catalog.url, 'token', 100)
+    assert [entry['id'] for entry in fetched] == list(range(120))
+    assert sorted(catalog.requests) == [0, 50, 100]
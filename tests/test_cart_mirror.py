@@ -0,0 +1,106 @@
+import json
+import threading
+
+import fakeredis
+import pytest
+
+import cart_mirror
+from cart_mirror import CartMirror
+
+CART_URL = 'https://api.moltin.com/v2/carts'
+
+
+class FakeCarts(object):
+    """Elasticpath carts whose reads can be held until released."""
+
+    def __init__(self):
+        self.products = {}
+        self.reads = 0
+        self.read_started = threading.Event()
+        self.release_read = threading.Event()
+        self.release_read.set()
+
+    def get_cart_products(self, url, access_token, user_id):
+        self.reads += 1
+        products = list(self.products.get(user_id, []))
+        self.read_started.set()
+        self.release_read.wait(2)
+        return products
+
+    def add_product(self, url, product_id, quantity, access_token, user_id):
+        self.products.setdefault(user_id, []).append(product_id)
+        return list(self.products[user_id])
+
+
+@pytest.fixture
+def carts(monkeypatch):
+    carts = FakeCarts()
+    monkeypatch.setattr(
+        cart_mirror, 'get_cart_products', carts.get_cart_products
+    )
+    monkeypatch.setattr(cart_mirror, 'add_proudct_to_cart', carts.add_product)
+    return carts
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def mirror(request):
+    if request.param == 'memory':
+        return CartMirror()
+    return CartMirror(database=fakeredis.FakeRedis())
+
+
+def test_reads_are_served_from_the_mirror(carts, mirror):
+    mirror.add_product(CART_URL, 'pizza', 1, 'token', 42)
+    assert mirror.get_cart_products(CART_URL, 'token', 42) == ['pizza']
+    assert carts.reads == 0
+
+
+def test_stale_reconcile_does_not_overwrite_a_newer_cart(carts, mirror):
+    carts.release_read.clear()
+    reconcile = threading.Thread(
+        target=mirror.reconcile, args=(CART_URL, 'token', 42)
+    )
+    reconcile.start()
+    carts.read_started.wait(2)
+    # The cart changes while the reconcile still holds the old copy.
+    mirror.add_product(CART_URL, 'pizza', 1, 'token', 42)
+    carts.release_read.set()
+    reconcile.join()
+    assert mirror.get_cart_products(CART_URL, 'token', 42) == ['pizza']
+
+
+def test_older_mutation_does_not_overwrite_a_newer_one(carts, mirror):
+    first = mirror._next_sequence(42)
+    second = mirror._next_sequence(42)
+    mirror._write(42, ['pizza', 'cola'], second)
+    mirror._write(42, ['pizza'], first)
+    assert mirror.get_cart_products(CART_URL, 'token', 42) == [
+        'pizza', 'cola'
+    ]
+
+
+def test_write_retries_after_a_concurrent_change(carts, monkeypatch):
+    server = fakeredis.FakeServer()
+    database = fakeredis.FakeRedis(server=server)
+    other = fakeredis.FakeRedis(server=server)
+    mirror = CartMirror(database=database)
+    sequence = mirror._next_sequence(42)
+    compare_and_set = cart_mirror.is_newer
+    calls = []
+
+    def interfere(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            # Another process mirrors a newer cart between WATCH and EXEC.
+            other.incr('cart_mirror:42:sequence')
+            other.set('cart_mirror:42', json.dumps({
+                'products': ['cola'],
+                'synced_at': 0,
+                'sequence': sequence + 1,
+            }))
+        return compare_and_set(*args)
+
+    monkeypatch.setattr(cart_mirror, 'is_newer', interfere)
+    mirror._write(42, ['pizza'], sequence)
+    assert len(calls) == 2
+    assert json.loads(database.get('cart_mirror:42'))['products'] == ['cola']
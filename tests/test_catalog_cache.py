@@ -0,0 +1,114 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import catalog_cache
+from catalog_cache import CatalogCache
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition was not met in time')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_cache(server, **kwargs):
+    return CatalogCache(
+        database=fakeredis.FakeRedis(server=server), **kwargs
+    )
+
+
+def test_fresh_entries_are_not_reloaded():
+    cache = CatalogCache()
+    loads = []
+    for _ in range(3):
+        assert cache.get('products', lambda: loads.append(1) or 'v1') == 'v1'
+    assert len(loads) == 1
+    assert cache.stats['hits'] == 2
+
+
+def test_stale_entries_are_served_while_one_refresh_runs():
+    cache = CatalogCache(ttl=0.01)
+    cache.get('products', lambda: 'v1')
+    time.sleep(0.02)
+    release = threading.Event()
+    loads = []
+
+    def load():
+        loads.append(1)
+        release.wait(2)
+        return 'v2'
+
+    assert cache.get('products', load) == 'v1'
+    assert cache.get('products', load) == 'v1'
+    release.set()
+    wait_for(lambda: cache.stats['refreshes'] == 1)
+    assert len(loads) == 1
+    assert cache.get('products', load) == 'v2'
+
+
+def test_entries_are_shared_through_redis(server):
+    first = make_cache(server)
+    second = make_cache(server)
+    first.get('products', lambda: 'v1')
+    assert second.get('products', lambda: 'v2') == 'v1'
+
+
+def test_invalidate_keys_leaves_other_entries(server):
+    cache = make_cache(server)
+    cache.get('catalog:products', lambda: 'list')
+    cache.get('product:1', lambda: 'one')
+    cache.get('product:2', lambda: 'two')
+    cache.invalidate_keys(['catalog:products', 'product:1'])
+    assert cache.get('catalog:products', lambda: 'new list') == 'new list'
+    assert cache.get('product:1', lambda: 'new one') == 'new one'
+    assert cache.get('product:2', lambda: 'new two') == 'two'
+
+
+def test_invalidation_reaches_other_processes(server):
+    first = make_cache(server)
+    second = make_cache(server)
+    first.subscribe()
+    second.subscribe()
+    wait_for(lambda: server.connected and all(
+        cache.database.pubsub_numsub(cache.channel)[0][1] == 2
+        for cache in (first, second)
+    ))
+    first.get('product:1', lambda: 'one')
+    first.get('product:2', lambda: 'two')
+    second.get('product:1', lambda: 'unused')
+    second.get('product:2', lambda: 'unused')
+    first.invalidate_keys(['product:1'])
+    wait_for(lambda: 'product:1' not in second._entries)
+    assert 'product:2' in second._entries
+
+
+def test_concurrent_first_calls_share_one_cache(monkeypatch):
+    monkeypatch.setattr(catalog_cache, '_catalog_cache', None)
+    subscriptions = []
+    monkeypatch.setattr(
+        CatalogCache, 'subscribe', lambda cache: subscriptions.append(cache)
+    )
+    start = threading.Barrier(8)
+    caches = []
+
+    def get_cache():
+        start.wait()
+        caches.append(catalog_cache.get_catalog_cache())
+
+    threads = [threading.Thread(target=get_cache) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(cache) for cache in caches}) == 1
+    assert len(subscriptions) == 1
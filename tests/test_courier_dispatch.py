@@ -0,0 +1,41 @@
+import random
+
+import pytest
+
+from courier_dispatch import (get_distance_matrix, get_route_length,
+                              order_nearest_neighbour, plan_route)
+
+MOSCOW = (55.75, 37.62)
+
+
+def make_stops(rng, count):
+    return [
+        (
+            MOSCOW[0] + rng.uniform(-0.1, 0.1),
+            MOSCOW[1] + rng.uniform(-0.2, 0.2),
+        ) for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_plan_route_is_never_longer_than_nearest_neighbour(seed):
+    rng = random.Random(seed)
+    stops = make_stops(rng, rng.randint(2, 15))
+    route, meters = plan_route(MOSCOW, stops)
+    distances = get_distance_matrix([MOSCOW, *stops]).tolist()
+    greedy = get_route_length(distances, order_nearest_neighbour(distances))
+    assert sorted(route) == list(range(len(stops)))
+    assert meters <= greedy + 1e-6
+    assert meters == pytest.approx(get_route_length(
+        distances, [0, *(position + 1 for position in route)]
+    ))
+
+
+def test_plan_route_without_stops():
+    assert plan_route(MOSCOW, []) == ([], 0)
+
+
+def test_plan_route_with_one_stop():
+    route, meters = plan_route(MOSCOW, [(55.76, 37.62)])
+    assert route == [0]
+    assert meters == pytest.approx(1113, abs=5)
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import database_backend
+from database_backend import StateStore, get_state_store
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition was not met in time')
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_store(server, **kwargs):
+    return StateStore(fakeredis.FakeRedis(server=server), **kwargs)
+
+
+def test_states_round_trip_without_cache(server):
+    store = make_store(server, prefix='telegram_')
+    assert store.get_state(1) is None
+    store.set_state(1, 'HANDLE_MENU')
+    assert store.get_state(1) == 'HANDLE_MENU'
+    assert store.database.get('telegram_1') == b'HANDLE_MENU'
+
+
+def test_cache_evicts_least_recently_used(server):
+    store = make_store(server, cache_size=2)
+    store.set_state(1, 'A')
+    store.set_state(2, 'B')
+    store.get_state(1)
+    store.set_state(3, 'C')
+    assert list(store._states) == ['1', '3']
+
+
+def test_cache_entries_expire(server):
+    store = make_store(server, cache_size=2, cache_ttl=0.01)
+    store.set_state(1, 'A')
+    store.database.set('1', 'B')
+    assert store.get_state(1) == 'A'
+    time.sleep(0.02)
+    assert store.get_state(1) == 'B'
+
+
+def test_writes_invalidate_other_processes(server):
+    first = make_store(server, cache_size=10)
+    second = make_store(server, cache_size=10)
+    first.subscribe()
+    second.subscribe()
+    wait_for(lambda: first.database.pubsub_numsub(
+        first.channel
+    )[0][1] == 2)
+    first.database.set('1', 'A')
+    first.database.set('2', 'A')
+    assert second.get_state(1) == 'A'
+    assert second.get_state(2) == 'A'
+    first.set_state(1, 'B')
+    wait_for(lambda: '1' not in second._states)
+    assert second.get_state(1) == 'B'
+    assert '2' in second._states
+    # A store ignores its own invalidations.
+    assert first._states['1'][0] == 'B'
+
+
+def test_concurrent_first_calls_share_one_store(server, monkeypatch):
+    database = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(
+        database_backend, 'get_database_connection', lambda: database
+    )
+    monkeypatch.setattr(database_backend, '_state_stores', {})
+    subscriptions = []
+    monkeypatch.setattr(
+        StateStore, 'subscribe', lambda store: subscriptions.append(store)
+    )
+    start = threading.Barrier(8)
+    stores = []
+
+    def get_store():
+        start.wait()
+        stores.append(get_state_store('race_'))
+
+    threads = [threading.Thread(target=get_store) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(store) for store in stores}) == 1
+    assert len(subscriptions) == 1
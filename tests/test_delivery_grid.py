@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from delivery_grid import AMBIGUOUS_CELL, DeliveryGrid
+from pizzeria_distances import DELIVERY_TIER_BOUNDARIES, DistanceEngine
+
+
+@pytest.fixture(scope='module')
+def grid(pizzerias):
+    return DeliveryGrid.build(
+        DistanceEngine(pizzerias, DELIVERY_TIER_BOUNDARIES),
+        'test',
+        DELIVERY_TIER_BOUNDARIES,
+    )
+
+
+def test_grid_matches_geopy_loop(grid, customers, expected):
+    hits = 0
+    for coords, (_, position, tier) in zip(customers, expected):
+        found = grid.lookup(coords.latitude, coords.longitude)
+        if found is None:
+            continue
+        hits += 1
+        assert found == (position, tier)
+    assert hits > len(customers) // 2
+
+
+def test_grid_leaves_boundary_cells_to_the_exact_path(grid, customers,
+                                                      expected):
+    near_boundary = [
+        coords for coords, (meters, _, _) in zip(customers, expected)
+        if min(abs(meters - boundary) for boundary in DELIVERY_TIER_BOUNDARIES)
+        < 5
+    ]
+    assert near_boundary
+    for coords in near_boundary:
+        assert grid.lookup(coords.latitude, coords.longitude) is None
+    assert np.count_nonzero(grid.cells == AMBIGUOUS_CELL) > 0
+
+
+def test_grid_lookup_many_agrees_with_lookup(grid, customers):
+    positions, tiers = grid.lookup_many(
+        [coords.latitude for coords in customers],
+        [coords.longitude for coords in customers]
+    )
+    for coords, position, tier in zip(customers, positions, tiers):
+        found = grid.lookup(coords.latitude, coords.longitude)
+        if found is None:
+            assert position == AMBIGUOUS_CELL
+        else:
+            assert (position, tier) == found
+
+
+def test_grid_survives_save_and_load(grid, tmp_path):
+    grid.save(tmp_path)
+    loaded = DeliveryGrid.load(tmp_path)
+    assert loaded.version == grid.version
+    assert loaded.boundaries == grid.boundaries
+    assert np.array_equal(loaded.keys, grid.keys)
+    assert np.array_equal(loaded.cells, grid.cells)
+
+
+def test_far_customers_fall_back(grid):
+    assert grid.lookup(56.75, 37.62) is None
+    positions, _ = grid.lookup_many([56.75], [37.62])
+    assert positions.tolist() == [AMBIGUOUS_CELL]
@@ -0,0 +1,52 @@
+import random
+
+from geopy.distance import Distance
+
+from delivery_tiers import DEFAULT_DELIVERY_TIERS, DeliveryTiers
+
+
+def make_closest(pizzeria, meters):
+    return {'pizzeria': pizzeria, 'distance': Distance(meters=meters)}
+
+
+def test_default_tiers_keep_the_old_prices():
+    tiers = DeliveryTiers()
+    pizzeria = {'id': '1', 'alias': 'Центр', 'address': 'Тверская, 1'}
+    quotes = [
+        tiers.quote(make_closest(pizzeria, meters))
+        for meters in (0, 499.9, 500, 4999, 5000, 19999, 20000)
+    ]
+    assert [quote.price for quote in quotes] == [0, 0, 100, 100, 300, 300, 0]
+    assert 'Тверская, 1' in quotes[0].message
+    assert quotes[0].markup is quotes[1].markup
+
+
+def test_pizzeria_overrides_by_id_or_alias():
+    tiers = DeliveryTiers(DEFAULT_DELIVERY_TIERS, {
+        'Афимолл': {'less_than_5_km': {'price': 150, 'up_to': 7000}},
+    })
+    override = {'id': '2', 'alias': 'Афимолл', 'address': ''}
+    other = {'id': '3', 'alias': 'Центр', 'address': ''}
+    assert tiers.quote(make_closest(override, 6000)).price == 150
+    assert tiers.quote(make_closest(other, 6000)).price == 300
+    assert tiers.boundaries == (500, 5000, 7000, 20000)
+
+
+def test_quote_many_matches_quote():
+    tiers = DeliveryTiers(DEFAULT_DELIVERY_TIERS, {
+        '2': {'less_than_5_km': {'price': 150, 'up_to': 7000}},
+    })
+    pizzerias = [
+        {'id': str(position), 'alias': '', 'address': f'address {position}'}
+        for position in range(4)
+    ]
+    rng = random.Random(3)
+    closest_pizzerias = [
+        make_closest(rng.choice(pizzerias), rng.choice(
+            [0, 499.9, 500, 5000, 6999, 7000, rng.uniform(0, 30000)]
+        )) for _ in range(200)
+    ]
+    assert tiers.quote_many(closest_pizzerias) == [
+        tiers.quote(closest_pizzeria)
+        for closest_pizzeria in closest_pizzerias
+    ]
@@ -0,0 +1,31 @@
+import pytest
+
+from pizzeria_distances import DELIVERY_TIER_BOUNDARIES, DistanceEngine
+from pizzeria_index import SPHERE_ERROR
+
+
+@pytest.fixture(scope='module')
+def engine(pizzerias):
+    return DistanceEngine(pizzerias, DELIVERY_TIER_BOUNDARIES)
+
+
+def test_distance_engine_matches_geopy_loop(engine, customers, expected):
+    positions, meters = engine.nearest_many(
+        [coords.latitude for coords in customers],
+        [coords.longitude for coords in customers]
+    )
+    assert positions.tolist() == [position for _, position, _ in expected]
+    assert engine.get_tiers(meters).tolist() == [
+        tier for _, _, tier in expected
+    ]
+
+
+def test_single_lookup_agrees_with_batch(engine, customers, expected):
+    for coords, (meters, position, _) in zip(customers[:50], expected):
+        found_position, found_meters = engine.nearest(
+            coords.latitude, coords.longitude
+        )
+        assert found_position == position
+        # Away from ties and boundaries the engine keeps the sphere
+        # distance.
+        assert found_meters == pytest.approx(meters, rel=SPHERE_ERROR)
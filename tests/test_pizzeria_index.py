@@ -0,0 +1,22 @@
+import pytest
+
+from pizzeria import get_closest_pizzeria
+from pizzeria_index import PizzeriaIndex
+
+
+def test_kd_index_matches_geopy_loop(pizzerias, customers, expected):
+    index = PizzeriaIndex(pizzerias)
+    for coords, (meters, position, _) in zip(customers, expected):
+        closest = get_closest_pizzeria(coords, index)
+        assert closest['pizzeria'] == pizzerias[position]
+        assert closest['distance'].m == pytest.approx(meters, abs=1e-6)
+
+
+def test_kd_index_returns_k_nearest_in_order(pizzerias, customers):
+    index = PizzeriaIndex(pizzerias)
+    coords = customers[0]
+    nearest = index.nearest(coords.latitude, coords.longitude, 3)
+    assert len(nearest) == 3
+    assert [meters for meters, _ in nearest] == sorted(
+        meters for meters, _ in nearest
+    )
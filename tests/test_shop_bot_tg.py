@@ -0,0 +1,30 @@
+import pytest
+
+from shop_bot_tg import build_application
+from update_scheduler import ChatLaneUpdateProcessor
+
+BOT_TOKEN = '123456:TEST'
+
+
+@pytest.mark.parametrize('value', ['0', '1'])
+def test_zero_or_one_lane_runs_sequentially(monkeypatch, value):
+    monkeypatch.setenv('PIZZA_SHOP_TG_CONCURRENT_UPDATES', value)
+    application = build_application(BOT_TOKEN)
+    assert application.update_processor.max_concurrent_updates == 1
+    assert not isinstance(
+        application.update_processor, ChatLaneUpdateProcessor
+    )
+
+
+def test_concurrent_updates_become_chat_lanes(monkeypatch):
+    monkeypatch.setenv('PIZZA_SHOP_TG_CONCURRENT_UPDATES', '8')
+    application = build_application(BOT_TOKEN)
+    assert isinstance(application.update_processor, ChatLaneUpdateProcessor)
+    assert application.update_processor.lanes == 8
+
+
+@pytest.mark.parametrize('value', ['-1', 'many'])
+def test_invalid_concurrent_updates_are_reported(monkeypatch, value):
+    monkeypatch.setenv('PIZZA_SHOP_TG_CONCURRENT_UPDATES', value)
+    with pytest.raises(SystemExit, match='PIZZA_SHOP_TG_CONCURRENT_UPDATES'):
+        build_application(BOT_TOKEN)
@@ -0,0 +1,16 @@
+import subprocess
+import sys
+
+
+def test_import_starts_no_threads():
+    # A fresh interpreter, so earlier imports do not hide the effect.
+    output = subprocess.run(
+        [
+            sys.executable, '-c',
+            'import threading, shop_fb_tg; print(threading.active_count())',
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    assert output.strip() == '1'
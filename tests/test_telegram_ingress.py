@@ -0,0 +1,60 @@
+import fakeredis
+import pytest
+
+from telegram_ingress import UpdateConsumer
+
+QUEUE = 'telegram_updates'
+
+
+@pytest.fixture
+def database():
+    return fakeredis.FakeRedis()
+
+
+def test_live_consumer_keeps_its_updates(database):
+    database.rpush(QUEUE, b'1', b'2')
+    first = UpdateConsumer(database, consumer_id='first')
+    first.heartbeat()
+    assert first.take(1) == b'1'
+    # A second replica starting up must not take update 1 again.
+    second = UpdateConsumer(database, consumer_id='second')
+    assert second.heartbeat() == 0
+    assert second.take(1) == b'2'
+    assert second.take(1) is None
+    assert database.lrange(first.processing, 0, -1) == [b'1']
+
+
+def test_expired_consumer_updates_are_requeued_in_order(database):
+    database.rpush(QUEUE, b'1', b'2', b'3')
+    dead = UpdateConsumer(database, consumer_id='dead')
+    dead.heartbeat()
+    assert dead.take(1) == b'1'
+    assert dead.take(1) == b'2'
+    database.delete(f'{QUEUE}:lease:dead')
+    alive = UpdateConsumer(database, consumer_id='alive')
+    assert alive.heartbeat() == 2
+    assert database.lrange(QUEUE, 0, -1) == [b'1', b'2', b'3']
+    assert database.smembers(f'{QUEUE}:consumers') == {b'alive'}
+
+
+def test_acknowledged_updates_are_not_requeued(database):
+    database.rpush(QUEUE, b'1', b'2')
+    consumer = UpdateConsumer(database, consumer_id='consumer')
+    consumer.heartbeat()
+    consumer.acknowledge(consumer.take(1))
+    consumer.take(1)
+    assert consumer.release() == 1
+    assert database.lrange(QUEUE, 0, -1) == [b'2']
+    assert not database.exists(consumer.processing)
+
+
+def test_requeue_waits_for_the_lock(database):
+    database.rpush(f'{QUEUE}:processing:dead', b'1')
+    database.sadd(f'{QUEUE}:consumers', 'dead')
+    database.set(f'{QUEUE}:requeue', 'other')
+    consumer = UpdateConsumer(database, consumer_id='consumer')
+    assert consumer.requeue_expired() == 0
+    assert database.get(f'{QUEUE}:requeue') == b'other'
+    database.delete(f'{QUEUE}:requeue')
+    assert consumer.requeue_expired() == 1
+    assert not database.exists(f'{QUEUE}:requeue')
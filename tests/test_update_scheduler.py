@@ -0,0 +1,106 @@
+import asyncio
+
+from telegram import Update
+
+from update_scheduler import ChatLaneUpdateProcessor, get_chat_key
+
+
+def make_update(update_id, chat_id):
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': str(update_id),
+        },
+    }, None)
+
+
+def run_updates(processor, updates, delays):
+    events = []
+
+    async def handle(update):
+        chat_id = update.effective_chat.id
+        events.append(('start', chat_id, update.update_id))
+        await asyncio.sleep(delays.get(update.update_id, 0.01))
+        events.append(('end', chat_id, update.update_id))
+
+    async def main():
+        await processor.initialize()
+        try:
+            await asyncio.gather(*(
+                processor.process_update(update, handle(update))
+                for update in updates
+            ))
+        finally:
+            await processor.shutdown()
+
+    asyncio.run(main())
+    return events
+
+
+def test_updates_of_one_chat_run_in_order():
+    updates = [make_update(update_id, 7) for update_id in range(10)]
+    # Earlier updates are slower, so running them at once would reorder.
+    delays = {update_id: 0.01 * (10 - update_id) for update_id in range(10)}
+    events = run_updates(ChatLaneUpdateProcessor(lanes=4), updates, delays)
+    expected = []
+    for update_id in range(10):
+        expected += [('start', 7, update_id), ('end', 7, update_id)]
+    assert events == expected
+
+
+def test_updates_of_different_chats_overlap():
+    processor = ChatLaneUpdateProcessor(lanes=4)
+    chats = [
+        chat_id for chat_id in range(100)
+        if processor.get_lane(make_update(0, chat_id)) != processor.get_lane(
+            make_update(0, 0)
+        )
+    ]
+    updates = [make_update(0, 0), make_update(1, chats[0])]
+    events = run_updates(processor, updates, {0: 0.05, 1: 0.05})
+    assert [event for event, _, _ in events] == ['start', 'start', 'end',
+                                                 'end']
+
+
+def test_failed_update_does_not_stop_its_lane():
+    processor = ChatLaneUpdateProcessor(lanes=1)
+    handled = []
+
+    async def fail():
+        raise ValueError('handler failed')
+
+    async def handle(update):
+        handled.append(update.update_id)
+
+    async def main():
+        await processor.initialize()
+        try:
+            await processor.process_update(make_update(0, 7), fail())
+            await processor.process_update(
+                make_update(1, 7), handle(make_update(1, 7))
+            )
+        finally:
+            await processor.shutdown()
+
+    asyncio.run(main())
+    assert handled == [1]
+
+
+def test_chat_key_falls_back_to_user_and_update():
+    query = Update.de_json({
+        'update_id': 5,
+        'pre_checkout_query': {
+            'id': '1',
+            'from': {'id': 9, 'is_bot': False, 'first_name': 'A'},
+            'currency': 'RUB',
+            'total_amount': 100,
+            'invoice_payload': 'payload',
+        },
+    }, None)
+    assert get_chat_key(make_update(1, 7)) == 7
+    assert get_chat_key(query) == 9
+    assert get_chat_key(Update.de_json({'update_id': 3}, None)) == 3
+    assert get_chat_key(object()) is None
@@ -0,0 +1,66 @@
+import json
+
+import fakeredis
+import pytest
+
+from user_data_store import UserData, UserDataStore
+
+
+@pytest.fixture
+def database():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def store(database):
+    return UserDataStore(database, ttl=60)
+
+
+def test_flush_writes_only_changed_fields(database, store):
+    store.save(42, {'cart': 'first', 'address': 'Moscow'})
+    user_data = UserData(store, 42)
+    assert user_data['cart'] == 'first'
+    user_data['cart'] = 'second'
+    # Another process updates a field this update only read.
+    store.save(42, {'address': 'Tver'})
+    user_data.flush()
+    assert store.load(42) == {'cart': 'second', 'address': 'Tver'}
+    assert database.ttl('user_data_42') > 0
+
+
+def test_flush_deletes_removed_fields(database, store):
+    store.save(42, {'cart': 'first', 'address': 'Moscow'})
+    user_data = UserData(store, 42)
+    del user_data['address']
+    user_data.flush()
+    assert database.hgetall('user_data_42') == {
+        b'cart': json.dumps('first').encode('utf-8'),
+    }
+
+
+def test_flush_without_changes_writes_nothing(database, store):
+    store.save(42, {'cart': 'first'})
+    database.persist('user_data_42')
+    user_data = UserData(store, 42)
+    assert dict(user_data) == {'cart': 'first'}
+    user_data.flush()
+    assert database.ttl('user_data_42') == -1
+
+
+def test_assignment_does_not_read_redis(store, monkeypatch):
+    def fail(user_id):
+        raise AssertionError('user data was read')
+
+    monkeypatch.setattr(store, 'load', fail)
+    user_data = UserData(store, 42)
+    user_data['cart'] = 'first'
+    user_data.flush()
+    monkeypatch.undo()
+    assert store.load(42) == {'cart': 'first'}
+
+
+def test_assigned_fields_win_over_stored_ones(store):
+    store.save(42, {'cart': 'first', 'address': 'Moscow'})
+    user_data = UserData(store, 42)
+    user_data['cart'] = 'second'
+    assert dict(user_data) == {'cart': 'second', 'address': 'Moscow'}
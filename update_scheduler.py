@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+CHAT_LANES = 64
+LANE_QUEUE_SIZE = 100
+
+
+class ChatLaneUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates of one chat in order and different chats in parallel.
+
+    Every chat is pinned to one of `lanes` queues, each drained by its
+    own task, so the state read, the handler and the state write of an
+    update finish before the next update of that chat starts. An update
+    counts as processed only once its lane has run it, so
+    Application.stop() waits for the lanes to drain.
+    """
+
+    def __init__(self, lanes=CHAT_LANES, queue_size=LANE_QUEUE_SIZE):
+        # Updates waiting on their lane hold a slot too, so one busy chat
+        # must not be able to take the slots every other chat needs.
+        super().__init__(lanes * queue_size)
+        self.lanes = lanes
+        self.queue_size = queue_size
+        self._queues = []
+        self._workers = []
+
+    async def initialize(self):
+        self._queues = [
+            asyncio.Queue(self.queue_size) for _ in range(self.lanes)
+        ]
+        self._workers = [
+            asyncio.create_task(self._work(queue)) for queue in self._queues
+        ]
+
+    async def shutdown(self):
+        for queue in self._queues:
+            await queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def do_process_update(self, update, coroutine):
+        processed = asyncio.get_running_loop().create_future()
+        await self._queues[self.get_lane(update)].put((coroutine, processed))
+        await processed
+
+    def get_lane(self, update):
+        return hash(get_chat_key(update)) % self.lanes
+
+    def get_queue_depths(self):
+        return [queue.qsize() for queue in self._queues]
+
+    def report_queue_depths(self):
+        depths = self.get_queue_depths()
+        busy = {lane: depth for lane, depth in enumerate(depths) if depth}
+        logger.info(
+            f'Chat lanes: {sum(depths)} queued updates, '
+            f'busiest {max(depths, default=0)}, by lane {busy}'
+        )
+        return depths
+
+    async def _work(self, queue):
+        while True:
+            coroutine, processed = await queue.get()
+            try:
+                await coroutine
+            except Exception as err:
+                logger.error(err)
+            finally:
+                if not processed.done():
+                    processed.set_result(None)
+                queue.task_done()
+
+
+def get_chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    # Shipping and pre-checkout queries carry only the user, which is the
+    # private chat the order came from.
+    if update.effective_user:
+        return update.effective_user.id
+    return update.update_id
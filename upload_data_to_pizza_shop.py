@@ -8,6 +8,7 @@ from dotenv import load_dotenv
 from pytils.translit import slugify
 
 from api_elasticpath import get_token
+from pizzeria_registry import publish_pizzeria_update
 
 logger = logging.getLogger(__name__)
 FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -119,6 +120,7 @@ def main(address, menu):
                 headers=headers, json={'data': json_data}
             )
             response.raise_for_status()
+        publish_pizzeria_update()
 
     if not menu:
         return
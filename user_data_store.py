@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+from collections.abc import MutableMapping
+
+from telegram.ext import CallbackContext, ContextTypes
+
+from database_backend import get_database_connection
+
+logger = logging.getLogger(__name__)
+
+USER_DATA_TTL = 30 * 86400
+USER_DATA_PREFIX = 'user_data_'
+
+_user_data_store = None
+
+
+class UserDataStore(object):
+    """Per-user data in one Redis hash per user, one JSON value per field."""
+
+    def __init__(self, database, prefix=USER_DATA_PREFIX, ttl=USER_DATA_TTL):
+        self.database = database
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def load(self, user_id):
+        fields = self.database.hgetall(self._get_key(user_id))
+        return {
+            field.decode('utf-8'): json.loads(value)
+            for field, value in fields.items()
+        }
+
+    def save(self, user_id, changed, deleted=(), pipeline=None):
+        key = self._get_key(user_id)
+        execute = pipeline is None
+        if execute:
+            pipeline = self.database.pipeline(transaction=False)
+        if changed:
+            pipeline.hset(key, mapping={
+                field: json.dumps(value) for field, value in changed.items()
+            })
+        if deleted:
+            pipeline.hdel(key, *deleted)
+        pipeline.expire(key, self.ttl)
+        if execute:
+            pipeline.execute()
+
+    def _get_key(self, user_id):
+        return f'{self.prefix}{user_id}'
+
+
+class UserData(MutableMapping):
+    """user_data of one update, read from Redis on first read.
+
+    Assigned and deleted fields are remembered and written by flush();
+    changes inside a stored value are not noticed, so assign it again.
+    """
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+        self._data = {}
+        self._loaded = False
+        self._changed = set()
+        self._deleted = set()
+
+    def load(self):
+        if not self._loaded:
+            data = self.store.load(self.user_id)
+            for field in self._deleted:
+                data.pop(field, None)
+            data.update(self._data)
+            self._data = data
+            self._loaded = True
+        return self
+
+    def flush(self, pipeline=None):
+        if not self._changed and not self._deleted:
+            return
+        logger.debug(
+            f'Saving user data {sorted(self._changed)} of {self.user_id}'
+        )
+        self.store.save(
+            self.user_id,
+            {field: self._data[field] for field in self._changed},
+            self._deleted,
+            pipeline,
+        )
+        self._changed = set()
+        self._deleted = set()
+
+    def __getitem__(self, field):
+        return self.load()._data[field]
+
+    def __setitem__(self, field, value):
+        self._data[field] = value
+        self._changed.add(field)
+        self._deleted.discard(field)
+
+    def __delitem__(self, field):
+        del self.load()._data[field]
+        self._deleted.add(field)
+        self._changed.discard(field)
+
+    def __iter__(self):
+        return iter(self.load()._data)
+
+    def __len__(self):
+        return len(self.load()._data)
+
+    def __repr__(self):
+        return f'UserData({self.user_id}, {self._data!r})'
+
+
+class UserDataContext(CallbackContext):
+    """CallbackContext whose user_data lives in Redis, not in the process."""
+
+    @property
+    def user_data(self):
+        if self._user_id is None:
+            return None
+        user_data = getattr(self, '_stored_user_data', None)
+        if user_data is None:
+            user_data = UserData(get_user_data_store(), self._user_id)
+            self._stored_user_data = user_data
+        return user_data
+
+
+def get_user_data_store():
+    global _user_data_store
+    if _user_data_store is None:
+        _user_data_store = UserDataStore(
+            get_database_connection(),
+            ttl=int(os.getenv('PIZZA_SHOP_USER_DATA_TTL', USER_DATA_TTL)),
+        )
+    return _user_data_store
+
+
+def get_context_types():
+    return ContextTypes(context=UserDataContext)